@@ -1,2 +1,314 @@
-from .orion import run_pipeline
-run_pipeline()
+import argparse
+import logging
+
+from .config import Config
+from .orion import run_fusion, run_pipeline, NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE
+
+BENCHMARK_BASELINE_FILE = 'device-config/benchmark-baseline.json'
+
+
+def _probe_capture(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_capture_probe
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    if args.camera is not None:
+        try:
+            config.camera.id = int(args.camera)
+        except ValueError:
+            config.camera.id = args.camera
+    if args.width is not None:
+        config.camera.resolution_width = args.width
+    if args.height is not None:
+        config.camera.resolution_height = args.height
+    run_capture_probe(config, args.templates, args.test_source, args.frames, args.warmup)
+
+
+def _tune_detector(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import generate_synthetic_frames, load_image_frames, reference_labels, tune_detector
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    tag_family = Config.fiducial_families[args.family]
+    if args.images is not None:
+        frames = reference_labels(load_image_frames(args.images), tag_family)
+    else:
+        frames = generate_synthetic_frames(tag_family, args.synthetic_frames)
+    if len(frames) == 0:
+        parser.error("no frames to tune on")
+    tune_detector(config.detector,
+                  tag_family,
+                  frames,
+                  max_profiles=args.max_profiles,
+                  min_recall=args.min_recall,
+                  output_file=args.output)
+
+
+def _bench_detectors(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import generate_synthetic_frames, load_image_frames, reference_labels, run_detector_benchmark
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    config.fiducial.tag_family = Config.fiducial_families[args.family]
+    if args.images is not None:
+        frames = reference_labels(load_image_frames(args.images), config.fiducial.tag_family)
+    else:
+        frames = generate_synthetic_frames(config.fiducial.tag_family, args.synthetic_frames)
+    if len(frames) == 0:
+        parser.error("no frames to benchmark on")
+    run_detector_benchmark(config, frames, args.apriltag_threads, args.tiles)
+
+
+def _bench_layout_filter(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import generate_synthetic_frames, load_image_frames, reference_labels, run_layout_filter_benchmark
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    config.fiducial.tag_family = Config.fiducial_families[args.family]
+    if args.images is not None:
+        frames = reference_labels(load_image_frames(args.images), config.fiducial.tag_family)
+    else:
+        # Frames show tags from a wider range of IDs than the layout, like tags of other fields or robots
+        frames = generate_synthetic_frames(config.fiducial.tag_family,
+                                           args.synthetic_frames,
+                                           tags_per_frame=args.tags,
+                                           tag_ids=range(args.frame_ids))
+    if len(frames) == 0:
+        parser.error("no frames to benchmark on")
+    run_layout_filter_benchmark(config, frames, range(args.layout_tags))
+
+
+def _tile_layout(value: str) -> tuple[int, int]:
+    try:
+        rows, cols = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid tile layout {value}, expected ROWSxCOLS")
+    return rows, cols
+
+
+def _bench_pose(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_pose_benchmark
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    run_pose_benchmark(config, args.tags, args.iterations)
+
+
+def _bench_allocations(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import generate_synthetic_frames, run_allocation_benchmark
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    config.fiducial.tag_family = Config.fiducial_families[args.family]
+    frames = generate_synthetic_frames(config.fiducial.tag_family, args.synthetic_frames, tags_per_frame=args.tags)
+    run_allocation_benchmark(config, frames, args.iterations, args.by_line)
+
+
+def _bench_nt(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_nt_load_test
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    run_nt_load_test(config,
+                     args.instances,
+                     args.targets,
+                     args.rate,
+                     args.subscribers,
+                     not args.latest_only,
+                     args.subscriber_periodic,
+                     args.duration,
+                     args.port,
+                     args.per_topic)
+
+
+def _bench_fusion(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_fusion_check
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    result = run_fusion_check(config, args.steps, args.noise, args.dropout_every, args.seed)
+    if result.grouping_errors > 0:
+        parser.exit(1)
+
+
+def _bench(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_regression_benchmark
+
+    comparisons = run_regression_benchmark(args.baseline,
+                                           args.only,
+                                           threshold=args.threshold,
+                                           min_time_s=args.min_time,
+                                           update_baseline=args.save_baseline)
+    if len(comparisons) == 0 or (not args.save_baseline
+                                 and any(c.change is not None and c.change > args.threshold for c in comparisons)):
+        parser.exit(1)
+
+
+def _calibrate(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_offline_calibration
+
+    candidate = run_offline_calibration(args.images,
+                                        args.output,
+                                        workers=args.workers,
+                                        min_corners=args.min_corners,
+                                        min_coverage=args.min_coverage,
+                                        max_frame_error=args.max_frame_error,
+                                        subsets=args.subsets,
+                                        subset_fraction=args.subset_fraction)
+    if candidate is None:
+        parser.exit(1)
+
+
+def _replay(args: argparse.Namespace):
+    logging.basicConfig(level=logging.INFO)
+    from .tools import run_replay
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    config.fiducial.tag_family = Config.fiducial_families[args.family]
+    run_replay(config, args.path, args.verbose)
+
+
+parser = argparse.ArgumentParser(prog="orion")
+subparsers = parser.add_subparsers(dest="command")
+
+fuse_parser = subparsers.add_parser("fuse",
+                                    help="fuse tag observations from several devices into one robot pose")
+fuse_parser.set_defaults(func=lambda _: run_fusion())
+
+probe_parser = subparsers.add_parser("probe-capture",
+                                     help="measure throughput of GStreamer capture pipeline templates")
+probe_parser.add_argument("templates", nargs="*",
+                          help="templates to probe, defaults to every built-in and configured template")
+probe_parser.add_argument("--test-source", action="store_true",
+                          help="use videotestsrc instead of a camera (CPU usage then includes test encoding)")
+probe_parser.add_argument("--camera", help="camera index or device path")
+probe_parser.add_argument("--width", type=int)
+probe_parser.add_argument("--height", type=int)
+probe_parser.add_argument("--frames", type=int, default=300)
+probe_parser.add_argument("--warmup", type=int, default=30)
+probe_parser.set_defaults(func=_probe_capture)
+
+tune_parser = subparsers.add_parser("tune-detector",
+                                    help="sweep detector parameters and report the speed/accuracy Pareto front")
+tune_parser.add_argument("--images", help="directory of recorded frames, synthetic frames are used if not given")
+tune_parser.add_argument("--synthetic-frames", type=int, default=20)
+tune_parser.add_argument("--family", choices=Config.fiducial_families.keys(), default="apriltag_36h11")
+tune_parser.add_argument("--max-profiles", type=int, help="randomly sample at most this many profiles")
+tune_parser.add_argument("--min-recall", type=float, default=0.99,
+                         help="minimum recall of the profile written to --output, relative to the best profile")
+tune_parser.add_argument("--output", help=f"write the chosen profile here, e.g. {DETECTOR_CONFIG_FILE}")
+tune_parser.set_defaults(func=_tune_detector)
+
+bench_detectors_parser = subparsers.add_parser("bench-detectors",
+                                               help="compare detection time and accuracy of the detector backends")
+bench_detectors_parser.add_argument("--images",
+                                    help="directory of recorded frames, synthetic frames are used if not given")
+bench_detectors_parser.add_argument("--synthetic-frames", type=int, default=50)
+bench_detectors_parser.add_argument("--family", choices=Config.fiducial_families.keys(), default="apriltag_36h11")
+bench_detectors_parser.add_argument("--apriltag-threads", type=int, nargs="+", default=[1, 2, 4])
+bench_detectors_parser.add_argument("--tiles", type=_tile_layout, nargs="*", default=[(2, 2)],
+                                    help="tile layouts to compare with full frame ArUco detection, e.g. 2x2")
+bench_detectors_parser.set_defaults(func=_bench_detectors)
+
+bench_layout_parser = subparsers.add_parser("bench-layout-filter",
+                                           help="compare decoding only layout IDs with filtering by the layout after "
+                                                "decoding")
+bench_layout_parser.add_argument("--images",
+                                 help="directory of recorded frames, synthetic frames are used if not given")
+bench_layout_parser.add_argument("--synthetic-frames", type=int, default=50)
+bench_layout_parser.add_argument("--family", choices=Config.fiducial_families.keys(), default="apriltag_36h11")
+bench_layout_parser.add_argument("--layout-tags", type=int, default=16, help="layout holds IDs 0 to this - 1")
+bench_layout_parser.add_argument("--frame-ids", type=int, default=64,
+                                 help="synthetic frames show tags with IDs 0 to this - 1")
+bench_layout_parser.add_argument("--tags", type=int, default=12, help="tags per synthetic frame")
+bench_layout_parser.set_defaults(func=_bench_layout_filter)
+
+bench_pose_parser = subparsers.add_parser("bench-pose",
+                                          help="compare the batched and per-tag target pose solvers")
+bench_pose_parser.add_argument("--tags", type=int, nargs="+", default=[1, 4, 8, 16])
+bench_pose_parser.add_argument("--iterations", type=int, default=200)
+bench_pose_parser.set_defaults(func=_bench_pose)
+
+bench_allocations_parser = subparsers.add_parser("bench-allocations",
+                                                 help="measure per-frame allocations and GC pauses after detection")
+bench_allocations_parser.add_argument("--synthetic-frames", type=int, default=20)
+bench_allocations_parser.add_argument("--tags", type=int, default=10, help="tags per frame")
+bench_allocations_parser.add_argument("--family", choices=Config.fiducial_families.keys(), default="apriltag_36h11")
+bench_allocations_parser.add_argument("--iterations", type=int, default=2000)
+bench_allocations_parser.add_argument("--by-line", type=int, default=0, metavar="N",
+                                      help="also list the N lines of Orion code with the most transient allocations")
+bench_allocations_parser.set_defaults(func=_bench_allocations)
+
+bench_nt_parser = subparsers.add_parser("bench-nt",
+                                        help="measure NT publish cost, latency and bandwidth against a local server")
+bench_nt_parser.add_argument("--instances", type=int, nargs="+", default=[1, 4], help="simulated Orion instances")
+bench_nt_parser.add_argument("--targets", type=int, nargs="+", default=[0, 8, 32], help="tracked targets per result")
+bench_nt_parser.add_argument("--rate", type=float, default=60.0, help="results published per second per instance")
+bench_nt_parser.add_argument("--subscribers", type=int, default=2, help="simulated dashboards")
+bench_nt_parser.add_argument("--latest-only", action="store_true",
+                             help="subscribe without sendAll, like a dashboard that only shows the latest value")
+bench_nt_parser.add_argument("--subscriber-periodic", type=float, default=0.1,
+                             help="subscriber update period in seconds, NT batches values sent within it")
+bench_nt_parser.add_argument("--duration", type=float, default=5.0, help="seconds to measure each scenario")
+bench_nt_parser.add_argument("--port", type=int, default=5820, help="port of the local NT4 server")
+bench_nt_parser.add_argument("--per-topic", action="store_true", help="also print latency and bandwidth per topic")
+bench_nt_parser.set_defaults(func=_bench_nt)
+
+bench_fusion_parser = subparsers.add_parser("bench-fusion",
+                                            help="fuse synthetic observations of two fake devices and compare the "
+                                                 "fused poses with the true ones")
+bench_fusion_parser.add_argument("--steps", type=int, default=100, help="timesteps to publish")
+bench_fusion_parser.add_argument("--noise", type=float, default=0.3, help="corner noise in pixels")
+bench_fusion_parser.add_argument("--dropout-every", type=int, default=10,
+                                 help="the second device skips every nth timestep, 0 to never skip")
+bench_fusion_parser.add_argument("--seed", type=int, default=0)
+bench_fusion_parser.set_defaults(func=_bench_fusion)
+
+bench_parser = subparsers.add_parser("bench",
+                                     help="time the hot paths on fixed inputs and flag regressions against a baseline")
+bench_parser.add_argument("--baseline", default=BENCHMARK_BASELINE_FILE, help="baseline file for this machine")
+bench_parser.add_argument("--save-baseline", action="store_true",
+                          help="store the results as the new baseline of the benchmarks that were run")
+bench_parser.add_argument("--threshold", type=float, default=0.15,
+                          help="flag benchmarks whose median is this fraction slower than the baseline")
+bench_parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each benchmark")
+bench_parser.add_argument("--only", nargs="+", help="only run benchmarks whose names contain one of these")
+bench_parser.set_defaults(func=_bench)
+
+calibrate_parser = subparsers.add_parser("calibrate", help="calibrate the camera from a directory of ChArUco images")
+calibrate_parser.add_argument("images", help="directory of calibration images")
+calibrate_parser.add_argument("--output", default=CALIBRATION_FILE)
+calibrate_parser.add_argument("--workers", type=int, help="worker processes, defaults to the number of CPUs")
+calibrate_parser.add_argument("--min-corners", type=int, default=12,
+                              help="reject frames with fewer ChArUco corners detected")
+calibrate_parser.add_argument("--min-coverage", type=float, default=0.02,
+                              help="reject frames where the board covers less than this fraction of the image")
+calibrate_parser.add_argument("--max-frame-error", type=float, default=1.0,
+                              help="reject frames with a higher reprojection error (px), then calibrate again")
+calibrate_parser.add_argument("--subsets", type=int, default=0,
+                              help="calibrate this many random subsets in parallel and keep the most typical result")
+calibrate_parser.add_argument("--subset-fraction", type=float, default=0.7)
+calibrate_parser.set_defaults(func=_calibrate)
+
+replay_parser = subparsers.add_parser("replay", help="run the pipeline over recorded frames")
+replay_parser.add_argument("path", help="recording directory or segment")
+replay_parser.add_argument("--family", choices=Config.fiducial_families.keys(), default="apriltag_36h11")
+replay_parser.add_argument("--verbose", action="store_true", help="print the result of every frame")
+replay_parser.set_defaults(func=_replay)
+
+args = parser.parse_args()
+if args.command is None:
+    run_pipeline()
+else:
+    args.func(args)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import ntcore
 
 from ..config import Config
@@ -5,13 +7,15 @@ from ..config import Config
 
 class CalibrationController:
     _config: Config
+    _nt_instance: ntcore.NetworkTableInstance
 
     _nt_initialized: bool = False
     _is_calibrating_entry: ntcore.BooleanEntry
     _capture_frame_entry: ntcore.BooleanEntry
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, nt_instance: Optional[ntcore.NetworkTableInstance] = None):
         self._config = config
+        self._nt_instance = nt_instance if nt_instance is not None else ntcore.NetworkTableInstance.getDefault()
 
     def is_calibrating(self) -> bool:
         if not self._nt_initialized:
@@ -30,7 +34,7 @@ class CalibrationController:
         return False
 
     def _init_nt(self):
-        table = ntcore.NetworkTableInstance.getDefault().getTable(f"orion/{self._config.network.device_id}/calibration")
+        table = self._nt_instance.getTable(f"orion/{self._config.network.device_id}/calibration")
         self._is_calibrating_entry = table.getBooleanTopic("is_calibrating").getEntry(False)
         self._capture_frame_entry = table.getBooleanTopic("capture_frame").getEntry(False)
         self._is_calibrating_entry.set(False)
@@ -13,6 +13,26 @@ from ..pipeline import CaptureFrame
 logger = logging.getLogger(__name__)
 
 
+def make_charuco_board() -> cv2.aruco.CharucoBoard:
+    marker_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_1000)
+    return cv2.aruco.CharucoBoard([12, 9], 0.030, 0.023, marker_dict)
+
+
+def write_calibration(calibration_file: str,
+                      camera_mat: npt.NDArray[np.float64],
+                      dist_coeffs: npt.NDArray[np.float64],
+                      avg_reproj_err: float):
+    # Written in the format Config.refresh_local reads
+    if os.path.exists(calibration_file):
+        os.remove(calibration_file)
+    calib_file = cv2.FileStorage(calibration_file, cv2.FILE_STORAGE_WRITE)
+    calib_file.write("calibration_time", str(datetime.datetime.now()))
+    calib_file.write("avg_reprojection_error", avg_reproj_err)
+    calib_file.write("camera_matrix", camera_mat)
+    calib_file.write("distortion_coefficients", dist_coeffs)
+    calib_file.release()
+
+
 class CalibrationPipeline:
     _controller: CalibrationController
 
@@ -26,10 +46,9 @@ class CalibrationPipeline:
 
     def __init__(self, controller: CalibrationController):
         self._controller = controller
-        marker_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_1000)
         charuco_params = cv2.aruco.CharucoParameters()
         detector_params = cv2.aruco.DetectorParameters()
-        self._charuco_board = cv2.aruco.CharucoBoard([12, 9], 0.030, 0.023, marker_dict)
+        self._charuco_board = make_charuco_board()
         self._detector = cv2.aruco.CharucoDetector(self._charuco_board, charuco_params, detector_params)
 
     def process_frame(self, frame: CaptureFrame):
@@ -61,9 +80,6 @@ class CalibrationPipeline:
             logger.warning(
                 f"Small calibration sample size {num_frames}, 10 or more frames recommended for accurate results")
 
-        if os.path.exists(calibration_file):
-            os.remove(calibration_file)
-
         retval, camera_mat, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(self._object_pts,
                                                                             self._image_pts,
                                                                             self._image_size,
@@ -82,10 +98,5 @@ class CalibrationPipeline:
         if avg_reproj_err >= 1:
             logger.warning(f"High mean reprojection error {avg_reproj_err}, calibration may be inaccurate")
 
-        calib_file = cv2.FileStorage(calibration_file, cv2.FILE_STORAGE_WRITE)
-        calib_file.write("calibration_time", str(datetime.datetime.now()))
-        calib_file.write("avg_reprojection_error", avg_reproj_err)
-        calib_file.write("camera_matrix", camera_mat)
-        calib_file.write("distortion_coefficients", dist_coeffs)
-
+        write_calibration(calibration_file, camera_mat, dist_coeffs, avg_reproj_err)
         logger.info(f"Calibration successful. Data saved to {calibration_file}")
@@ -1,7 +1,9 @@
 __all__ = [
     "CalibrationPipeline",
-    "CalibrationController"
+    "CalibrationController",
+    "make_charuco_board",
+    "write_calibration"
 ]
 
-from CalibrationPipeline import CalibrationPipeline
-from CalibrationController import CalibrationController
+from .CalibrationPipeline import CalibrationPipeline, make_charuco_board, write_calibration
+from .CalibrationController import CalibrationController
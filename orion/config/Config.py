@@ -1,16 +1,29 @@
+import dataclasses
 import json
 import logging
-from typing import Union
+from typing import Any, Dict, Union, get_type_hints
 
 import cv2
 import ntcore
 import numpy as np
-from wpimath.geometry import Pose3d, Rotation3d, Quaternion
+from wpimath.geometry import Pose3d, Rotation3d, Quaternion, Transform3d, Translation3d
 
-from .config_types import NetworkConfig, CameraConfig, Calibration, FiducialConfig
+from .config_types import (NetworkConfig,
+                           CameraConfig,
+                           Calibration,
+                           DetectorConfig,
+                           FiducialConfig,
+                           FusionConfig,
+                           ProfilerConfig,
+                           RecordingConfig,
+                           RoleSchedule,
+                           SchedulingConfig)
 
 logger = logging.getLogger(__name__)
 
+# Resolved field types, since annotations may be strings
+DETECTOR_PARAM_TYPES: Dict[str, type] = get_type_hints(DetectorConfig)
+
 
 class Config:
     fiducial_families = {
@@ -37,13 +50,28 @@ class Config:
         "aruco_mip_36h12": cv2.aruco.DICT_ARUCO_MIP_36h12
     }
 
+    detector_backends = ["aruco", "apriltag"]
+
+    corner_refinement_methods = {
+        "none": cv2.aruco.CORNER_REFINE_NONE,
+        "subpix": cv2.aruco.CORNER_REFINE_SUBPIX,
+        "contour": cv2.aruco.CORNER_REFINE_CONTOUR,
+        "apriltag": cv2.aruco.CORNER_REFINE_APRILTAG
+    }
+
     network: NetworkConfig
     camera: CameraConfig
     calibration: Union[Calibration, None]
     fiducial: FiducialConfig
+    detector: DetectorConfig
+    recording: RecordingConfig
+    profiler: ProfilerConfig
+    fusion: FusionConfig
+    scheduling: SchedulingConfig
 
     network_config_file: str
     calibration_file: str
+    detector_config_file: str
 
     _nt_initialized: bool = False
     _camera_id_entry: ntcore.StringEntry
@@ -53,20 +81,33 @@ class Config:
     _camera_exposure_entry: ntcore.IntegerEntry
     _camera_brightness_entry: ntcore.IntegerEntry
     _camera_gain_entry: ntcore.IntegerEntry
+    _camera_capture_pipelines_entry: ntcore.StringArrayEntry
     _tag_family_entry: ntcore.StringEntry
+    _extra_tag_families_entry: ntcore.StringArrayEntry
     _tag_size_entry: ntcore.DoubleEntry
     _tag_layout_entry: ntcore.StringEntry
+    _detector_params_entry: ntcore.StringEntry
 
+    _local_detector: DetectorConfig
     _last_family_update: int = -1
+    _last_extra_families_update: int = -1
     _last_layout_update: int = -1
+    _last_detector_params_update: int = -1
 
-    def __init__(self, network_config_file: str, calibration_file: str):
+    def __init__(self, network_config_file: str, calibration_file: str, detector_config_file: str):
         self.network_config_file = network_config_file
         self.calibration_file = calibration_file
+        self.detector_config_file = detector_config_file
         self.network = NetworkConfig()
         self.camera = CameraConfig()
         self.calibration = Calibration()
         self.fiducial = FiducialConfig()
+        self.detector = DetectorConfig()
+        self.recording = RecordingConfig()
+        self.profiler = ProfilerConfig()
+        self.fusion = FusionConfig()
+        self.scheduling = SchedulingConfig()
+        self._local_detector = DetectorConfig()
 
     def refresh_local(self):
         logger.info(f"Loading network config from {self.network_config_file}...")
@@ -76,6 +117,40 @@ class Config:
                 self.network.device_id = network_data["device_id"]
                 self.network.server_ip = network_data["server_ip"]
                 self.network.stream_port = network_data["stream_port"]
+                self.camera.capture_templates = dict(network_data.get("capture_templates", {}))
+                recording_data = network_data.get("recording", {})
+                self.recording.directory = recording_data.get("directory", self.recording.directory)
+                self.recording.max_disk_mb = recording_data.get("max_disk_mb", self.recording.max_disk_mb)
+                self.recording.segment_frames = recording_data.get("segment_frames", self.recording.segment_frames)
+                self.recording.queue_size = recording_data.get("queue_size", self.recording.queue_size)
+                self.recording.video_fps = recording_data.get("video_fps", self.recording.video_fps)
+                profiler_data = network_data.get("profiler", {})
+                self.profiler.directory = profiler_data.get("directory", self.profiler.directory)
+                self.profiler.num_frames = profiler_data.get("num_frames", self.profiler.num_frames)
+                self.profiler.max_profiles = profiler_data.get("max_profiles", self.profiler.max_profiles)
+                scheduling_data = network_data.get("scheduling", {})
+                self.scheduling.opencv_threads = scheduling_data.get("opencv_threads",
+                                                                     self.scheduling.opencv_threads)
+                self.scheduling.report_interval_s = scheduling_data.get("report_interval_s",
+                                                                        self.scheduling.report_interval_s)
+                try:
+                    self.scheduling.roles = {role: RoleSchedule(list(role_data.get("cpus", [])),
+                                                                role_data.get("nice"),
+                                                                role_data.get("realtime_priority", 0))
+                                             for role, role_data in scheduling_data.get("roles", {}).items()}
+                except (AttributeError, TypeError):
+                    logger.warning("Failed to load thread scheduling roles, invalid format")
+                    self.scheduling.roles = {}
+                fusion_data = network_data.get("fusion", {})
+                self.fusion.device_id = fusion_data.get("device_id", self.fusion.device_id)
+                self.fusion.max_time_skew_ms = fusion_data.get("max_time_skew_ms", self.fusion.max_time_skew_ms)
+                self.fusion.max_wait_ms = fusion_data.get("max_wait_ms", self.fusion.max_wait_ms)
+                try:
+                    self.fusion.cameras = {device_id: self.parse_transform(transform_data)
+                                           for device_id, transform_data in fusion_data.get("cameras", {}).items()}
+                except (KeyError, TypeError):
+                    logger.warning("Failed to load fusion camera transforms, invalid format")
+                    self.fusion.cameras = {}
         except FileNotFoundError:
             logger.error(f"Network config file {self.network_config_file} not found, using defaults")
 
@@ -91,6 +166,16 @@ class Config:
             self.calibration.intrinsics_matrix = intrinsics_mat
             self.calibration.distortion_coeffs = dist_coeffs
 
+        logger.info(f"Loading detector config from {self.detector_config_file}...")
+        try:
+            with open(self.detector_config_file, "r") as f:
+                self._local_detector = self.parse_detector_params(json.loads(f.read()), DetectorConfig())
+        except FileNotFoundError:
+            logger.info(f"Detector config file {self.detector_config_file} not found, using defaults")
+        except (json.JSONDecodeError, TypeError, ValueError):
+            logger.warning(f"Detector config file {self.detector_config_file} is invalid, using defaults")
+        self.detector = dataclasses.replace(self._local_detector)
+
     def refresh_nt(self):
         if not self._nt_initialized:
             self._init_nt()
@@ -107,6 +192,7 @@ class Config:
         self.camera.exposure = self._camera_exposure_entry.get()
         self.camera.brightness = self._camera_brightness_entry.get()
         self.camera.gain = self._camera_gain_entry.get()
+        self.camera.capture_pipelines = list(self._camera_capture_pipelines_entry.get())
 
         self.fiducial.tag_size_m = self._tag_size_entry.get()
 
@@ -120,6 +206,16 @@ class Config:
                 self.fiducial.tag_family = cv2.aruco.DICT_APRILTAG_36h11
             self._last_family_update = family_change
 
+        if (extra_families_change := self._extra_tag_families_entry.getLastChange()) > self._last_extra_families_update:
+            extra_families = []
+            for tag_family in self._extra_tag_families_entry.get():
+                if tag_family in self.fiducial_families:
+                    extra_families.append(self.fiducial_families[tag_family])
+                else:
+                    logger.warning(f'Unknown extra tag family "{tag_family}", ignoring')
+            self.fiducial.extra_tag_families = extra_families
+            self._last_extra_families_update = extra_families_change
+
         if (layout_change := self._tag_layout_entry.getLastChange()) > self._last_layout_update:
             try:
                 self.fiducial.tag_layout = {}
@@ -140,6 +236,52 @@ class Config:
                 self.fiducial.tag_layout = None
             self._last_layout_update = layout_change
 
+        if (detector_params_change := self._detector_params_entry.getLastChange()) > self._last_detector_params_update:
+            detector_params = self._detector_params_entry.get()
+            try:
+                # NT parameters are applied on top of the local detector config
+                self.detector = self.parse_detector_params(json.loads(detector_params) if detector_params else {},
+                                                           self._local_detector)
+                logger.debug("Set detector parameters")
+            except (json.JSONDecodeError, TypeError, ValueError):
+                logger.warning("Failed to load detector parameters, invalid format")
+                self.detector = dataclasses.replace(self._local_detector)
+            self._last_detector_params_update = detector_params_change
+
+    @staticmethod
+    def parse_transform(data: Dict[str, Any]) -> Transform3d:
+        # Same translation and quaternion format as poses in the tag layout
+        return Transform3d(Translation3d(data["translation"]["x"], data["translation"]["y"], data["translation"]["z"]),
+                           Rotation3d(Quaternion(data["rotation"]["quaternion"]["w"],
+                                                 data["rotation"]["quaternion"]["x"],
+                                                 data["rotation"]["quaternion"]["y"],
+                                                 data["rotation"]["quaternion"]["z"])))
+
+    def parse_detector_params(self, data: Dict[str, Any], base: DetectorConfig) -> DetectorConfig:
+        if not isinstance(data, dict):
+            raise TypeError("Detector parameters must be a JSON object")
+        detector = dataclasses.replace(base)
+        for name, value in data.items():
+            if name not in DETECTOR_PARAM_TYPES:
+                logger.warning(f'Unknown detector parameter "{name}", ignoring')
+                continue
+            field_type = DETECTOR_PARAM_TYPES[name]
+            # bool is a subclass of int, so it's only accepted for bool fields. Integers are accepted for float fields.
+            if field_type is float and type(value) is int:
+                value = float(value)
+            if type(value) is not field_type:
+                logger.warning(f'Detector parameter "{name}" must be {field_type.__name__}, got {value!r}, ignoring')
+                continue
+            setattr(detector, name, value)
+        if detector.backend not in self.detector_backends:
+            logger.warning(f'Unknown detector backend "{detector.backend}", defaulting to aruco')
+            detector.backend = "aruco"
+        if detector.corner_refinement_method not in self.corner_refinement_methods:
+            logger.warning(f'Unknown corner refinement method "{detector.corner_refinement_method}", '
+                           f'defaulting to none')
+            detector.corner_refinement_method = "none"
+        return detector
+
     def _init_nt(self):
         logger.info("Initializing NetworkTables config...")
 
@@ -155,9 +297,13 @@ class Config:
         self._camera_exposure_entry = table.getIntegerTopic("camera_exposure").getEntry(self.camera.exposure)
         self._camera_brightness_entry = table.getIntegerTopic("camera_brightness").getEntry(self.camera.brightness)
         self._camera_gain_entry = table.getIntegerTopic("camera_gain").getEntry(self.camera.gain)
+        self._camera_capture_pipelines_entry = (
+            table.getStringArrayTopic("camera_capture_pipelines").getEntry(self.camera.capture_pipelines))
         self._tag_family_entry = table.getStringTopic("tag_family").getEntry("apriltag_36h11")
+        self._extra_tag_families_entry = table.getStringArrayTopic("extra_tag_families").getEntry([])
         self._tag_size_entry = table.getDoubleTopic("tag_size_m").getEntry(self.fiducial.tag_size_m)
         self._tag_layout_entry = table.getStringTopic("tag_layout").getEntry("")
+        self._detector_params_entry = table.getStringTopic("detector_params").getEntry("")
 
         self._camera_id_entry.setDefault(str(self.camera.id))
         self._camera_resolution_w_entry.setDefault(self.camera.resolution_width)
@@ -166,9 +312,12 @@ class Config:
         self._camera_exposure_entry.setDefault(self.camera.exposure)
         self._camera_brightness_entry.setDefault(self.camera.brightness)
         self._camera_gain_entry.setDefault(self.camera.gain)
+        self._camera_capture_pipelines_entry.setDefault(self.camera.capture_pipelines)
         self._tag_family_entry.setDefault("apriltag_36h11")
+        self._extra_tag_families_entry.setDefault([])
         self._tag_size_entry.setDefault(self.fiducial.tag_size_m)
         self._tag_layout_entry.setDefault("")
+        self._detector_params_entry.setDefault("")
 
         self._camera_id_entry.getTopic().setRetained(True)
         self._camera_resolution_w_entry.getTopic().setRetained(True)
@@ -177,9 +326,12 @@ class Config:
         self._camera_exposure_entry.getTopic().setRetained(True)
         self._camera_brightness_entry.getTopic().setRetained(True)
         self._camera_gain_entry.getTopic().setRetained(True)
+        self._camera_capture_pipelines_entry.getTopic().setRetained(True)
         self._tag_family_entry.getTopic().setRetained(True)
+        self._extra_tag_families_entry.getTopic().setRetained(True)
         self._tag_size_entry.getTopic().setRetained(True)
         self._tag_layout_entry.getTopic().setRetained(True)
+        self._detector_params_entry.getTopic().setRetained(True)
 
         self._nt_initialized = True
 
@@ -2,7 +2,22 @@ __all__ = [
     "Config",
     "Calibration",
     "CameraConfig",
+    "DetectorConfig",
     "FiducialConfig",
+    "FusionConfig",
+    "ProfilerConfig",
+    "RecordingConfig",
+    "RoleSchedule",
+    "SchedulingConfig",
 ]
 
-from .Config import Calibration, CameraConfig, FiducialConfig, Config
+from .Config import (Calibration,
+                     CameraConfig,
+                     DetectorConfig,
+                     FiducialConfig,
+                     FusionConfig,
+                     ProfilerConfig,
+                     RecordingConfig,
+                     RoleSchedule,
+                     SchedulingConfig,
+                     Config)
@@ -1,10 +1,10 @@
-from dataclasses import dataclass
-from typing import Dict, Union, Optional
+from dataclasses import dataclass, field
+from typing import Dict, List, Union, Optional
 
 import cv2
 import numpy as np
 import numpy.typing as npt
-from wpimath.geometry import Pose3d
+from wpimath.geometry import Pose3d, Transform3d
 
 
 @dataclass
@@ -14,6 +14,48 @@ class NetworkConfig:
     stream_port: str = "8000"
 
 
+@dataclass
+class RecordingConfig:
+    directory: str = "recordings"
+    max_disk_mb: int = 4096
+    segment_frames: int = 3000
+    queue_size: int = 16
+    video_fps: int = 60
+
+
+@dataclass
+class ProfilerConfig:
+    directory: str = "profiles"
+    num_frames: int = 300
+    max_profiles: int = 20
+
+
+@dataclass
+class RoleSchedule:
+    # CPUs the role's threads may run on (all if empty), and optionally a nice value or a SCHED_FIFO priority
+    cpus: List[int] = field(default_factory=list)
+    nice: Optional[int] = None
+    realtime_priority: int = 0
+
+
+@dataclass
+class SchedulingConfig:
+    # Roles are "capture", "vision", "stream" and "nt"
+    roles: Dict[str, RoleSchedule] = field(default_factory=dict)
+    # Size of OpenCV's thread pool, which is shared by the whole process. Left at OpenCV's default if negative.
+    opencv_threads: int = -1
+    report_interval_s: float = 1.0
+
+
+@dataclass
+class FusionConfig:
+    device_id: str = "fusion"
+    # Robot to camera transform of each Orion device, by device ID
+    cameras: Dict[str, Transform3d] = field(default_factory=dict)
+    max_time_skew_ms: float = 5.0
+    max_wait_ms: float = 30.0
+
+
 @dataclass
 class Calibration:
     intrinsics_matrix: Optional[npt.NDArray[np.float64]] = None
@@ -29,6 +71,43 @@ class CameraConfig:
     exposure: int = 25
     brightness: int = 0
     gain: int = 20
+    capture_pipelines: List[str] = field(default_factory=lambda: ["mjpeg_jpegdec"])
+    capture_templates: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class DetectorConfig:
+    backend: str = "aruco"
+    adaptive_thresh_win_size_min: int = 3
+    adaptive_thresh_win_size_max: int = 23
+    adaptive_thresh_win_size_step: int = 10
+    adaptive_thresh_constant: float = 7.0
+    min_marker_perimeter_rate: float = 0.03
+    max_marker_perimeter_rate: float = 4.0
+    polygonal_approx_accuracy_rate: float = 0.03
+    corner_refinement_method: str = "none"
+    corner_refinement_win_size: int = 5
+    corner_refinement_max_iterations: int = 30
+    corner_refinement_min_accuracy: float = 0.1
+    use_aruco3_detection: bool = False
+    min_marker_length_ratio_original_img: float = 0.0
+    apriltag_num_threads: int = 1
+    apriltag_quad_decimate: float = 2.0
+    apriltag_quad_sigma: float = 0.0
+    apriltag_refine_edges: bool = True
+    apriltag_decode_sharpening: float = 0.25
+    apriltag_min_decision_margin: float = 35.0
+    apriltag_max_hamming: int = 0
+    # With a tag layout, the ArUco backend only decodes the layout's IDs, so tags that aren't in it are rejected during
+    # decoding instead of after
+    restrict_to_layout: bool = True
+    # Detection on overlapping tiles in a thread pool, for TiledFiducialDetector. The pipeline doesn't tile yet, these
+    # are only used by bench-detectors. The overlap is a fraction of the frame size and should be larger than the
+    # biggest tag expected at a tile boundary.
+    tile_rows: int = 1
+    tile_cols: int = 1
+    tile_overlap: float = 0.2
+    tile_threads: int = 0
 
 
 @dataclass
@@ -36,3 +115,6 @@ class FiducialConfig:
     tag_family: int = cv2.aruco.DICT_APRILTAG_36h11
     tag_size_m: float = 0.1651
     tag_layout: Optional[Dict[int, Pose3d]] = None
+    # Families detected alongside tag_family by the ArUco backend. IDs of the nth extra family are reported offset by
+    # n * MULTI_FAMILY_ID_OFFSET.
+    extra_tag_families: List[int] = field(default_factory=list)
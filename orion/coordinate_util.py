@@ -1,6 +1,8 @@
+from typing import List
+
 import numpy as np
 import numpy.typing as npt
-from wpimath.geometry import Rotation3d, Translation3d
+from wpimath.geometry import Rotation3d, Transform3d, Translation3d
 
 
 def to_opencv_translation(translation: Translation3d) -> npt.NDArray[np.float64]:
@@ -13,3 +15,54 @@ def from_opencv_translation(tvec: npt.NDArray[np.float64]) -> Translation3d:
 
 def from_opencv_rotation(rvec: npt.NDArray[np.float64]) -> Rotation3d:
     return Rotation3d(np.array([rvec[2], -rvec[0], -rvec[1]]), np.linalg.norm(rvec))
+
+
+def tag_corner_offsets(tag_size: float) -> List[Transform3d]:
+    # Transforms from a tag's pose to its corners, in the detector's corner order
+    half_size = tag_size / 2.0
+    return [Transform3d(0, half_size, -half_size, Rotation3d()),
+            Transform3d(0, -half_size, -half_size, Rotation3d()),
+            Transform3d(0, -half_size, half_size, Rotation3d()),
+            Transform3d(0, half_size, half_size, Rotation3d())]
+
+
+# Maps OpenCV camera coordinates (x right, y down, z forward) to WPILib coordinates (x forward, y left, z up)
+OPENCV_TO_WPILIB = np.array([[0.0, 0.0, 1.0], [-1.0, 0.0, 0.0], [0.0, -1.0, 0.0]])
+
+
+def from_opencv_translations(tvecs: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    return tvecs @ OPENCV_TO_WPILIB.T
+
+
+def from_opencv_rotation_matrices(rotation_mats: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    return OPENCV_TO_WPILIB @ rotation_mats @ OPENCV_TO_WPILIB.T
+
+
+def rotation_matrices_to_quaternions(rotation_mats: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # Returns (w, x, y, z) quaternions, taking the sign of each vector component from the antisymmetric part
+    m = rotation_mats
+    m00 = m[..., 0, 0]
+    m11 = m[..., 1, 1]
+    m22 = m[..., 2, 2]
+    quaternions = np.empty(m.shape[:-2] + (4,))
+    quaternions[..., 0] = np.sqrt(np.maximum(1 + m00 + m11 + m22, 0))
+    quaternions[..., 1] = np.copysign(np.sqrt(np.maximum(1 + m00 - m11 - m22, 0)), m[..., 2, 1] - m[..., 1, 2])
+    quaternions[..., 2] = np.copysign(np.sqrt(np.maximum(1 - m00 + m11 - m22, 0)), m[..., 0, 2] - m[..., 2, 0])
+    quaternions[..., 3] = np.copysign(np.sqrt(np.maximum(1 - m00 - m11 + m22, 0)), m[..., 1, 0] - m[..., 0, 1])
+    quaternions /= np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    return quaternions
+
+
+def quaternion_to_rotation_matrix(w: float, x: float, y: float, z: float) -> npt.NDArray[np.float64]:
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                     [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+                     [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]])
+
+
+def to_pose_vectors(rotation_mats: npt.NDArray[np.float64],
+                    translations: npt.NDArray[np.float64],
+                    out: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # Writes (x, y, z, qw, qx, qy, qz) pose vectors into out, which has shape (..., 7)
+    out[..., :3] = translations
+    out[..., 3:] = rotation_matrices_to_quaternions(rotation_mats)
+    return out
@@ -0,0 +1,209 @@
+import collections
+import logging
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+import ntcore
+import numpy as np
+import numpy.typing as npt
+from wpimath.geometry import Pose3d, Rotation3d, Transform3d, Translation3d
+
+from ..config import Config
+from ..coordinate_util import quaternion_to_rotation_matrix, tag_corner_offsets
+from ..nt_time_util import nt_now_us
+from ..output.NTOutputPublisher import OBSERVATION_STRIDE, PUBLISH_PERIOD_S
+from .multi_camera_pnp import CameraObservation, solve_multi_camera_pnp
+
+logger = logging.getLogger(__name__)
+
+# Devices that haven't published for this long aren't waited for when grouping observations
+INACTIVE_TIMEOUT_S = 1.0
+MAX_QUEUED_OBSERVATIONS = 32
+
+
+class _TagObservations:
+    __slots__ = ("timestamp_ns", "received_s", "tags")
+
+    def __init__(self, timestamp_ns: float, received_s: float, tags: npt.NDArray[np.float64]):
+        self.timestamp_ns = timestamp_ns
+        self.received_s = received_s
+        # (N, 9) rows of tag ID and corners
+        self.tags = tags
+
+
+class _CameraDevice:
+    device_id: str
+    robot_to_camera_rotation: npt.NDArray[np.float64]
+    robot_to_camera_translation: npt.NDArray[np.float64]
+
+    observations_sub: ntcore.DoubleArraySubscriber
+    intrinsics_sub: ntcore.DoubleArraySubscriber
+    intrinsics_matrix: Optional[npt.NDArray[np.float64]] = None
+    distortion_coeffs: Optional[npt.NDArray[np.float64]] = None
+
+    queue: Deque[_TagObservations]
+    last_timestamp_ns: float = -np.inf
+    last_received_s: float = -np.inf
+
+    def __init__(self, device_id: str, robot_to_camera: Transform3d, nt_instance: ntcore.NetworkTableInstance):
+        self.device_id = device_id
+        quaternion = robot_to_camera.rotation().getQuaternion()
+        self.robot_to_camera_rotation = quaternion_to_rotation_matrix(quaternion.W(),
+                                                                      quaternion.X(),
+                                                                      quaternion.Y(),
+                                                                      quaternion.Z())
+        self.robot_to_camera_translation = np.array([robot_to_camera.x, robot_to_camera.y, robot_to_camera.z])
+        table = nt_instance.getTable(f"orion/{device_id}/output")
+        self.observations_sub = table.getDoubleArrayTopic("tag_observations").subscribe(
+            [], ntcore.PubSubOptions(periodic=PUBLISH_PERIOD_S, sendAll=True, keepDuplicates=True))
+        self.intrinsics_sub = table.getDoubleArrayTopic("camera_intrinsics").subscribe([])
+        self.queue = collections.deque(maxlen=MAX_QUEUED_OBSERVATIONS)
+
+    def read(self, now_s: float):
+        for intrinsics in self.intrinsics_sub.readQueue():
+            if len(intrinsics.value) > 9:
+                self.intrinsics_matrix = np.array(intrinsics.value[:9]).reshape(3, 3)
+                self.distortion_coeffs = np.array(intrinsics.value[9:]).reshape(1, -1)
+        for observations in self.observations_sub.readQueue():
+            values = np.asarray(observations.value)
+            if len(values) == 0 or (len(values) - 1) % OBSERVATION_STRIDE != 0:
+                continue
+            timestamp_ns = values[0]
+            if timestamp_ns <= self.last_timestamp_ns:
+                continue
+            self.queue.append(_TagObservations(timestamp_ns, now_s, values[1:].reshape(-1, OBSERVATION_STRIDE)))
+            self.last_timestamp_ns = timestamp_ns
+            self.last_received_s = now_s
+
+
+class FusionNode:
+    # Fuses tag observations from several Orion devices with known robot to camera transforms into one robot pose.
+    # Observations are grouped into timesteps by capture timestamp and solved with a joint multi-camera PnP.
+    _config: Config
+    _nt_instance: ntcore.NetworkTableInstance
+
+    _devices: List[_CameraDevice]
+    _last_fused_timestamp_ns: float = -np.inf
+
+    # Corners of each tag in the layout in WPILib field coordinates, rebuilt when the layout or tag size changes
+    _layout_cache: Dict[int, npt.NDArray[np.float64]]
+    _cached_layout: Optional[Dict[int, Pose3d]] = None
+    _cached_tag_size: float = 0.0
+
+    _nt_initialized: bool = False
+    _heartbeat: int = 0
+    _timestamp_pub: ntcore.DoublePublisher
+    _latency_pub: ntcore.DoublePublisher
+    _heartbeat_pub: ntcore.IntegerPublisher
+    _has_pose_estimate_pub: ntcore.BooleanPublisher
+    _robot_pose_pub: ntcore.StructPublisher
+    _reprojection_error_pub: ntcore.DoublePublisher
+    _tag_ids_pub: ntcore.IntegerArrayPublisher
+    _num_cameras_pub: ntcore.IntegerPublisher
+
+    def __init__(self, config: Config, nt_instance: Optional[ntcore.NetworkTableInstance] = None):
+        self._config = config
+        self._nt_instance = nt_instance if nt_instance is not None else ntcore.NetworkTableInstance.getDefault()
+        self._devices = [_CameraDevice(device_id, robot_to_camera, self._nt_instance)
+                         for device_id, robot_to_camera in config.fusion.cameras.items()]
+        self._layout_cache = {}
+
+    def update(self) -> int:
+        # Reads new observations and fuses every timestep that is complete, returning the number of poses published
+        if not self._nt_initialized:
+            self._init_nt()
+        now_s = time.monotonic()
+        for device in self._devices:
+            device.read(now_s)
+
+        fused = 0
+        while (group := self._next_group(now_s)) is not None:
+            self._fuse(group)
+            fused += 1
+        return fused
+
+    def _next_group(self, now_s: float) -> Optional[List[Tuple[_CameraDevice, _TagObservations]]]:
+        # The oldest queued observation and the observations of other devices within max_time_skew_ms of it form a
+        # timestep. It's complete once every active device has either contributed or moved past it, or after
+        # max_wait_ms.
+        heads = [device for device in self._devices if len(device.queue) > 0]
+        if len(heads) == 0:
+            return None
+        start_ns = min(device.queue[0].timestamp_ns for device in heads)
+        end_ns = start_ns + self._config.fusion.max_time_skew_ms * 1e6
+        group = [(device, device.queue[0]) for device in heads if device.queue[0].timestamp_ns <= end_ns]
+        grouped = {id(device) for device, _ in group}
+        complete = all(id(device) in grouped
+                       or device.last_timestamp_ns > end_ns
+                       or now_s - device.last_received_s > INACTIVE_TIMEOUT_S
+                       for device in self._devices)
+        first_received_s = min(observations.received_s for _, observations in group)
+        if not complete and (now_s - first_received_s) * 1000 < self._config.fusion.max_wait_ms:
+            return None
+        for device, _ in group:
+            device.queue.popleft()
+        return group
+
+    def _fuse(self, group: List[Tuple[_CameraDevice, _TagObservations]]):
+        timestamp_ns = float(np.mean([observations.timestamp_ns for _, observations in group]))
+        if timestamp_ns <= self._last_fused_timestamp_ns:
+            return
+        self._last_fused_timestamp_ns = timestamp_ns
+
+        layout = self._get_layout_cache()
+        camera_observations = []
+        tag_ids = set()
+        for device, observations in group:
+            if device.intrinsics_matrix is None:
+                continue
+            rows = [row for row in observations.tags if int(row[0]) in layout]
+            if len(rows) == 0:
+                continue
+            tag_ids.update(int(row[0]) for row in rows)
+            camera_observations.append(CameraObservation(np.concatenate([layout[int(row[0])] for row in rows]),
+                                                         np.array([row[1:] for row in rows]).reshape(-1, 2),
+                                                         device.intrinsics_matrix,
+                                                         device.distortion_coeffs,
+                                                         device.robot_to_camera_rotation,
+                                                         device.robot_to_camera_translation))
+
+        result = solve_multi_camera_pnp(camera_observations) if len(camera_observations) > 0 else None
+        self._heartbeat += 1
+        self._heartbeat_pub.set(self._heartbeat)
+        self._timestamp_pub.set(timestamp_ns)
+        server_time_offset_us = self._nt_instance.getServerTimeOffset() or 0
+        self._latency_pub.set(((nt_now_us() + server_time_offset_us) * 1000 - timestamp_ns) / 1e6)
+        self._tag_ids_pub.set(sorted(tag_ids))
+        self._num_cameras_pub.set(len(camera_observations))
+        self._has_pose_estimate_pub.set(result is not None)
+        if result is not None:
+            self._robot_pose_pub.set(Pose3d(Translation3d(*result.translation.tolist()), Rotation3d(result.rotation)))
+            self._reprojection_error_pub.set(result.reprojection_error)
+
+    def _get_layout_cache(self) -> Dict[int, npt.NDArray[np.float64]]:
+        if not self._config.has_tag_layout():
+            return {}
+        if (self._cached_layout is not self._config.fiducial.tag_layout
+                or self._cached_tag_size != self._config.fiducial.tag_size_m):
+            offsets = tag_corner_offsets(self._config.fiducial.tag_size_m)
+            self._layout_cache = {}
+            for tag_id, tag_pose in self._config.fiducial.tag_layout.items():
+                corners = [tag_pose.transformBy(offset) for offset in offsets]
+                self._layout_cache[tag_id] = np.array([[corner.x, corner.y, corner.z] for corner in corners])
+            self._cached_layout = self._config.fiducial.tag_layout
+            self._cached_tag_size = self._config.fiducial.tag_size_m
+        return self._layout_cache
+
+    def _init_nt(self):
+        logger.info(f"Initializing fusion of {', '.join(device.device_id for device in self._devices)}")
+        table = self._nt_instance.getTable(f"orion/{self._config.fusion.device_id}/output")
+        pubsub_options = ntcore.PubSubOptions(periodic=PUBLISH_PERIOD_S, sendAll=True, keepDuplicates=True)
+        self._timestamp_pub = table.getDoubleTopic("timestamp_ns").publish(pubsub_options)
+        self._latency_pub = table.getDoubleTopic("latency_ms").publish(pubsub_options)
+        self._heartbeat_pub = table.getIntegerTopic("heartbeat").publish(pubsub_options)
+        self._has_pose_estimate_pub = table.getBooleanTopic("has_pose_estimate").publish(pubsub_options)
+        self._robot_pose_pub = table.getStructTopic("robot_pose", Pose3d).publish(pubsub_options)
+        self._reprojection_error_pub = table.getDoubleTopic("reprojection_error").publish(pubsub_options)
+        self._tag_ids_pub = table.getIntegerArrayTopic("tag_ids").publish(pubsub_options)
+        self._num_cameras_pub = table.getIntegerTopic("num_cameras").publish(pubsub_options)
+        self._nt_initialized = True
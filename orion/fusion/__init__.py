@@ -0,0 +1,10 @@
+__all__ = [
+    "FusionNode",
+    "CameraObservation",
+    "MultiCameraPnPResult",
+    "jacobian_error",
+    "solve_multi_camera_pnp"
+]
+
+from .FusionNode import FusionNode
+from .multi_camera_pnp import CameraObservation, MultiCameraPnPResult, jacobian_error, solve_multi_camera_pnp
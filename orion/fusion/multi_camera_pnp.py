@@ -0,0 +1,163 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from ..coordinate_util import OPENCV_TO_WPILIB
+
+MAX_ITERATIONS = 20
+CONVERGENCE_STEP = 1e-7
+INITIAL_DAMPING = 1e-3
+
+
+@dataclass
+class CameraObservation:
+    # Tag corners seen by one camera. Field points are in WPILib field coordinates, the robot to camera transform is a
+    # rotation matrix and translation in WPILib robot coordinates.
+    field_points: npt.NDArray[np.float64]
+    image_points: npt.NDArray[np.float64]
+    intrinsics_matrix: npt.NDArray[np.float64]
+    distortion_coeffs: npt.NDArray[np.float64]
+    robot_to_camera_rotation: npt.NDArray[np.float64]
+    robot_to_camera_translation: npt.NDArray[np.float64]
+
+
+@dataclass
+class MultiCameraPnPResult:
+    # Robot pose in the field as a rotation matrix and translation, and the RMS reprojection error in pixels
+    rotation: npt.NDArray[np.float64]
+    translation: npt.NDArray[np.float64]
+    reprojection_error: float
+    iterations: int
+
+
+def _camera_from_robot(observation: CameraObservation) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+    # Maps robot points into the camera's OpenCV coordinates, x_camera = a @ x_robot + b
+    a = OPENCV_TO_WPILIB.T @ observation.robot_to_camera_rotation.T
+    return a, -a @ observation.robot_to_camera_translation
+
+
+def _initial_guess(observations: Sequence[CameraObservation],
+                   transforms: Sequence[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]]
+                   ) -> Optional[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]]:
+    # Single camera SQPNP on the camera that sees the most corners, as a robot from field transform
+    best = max(range(len(observations)), key=lambda i: len(observations[i].field_points))
+    observation = observations[best]
+    try:
+        ok, rvec, tvec = cv2.solvePnP(observation.field_points,
+                                      observation.image_points,
+                                      observation.intrinsics_matrix,
+                                      observation.distortion_coeffs,
+                                      flags=cv2.SOLVEPNP_SQPNP)
+    except cv2.error:
+        return None
+    if not ok:
+        return None
+    a, b = transforms[best]
+    return a.T @ cv2.Rodrigues(rvec)[0], a.T @ (tvec.reshape(3) - b)
+
+
+def _residuals(observations: Sequence[CameraObservation],
+               transforms: Sequence[Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]],
+               rotation: npt.NDArray[np.float64],
+               translation: npt.NDArray[np.float64],
+               with_jacobian: bool) -> Tuple[npt.NDArray[np.float64], Optional[npt.NDArray[np.float64]]]:
+    # Reprojection residuals of every corner and their Jacobian with respect to a small rotation and translation applied
+    # to the robot from field transform
+    residuals = []
+    jacobians = []
+    for observation, (a, b) in zip(observations, transforms):
+        robot_points = observation.field_points @ rotation.T + translation
+        camera_points = robot_points @ a.T + b
+        projected, projection_jacobian = cv2.projectPoints(camera_points,
+                                                           np.zeros(3),
+                                                           np.zeros(3),
+                                                           observation.intrinsics_matrix,
+                                                           observation.distortion_coeffs)
+        residuals.append((projected.reshape(-1, 2) - observation.image_points).reshape(-1))
+        if with_jacobian:
+            # With a zero pose, the derivative by tvec is the derivative by the camera point
+            point_jacobian = projection_jacobian[:, 3:6].reshape(-1, 2, 3) @ a
+            skew = np.zeros((len(robot_points), 3, 6))
+            skew[:, 0, 1] = robot_points[:, 2]
+            skew[:, 0, 2] = -robot_points[:, 1]
+            skew[:, 1, 0] = -robot_points[:, 2]
+            skew[:, 1, 2] = robot_points[:, 0]
+            skew[:, 2, 0] = robot_points[:, 1]
+            skew[:, 2, 1] = -robot_points[:, 0]
+            skew[:, :, 3:] = np.eye(3)
+            jacobians.append((point_jacobian @ skew).reshape(-1, 6))
+    return np.concatenate(residuals), np.concatenate(jacobians) if with_jacobian else None
+
+
+def jacobian_error(observations: Sequence[CameraObservation],
+                   rotation: npt.NDArray[np.float64],
+                   translation: npt.NDArray[np.float64],
+                   step: float = 1e-6) -> float:
+    # Largest difference between the analytic Jacobian of the residuals and central differences at a robot from field
+    # transform, relative to the largest derivative
+    observations = [observation for observation in observations if len(observation.field_points) > 0]
+    transforms = [_camera_from_robot(observation) for observation in observations]
+    _, jacobian = _residuals(observations, transforms, rotation, translation, True)
+    numeric = np.zeros_like(jacobian)
+    for i in range(6):
+        delta = np.zeros(6)
+        delta[i] = step
+        perturbed = []
+        for sign in (1.0, -1.0):
+            step_rotation = cv2.Rodrigues(sign * delta[:3])[0]
+            perturbed.append(_residuals(observations,
+                                        transforms,
+                                        step_rotation @ rotation,
+                                        step_rotation @ translation + sign * delta[3:],
+                                        False)[0])
+        numeric[:, i] = (perturbed[0] - perturbed[1]) / (2 * step)
+    return float(np.max(np.abs(jacobian - numeric)) / max(np.max(np.abs(numeric)), 1e-12))
+
+
+def solve_multi_camera_pnp(observations: Sequence[CameraObservation]) -> Optional[MultiCameraPnPResult]:
+    # Finds the robot pose that minimizes the reprojection error of every corner in every camera, with
+    # Levenberg-Marquardt starting from the single camera solution
+    observations = [observation for observation in observations if len(observation.field_points) > 0]
+    if sum(len(observation.field_points) for observation in observations) < 4:
+        return None
+    transforms = [_camera_from_robot(observation) for observation in observations]
+    initial = _initial_guess(observations, transforms)
+    if initial is None:
+        return None
+    rotation, translation = initial
+
+    residuals, jacobian = _residuals(observations, transforms, rotation, translation, True)
+    cost = residuals @ residuals
+    damping = INITIAL_DAMPING
+    iterations = 0
+    for iterations in range(1, MAX_ITERATIONS + 1):
+        hessian = jacobian.T @ jacobian
+        gradient = jacobian.T @ residuals
+        try:
+            step = np.linalg.solve(hessian + damping * np.diag(np.diag(hessian)), -gradient)
+        except np.linalg.LinAlgError:
+            break
+        step_rotation = cv2.Rodrigues(step[:3])[0]
+        new_rotation = step_rotation @ rotation
+        new_translation = step_rotation @ translation + step[3:]
+        new_residuals, _ = _residuals(observations, transforms, new_rotation, new_translation, False)
+        new_cost = new_residuals @ new_residuals
+        if new_cost < cost:
+            rotation, translation, cost = new_rotation, new_translation, new_cost
+            damping = max(damping / 10, 1e-9)
+            if np.max(np.abs(step)) < CONVERGENCE_STEP:
+                break
+            residuals, jacobian = _residuals(observations, transforms, rotation, translation, True)
+        else:
+            damping *= 10
+            if damping > 1e6:
+                break
+
+    # Invert the robot from field transform for the robot pose
+    return MultiCameraPnPResult(rotation.T,
+                                -rotation.T @ translation,
+                                float(np.sqrt(cost / (len(residuals) / 2))),
+                                iterations)
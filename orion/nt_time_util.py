@@ -0,0 +1,45 @@
+import time
+from typing import Optional
+
+import ntcore
+
+CALIBRATION_SAMPLES = 8
+
+_nt_time_offset_ns: Optional[int] = None
+
+
+def _calibrate_nt_time_offset_ns() -> int:
+    # ntcore doesn't expose the NT time base (wpi::Now()) publicly, but it stamps values set without a timestamp with
+    # it. Set values on a local instance and compare their timestamps to the monotonic clock read around each set,
+    # keeping the tightest sample. Both clocks are monotonic, so the offset between them doesn't change.
+    instance = ntcore.NetworkTableInstance.create()
+    try:
+        topic = instance.getIntegerTopic("/clock")
+        publisher = topic.publish()
+        subscriber = topic.subscribe(0)
+        best_offset_ns = 0
+        best_width_ns = None
+        for i in range(CALIBRATION_SAMPLES):
+            before_ns = time.monotonic_ns()
+            publisher.set(i)
+            after_ns = time.monotonic_ns()
+            width_ns = after_ns - before_ns
+            if best_width_ns is None or width_ns < best_width_ns:
+                best_width_ns = width_ns
+                best_offset_ns = subscriber.getAtomic().time * 1000 - (before_ns + after_ns) // 2
+        return best_offset_ns
+    finally:
+        ntcore.NetworkTableInstance.destroy(instance)
+
+
+def nt_time_offset_ns() -> int:
+    # Offset from time.monotonic_ns() to the local NT time base, in nanoseconds
+    global _nt_time_offset_ns
+    if _nt_time_offset_ns is None:
+        _nt_time_offset_ns = _calibrate_nt_time_offset_ns()
+    return _nt_time_offset_ns
+
+
+def nt_now_us() -> int:
+    # Current time in the local NT time base, the time base of value and connection timestamps, in microseconds
+    return (time.monotonic_ns() + nt_time_offset_ns()) // 1000
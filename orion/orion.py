@@ -5,32 +5,43 @@ import ntcore
 
 from .calibration import CalibrationController, CalibrationPipeline
 from .config import Config
-from .output import NTOutputPublisher, StreamServer
-from .pipeline import DefaultCapture, GStreamerCapture, Pipeline
+from .fusion import FusionNode
+from .output import FrameProfiler, FrameRecorder, NTOutputPublisher, StreamServer
+from .pipeline import Pipeline, create_gstreamer_capture
+from .scheduling import ThreadScheduler
 
 logger = logging.getLogger(__name__)
 
 NETWORK_CONFIG_FILE = 'device-config/network-config.json'
 CALIBRATION_FILE = 'device-config/calibration.json'
+DETECTOR_CONFIG_FILE = 'device-config/detector-config.json'
+
+FUSION_POLL_INTERVAL_S = 0.002
 
 
 def run_pipeline():
     logging.basicConfig(level=logging.DEBUG)
 
-    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE)
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
     config.refresh_local()
+    scheduler = ThreadScheduler(config)
 
     logger.info(
         f"Starting NT client for device {config.network.device_id}, server is set to {config.network.server_ip}")
-    ntcore.NetworkTableInstance.getDefault().startClient4(config.network.device_id)
-    ntcore.NetworkTableInstance.getDefault().setServer(config.network.server_ip)
+    with scheduler.spawning("nt"):
+        ntcore.NetworkTableInstance.getDefault().startClient4(config.network.device_id)
+        ntcore.NetworkTableInstance.getDefault().setServer(config.network.server_ip)
+    # The pipeline runs on the main thread, and OpenCV's worker threads are created from it
+    scheduler.apply("vision")
 
     config.refresh_nt()
 
-    capture = GStreamerCapture(config)
+    capture = create_gstreamer_capture(config, scheduler)
     pipeline = Pipeline(config)
     output = NTOutputPublisher(config)
-    stream = StreamServer(config)
+    profiler = FrameProfiler(config)
+    stream = StreamServer(config, profiler, scheduler)
+    recorder = FrameRecorder(config, scheduler)
 
     calib_control = CalibrationController(config)
     calib_pipeline = CalibrationPipeline(calib_control)
@@ -43,11 +54,15 @@ def run_pipeline():
 
     logger.info("Starting pipeline...")
     stream.start()
+    recorder.start()
     while True:
+        profiler.start_frame()
         config.refresh_nt()
+        scheduler.report()
 
         ret, frame = capture.get_frame()
         if not ret:
+            profiler.end_frame()
             time.sleep(0.2)
             continue
 
@@ -59,6 +74,9 @@ def run_pipeline():
             last_fps_time = current_time
             frame_count = 0
 
+        # The pipeline draws detections onto the frame, so the raw frame is copied for recording first
+        raw_frame = recorder.copy_frame(frame)
+
         result = None
         if calib_control.is_calibrating():
             if not was_calibrating:
@@ -74,4 +92,31 @@ def run_pipeline():
             result = pipeline.process_frame(frame)
 
         output.publish(result, fps, heartbeat)
+        recorder.record(raw_frame, result)
         stream.set_frame(frame)
+        frame.release()
+        profiler.end_frame()
+
+
+def run_fusion():
+    logging.basicConfig(level=logging.DEBUG)
+
+    config = Config(NETWORK_CONFIG_FILE, CALIBRATION_FILE, DETECTOR_CONFIG_FILE)
+    config.refresh_local()
+    if len(config.fusion.cameras) == 0:
+        logger.error("No cameras configured for fusion, add them to the fusion object of the network config")
+        return
+    # The fusion node reads its tag layout and tag size from its own config table
+    config.network.device_id = config.fusion.device_id
+
+    logger.info(f"Starting NT client for fusion node {config.fusion.device_id}, server is set to "
+                f"{config.network.server_ip}")
+    ntcore.NetworkTableInstance.getDefault().startClient4(config.fusion.device_id)
+    ntcore.NetworkTableInstance.getDefault().setServer(config.network.server_ip)
+
+    fusion = FusionNode(config)
+    logger.info("Starting fusion...")
+    while True:
+        config.refresh_nt()
+        fusion.update()
+        time.sleep(FUSION_POLL_INTERVAL_S)
@@ -0,0 +1,119 @@
+import cProfile
+import datetime
+import glob
+import io
+import logging
+import os
+import pstats
+import threading
+from typing import List, Optional
+
+import ntcore
+
+from ..config import Config
+
+logger = logging.getLogger(__name__)
+
+PROFILE_EXTENSIONS = (".prof", ".txt")
+SUMMARY_LINES = 60
+
+
+class FrameProfiler:
+    # Profiles the next N iterations of the pipeline loop with cProfile when armed over NT or HTTP. Unarmed, each
+    # frame only costs an attribute check and reading an NT entry.
+    _config: Config
+
+    _arm_lock: threading.Lock
+    _armed_frames: int = 0
+    _profile: Optional[cProfile.Profile] = None
+    _frames_remaining: int = 0
+
+    _nt_initialized: bool = False
+    _armed_entry: ntcore.BooleanEntry
+    _num_frames_entry: ntcore.IntegerEntry
+    _last_profile_pub: ntcore.StringPublisher
+
+    def __init__(self, config: Config):
+        self._config = config
+        self._arm_lock = threading.Lock()
+
+    def arm(self, num_frames: Optional[int] = None) -> None:
+        # Thread safe, takes effect at the start of the next frame
+        with self._arm_lock:
+            self._armed_frames = num_frames if num_frames is not None else self._config.profiler.num_frames
+
+    def is_profiling(self) -> bool:
+        return self._profile is not None
+
+    def start_frame(self) -> None:
+        if self._profile is not None:
+            return
+        if not self._nt_initialized:
+            self._init_nt()
+
+        if self._armed_entry.get():
+            self._armed_entry.set(False)
+            self.arm(self._num_frames_entry.get())
+        if self._armed_frames > 0:
+            with self._arm_lock:
+                self._frames_remaining = self._armed_frames
+                self._armed_frames = 0
+            logger.info(f"Profiling the next {self._frames_remaining} frames")
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def end_frame(self) -> None:
+        if self._profile is None:
+            return
+        self._frames_remaining -= 1
+        if self._frames_remaining <= 0:
+            self._profile.disable()
+            # Writing the stats takes a while, don't hold up the next frame
+            threading.Thread(target=self._write_profile, args=(self._profile,), daemon=True).start()
+            self._profile = None
+
+    def list_profiles(self) -> List[str]:
+        if not os.path.isdir(self._config.profiler.directory):
+            return []
+        return sorted((os.path.basename(path) for path in glob.glob(os.path.join(self._config.profiler.directory, "*"))
+                       if path.endswith(PROFILE_EXTENSIONS)), reverse=True)
+
+    def profile_path(self, name: str) -> Optional[str]:
+        # Only serve files that are in the profile directory listing
+        if name not in self.list_profiles():
+            return None
+        return os.path.join(self._config.profiler.directory, name)
+
+    def _write_profile(self, profile: cProfile.Profile):
+        try:
+            os.makedirs(self._config.profiler.directory, exist_ok=True)
+            name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            path = os.path.join(self._config.profiler.directory, name)
+            profile.dump_stats(f"{path}.prof")
+
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_LINES)
+            with open(f"{path}.txt", "w") as summary_file:
+                summary_file.write(summary.getvalue())
+            logger.info(f"Wrote profile to {path}.prof")
+            self._last_profile_pub.set(f"{name}.prof")
+            self._delete_old_profiles()
+        except OSError as e:
+            logger.error(f"Failed to write profile: {e}")
+
+    def _delete_old_profiles(self):
+        profiles = sorted(glob.glob(os.path.join(self._config.profiler.directory, "*.prof")))
+        for profile in profiles[:max(len(profiles) - self._config.profiler.max_profiles, 0)]:
+            for extension in PROFILE_EXTENSIONS:
+                path = os.path.splitext(profile)[0] + extension
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _init_nt(self):
+        table = ntcore.NetworkTableInstance.getDefault().getTable(f"orion/{self._config.network.device_id}/profiler")
+        self._armed_entry = table.getBooleanTopic("armed").getEntry(False)
+        self._armed_entry.set(False)
+        self._num_frames_entry = table.getIntegerTopic("num_frames").getEntry(self._config.profiler.num_frames)
+        self._num_frames_entry.setDefault(self._config.profiler.num_frames)
+        self._last_profile_pub = table.getStringTopic("last_profile").publish()
+        self._nt_initialized = True
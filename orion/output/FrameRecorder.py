@@ -0,0 +1,197 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+import cv2
+import ntcore
+import numpy as np
+import numpy.typing as npt
+
+from ..config import Config
+from ..pipeline import CaptureFrame, PipelineResult
+from ..scheduling import ThreadScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def _pose_to_json(pose: npt.NDArray[np.float64]) -> Dict[str, Any]:
+    return {"translation": pose[:3].tolist(), "rotation": pose[3:].tolist()}
+
+
+def result_to_json(result: Optional[PipelineResult]) -> Optional[Dict[str, Any]]:
+    if result is None:
+        return None
+    pose_estimate = None
+    if result.has_pose_estimate:
+        pose_estimate = {"pose": _pose_to_json(result.camera_pose[0]),
+                         "reproj_error": float(result.camera_pose_errors[0]),
+                         "pose_alt": _pose_to_json(result.camera_pose[1]),
+                         "reproj_error_alt": float(result.camera_pose_errors[1])}
+    return {"process_dt_ns": result.process_dt_ns,
+            "seen_tag_ids": result.seen_tag_ids.tolist(),
+            "tracked_targets": [{"id": int(result.target_ids[i]),
+                                 "camera_to_target": _pose_to_json(result.target_poses[i, 0]),
+                                 "reproj_error": float(result.target_errors[i, 0]),
+                                 "camera_to_target_alt": _pose_to_json(result.target_poses[i, 1]),
+                                 "reproj_error_alt": float(result.target_errors[i, 1])}
+                                for i in range(result.num_targets)],
+            "pose_estimate": pose_estimate}
+
+
+class FrameRecorder:
+    _config: Config
+    _scheduler: Optional[ThreadScheduler]
+
+    # Frames are copied into a fixed set of slots, and a frame is dropped when no slot is free, so a slow disk can
+    # never hold up the vision loop or grow memory usage
+    _slots: List[Optional[np.ndarray]]
+    _slot_results: List[PipelineResult]
+    _free_slots: queue.Queue
+    _work_queue: queue.Queue
+    _pending_slot: Optional[int] = None
+
+    _is_recording: bool = False
+    _frames_recorded: int = 0
+    _frames_dropped: int = 0
+
+    _writer: Optional[cv2.VideoWriter] = None
+    _metadata_file: Any = None
+    _segment_frame_count: int = 0
+    _segment_shape: Optional[tuple] = None
+
+    _nt_initialized: bool = False
+    _is_recording_entry: ntcore.BooleanEntry
+    _frames_recorded_pub: ntcore.IntegerPublisher
+    _frames_dropped_pub: ntcore.IntegerPublisher
+
+    def __init__(self, config: Config, scheduler: Optional[ThreadScheduler] = None):
+        self._config = config
+        self._scheduler = scheduler
+        self._slots = [None] * config.recording.queue_size
+        self._slot_results = [PipelineResult() for _ in range(config.recording.queue_size)]
+        self._free_slots = queue.Queue()
+        for slot in range(config.recording.queue_size):
+            self._free_slots.put(slot)
+        self._work_queue = queue.Queue()
+
+    def start(self) -> None:
+        logger.info("Starting frame recorder")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def copy_frame(self, frame: CaptureFrame) -> Optional[CaptureFrame]:
+        # Called before the pipeline annotates the frame, returns a copy of the raw frame to pass to record
+        if not self._nt_initialized:
+            self._init_nt()
+
+        is_recording = self._is_recording_entry.get()
+        if is_recording != self._is_recording:
+            logger.info("Starting recording" if is_recording else "Stopping recording")
+            self._is_recording = is_recording
+            if not is_recording:
+                self._work_queue.put(None)
+        if not is_recording or frame.image is None:
+            return None
+
+        try:
+            slot = self._free_slots.get_nowait()
+        except queue.Empty:
+            self._frames_dropped += 1
+            self._frames_dropped_pub.set(self._frames_dropped)
+            return None
+        if self._slots[slot] is None or self._slots[slot].shape != frame.image.shape:
+            self._slots[slot] = np.empty_like(frame.image)
+        np.copyto(self._slots[slot], frame.image)
+        self._pending_slot = slot
+        return CaptureFrame(self._slots[slot], frame.timestamp_ns, frame.resolution_height, frame.resolution_width)
+
+    def record(self, frame: Optional[CaptureFrame], result: Optional[PipelineResult]) -> None:
+        if frame is None or self._pending_slot is None:
+            return
+        # The pipeline reuses its result for the next frame, so keep a copy for the writer thread
+        has_result = result is not None
+        if has_result:
+            self._slot_results[self._pending_slot].copy_from(result)
+        self._work_queue.put((self._pending_slot, frame.timestamp_ns, has_result))
+        self._pending_slot = None
+        self._frames_recorded += 1
+        self._frames_recorded_pub.set(self._frames_recorded)
+
+    def _run(self):
+        if self._scheduler is not None:
+            # Encoding competes with the stream server rather than the pipeline, so they share a role
+            self._scheduler.apply("stream")
+        while True:
+            item = self._work_queue.get()
+            if item is None:
+                self._close_segment()
+                continue
+
+            slot, timestamp_ns, has_result = item
+            image = self._slots[slot]
+            result = self._slot_results[slot] if has_result else None
+            try:
+                if (self._writer is None
+                        or self._segment_frame_count >= self._config.recording.segment_frames
+                        or self._segment_shape != image.shape):
+                    self._open_segment(image)
+                self._writer.write(image)
+                self._metadata_file.write(json.dumps({"timestamp_ns": timestamp_ns,
+                                                      "result": result_to_json(result)}) + "\n")
+                self._segment_frame_count += 1
+            except (OSError, cv2.error) as e:
+                logger.error(f"Failed to write recorded frame: {e}")
+            finally:
+                self._free_slots.put(slot)
+
+    def _open_segment(self, image: np.ndarray):
+        self._close_segment()
+        self._enforce_disk_cap()
+        os.makedirs(self._config.recording.directory, exist_ok=True)
+        segment_name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        segment_path = os.path.join(self._config.recording.directory, segment_name)
+        self._writer = cv2.VideoWriter(f"{segment_path}.avi",
+                                       cv2.VideoWriter.fourcc('M', 'J', 'P', 'G'),
+                                       self._config.recording.video_fps,
+                                       (image.shape[1], image.shape[0]),
+                                       image.ndim == 3)
+        self._metadata_file = open(f"{segment_path}.jsonl", "w")
+        self._segment_frame_count = 0
+        self._segment_shape = image.shape
+        logger.info(f"Recording to {segment_path}")
+
+    def _close_segment(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+        if self._metadata_file is not None:
+            self._metadata_file.close()
+            self._metadata_file = None
+
+    def _enforce_disk_cap(self):
+        # Delete the oldest segments until the recordings fit within the cap, with room for a new segment
+        segments = sorted(glob.glob(os.path.join(self._config.recording.directory, "*.avi")))
+        sizes = [os.path.getsize(segment) + os.path.getsize(os.path.splitext(segment)[0] + ".jsonl")
+                 if os.path.exists(os.path.splitext(segment)[0] + ".jsonl") else os.path.getsize(segment)
+                 for segment in segments]
+        max_bytes = self._config.recording.max_disk_mb * 1024 * 1024
+        average_size = sum(sizes) / len(sizes) if len(sizes) > 0 else 0
+        while len(segments) > 0 and sum(sizes) + average_size > max_bytes:
+            oldest = os.path.splitext(segments.pop(0))[0]
+            sizes.pop(0)
+            logger.info(f"Recording disk cap reached, deleting {oldest}")
+            for extension in (".avi", ".jsonl"):
+                if os.path.exists(oldest + extension):
+                    os.remove(oldest + extension)
+
+    def _init_nt(self):
+        table = ntcore.NetworkTableInstance.getDefault().getTable(f"orion/{self._config.network.device_id}/recording")
+        self._is_recording_entry = table.getBooleanTopic("is_recording").getEntry(False)
+        self._is_recording_entry.set(False)
+        self._frames_recorded_pub = table.getIntegerTopic("frames_recorded").publish()
+        self._frames_dropped_pub = table.getIntegerTopic("frames_dropped").publish()
+        self._nt_initialized = True
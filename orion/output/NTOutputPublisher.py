@@ -1,31 +1,73 @@
 import logging
+import time
 from typing import Optional
 
 import ntcore
+import numpy as np
+import numpy.typing as npt
+from wpiutil import wpistruct
 
-from ..config import Config
+from ..config import Calibration, Config
+from ..nt_time_util import nt_time_offset_ns
 from ..pipeline import PipelineResult, CameraPoseEstimate, TrackedTarget
 
 logger = logging.getLogger(__name__)
 
+# A periodic of 0 falls back to NT's default 100 ms batching, which added up to 100 ms of latency in bench-nt. 5 ms
+# is the shortest period NT honors.
+PUBLISH_PERIOD_S = 0.005
+
+# Values per tag in tag_observations: the tag ID followed by the x and y of its four corners in pixels
+OBSERVATION_STRIDE = 9
+
+# Byte layouts of the TrackedTarget and CameraPoseEstimate structs, so they are packed straight from the result's arrays
+# into reused buffers instead of building WPILib objects for every target. Poses and transforms are
+# (x, y, z, qw, qx, qy, qz), the same as in PipelineResult.
+TRACKED_TARGET_DTYPE = np.dtype([("id", "<i4"),
+                                 ("camera_to_target", "<f8", 7),
+                                 ("reproj_error", "<f4"),
+                                 ("camera_to_target_alt", "<f8", 7),
+                                 ("reproj_error_alt", "<f4"),
+                                 ("has_alt", "?")])
+CAMERA_POSE_ESTIMATE_DTYPE = np.dtype([("pose", "<f8", 7),
+                                       ("reproj_error", "<f4"),
+                                       ("pose_alt", "<f8", 7),
+                                       ("reproj_error_alt", "<f4"),
+                                       ("has_alt", "?")])
+
 
 class NTOutputPublisher:
     _config: Config
+    _nt_instance: ntcore.NetworkTableInstance
 
     _nt_initialized: bool = False
 
     _timestamp_pub: ntcore.DoublePublisher
+    _latency_pub: ntcore.DoublePublisher
     _fps_pub: ntcore.DoublePublisher
     _heartbeat_pub: ntcore.IntegerPublisher
 
     _tag_ids_pub: ntcore.IntegerArrayPublisher
     _has_pose_estimate_pub: ntcore.BooleanPublisher
     _has_tracked_targets_pub: ntcore.BooleanPublisher
-    _pose_estimate_pub: ntcore.StructPublisher
-    _tracked_targets_pub: ntcore.StructArrayPublisher
-
-    def __init__(self, config: Config):
+    _pose_estimate_pub: ntcore.RawPublisher
+    _tracked_targets_pub: ntcore.RawPublisher
+    _tag_observations_pub: ntcore.DoubleArrayPublisher
+    _camera_intrinsics_pub: ntcore.DoubleArrayPublisher
+    # Intrinsics matrix followed by distortion coefficients, as last published
+    _published_intrinsics: Optional[npt.NDArray[np.float64]] = None
+
+    # Reused between frames, and grown to the result's capacity when it has more tags
+    _pose_estimate: npt.NDArray[np.void]
+    _tracked_targets: npt.NDArray[np.void]
+    _tag_observations: npt.NDArray[np.float64]
+
+    def __init__(self, config: Config, nt_instance: Optional[ntcore.NetworkTableInstance] = None):
         self._config = config
+        self._nt_instance = nt_instance if nt_instance is not None else ntcore.NetworkTableInstance.getDefault()
+        self._pose_estimate = np.zeros(1, dtype=CAMERA_POSE_ESTIMATE_DTYPE)
+        self._tracked_targets = np.zeros(0, dtype=TRACKED_TARGET_DTYPE)
+        self._tag_observations = np.zeros(1)
 
     def publish(self, result: Optional[PipelineResult], fps: float, heartbeat: int):
         if not self._nt_initialized:
@@ -35,37 +77,110 @@ class NTOutputPublisher:
         self._heartbeat_pub.set(heartbeat)
 
         if result is not None:
-            time_offset = ntcore.NetworkTableInstance.getDefault().getServerTimeOffset() or 0
-            corrected_timestamp = (result.capture_timestamp_ns + time_offset * 1000)
+            # Capture timestamps are on the monotonic clock, convert to the local NT time base and then to server time
+            publish_timestamp_ns = time.monotonic_ns()
+            server_time_offset_ns = (self._nt_instance.getServerTimeOffset() or 0) * 1000
+            corrected_timestamp = result.capture_timestamp_ns + nt_time_offset_ns() + server_time_offset_ns
             self._timestamp_pub.set(corrected_timestamp)
+            self._latency_pub.set((publish_timestamp_ns - result.capture_timestamp_ns) / 1e6)
 
             self._tag_ids_pub.set(result.seen_tag_ids)
-            self._has_pose_estimate_pub.set(result.pose_estimate is not None)
-            self._has_tracked_targets_pub.set(len(result.tracked_targets) > 0)
-            if result.pose_estimate is not None:
-                self._pose_estimate_pub.set(result.pose_estimate)
-            if len(result.tracked_targets) > 0:
-                self._tracked_targets_pub.set(result.tracked_targets)
-            else:
-                self._tracked_targets_pub.set([])
+            self._has_pose_estimate_pub.set(result.has_pose_estimate)
+            self._has_tracked_targets_pub.set(result.num_targets > 0)
+            if result.has_pose_estimate:
+                self._pose_estimate_pub.set(self._pack_pose_estimate(result))
+            self._tracked_targets_pub.set(self._pack_tracked_targets(result))
+            self._tag_observations_pub.set(self._pack_tag_observations(result, corrected_timestamp))
         else:
             self._tag_ids_pub.set([])
             self._has_pose_estimate_pub.set(False)
             self._has_tracked_targets_pub.set(False)
-            self._tracked_targets_pub.set([])
+            self._tracked_targets_pub.set(b"")
+
+        calibration = self._config.calibration
+        if calibration is not None and not self._is_published(calibration):
+            self._published_intrinsics = np.concatenate([calibration.intrinsics_matrix.reshape(-1),
+                                                         calibration.distortion_coeffs.reshape(-1)])
+            self._camera_intrinsics_pub.set(self._published_intrinsics.tolist())
+
+    def _is_published(self, calibration: Calibration) -> bool:
+        # Compares contents, since the arrays may be modified in place, or replaced by new arrays with a reused id()
+        published = self._published_intrinsics
+        intrinsics = calibration.intrinsics_matrix.reshape(-1)
+        distortion = calibration.distortion_coeffs.reshape(-1)
+        return (published is not None
+                and len(published) == len(intrinsics) + len(distortion)
+                and np.array_equal(published[:len(intrinsics)], intrinsics)
+                and np.array_equal(published[len(intrinsics):], distortion))
+
+    def _pack_tag_observations(self, result: PipelineResult, timestamp: float) -> npt.NDArray[np.float64]:
+        # Capture timestamp followed by the ID and corners of each tag, for fusing observations from several devices
+        size = 1 + result.num_tags * OBSERVATION_STRIDE
+        if size > len(self._tag_observations):
+            self._tag_observations = np.zeros(1 + result.capacity * OBSERVATION_STRIDE)
+        observations = self._tag_observations[:size]
+        observations[0] = timestamp
+        tags = observations[1:].reshape(-1, OBSERVATION_STRIDE)
+        tags[:, 0] = result.tag_ids[:result.num_tags]
+        tags[:, 1:] = result.tag_corners[:result.num_tags].reshape(-1, 8)
+        return observations
+
+    def _pack_pose_estimate(self, result: PipelineResult) -> npt.NDArray[np.uint8]:
+        estimate = self._pose_estimate[0]
+        estimate["pose"] = result.camera_pose[0]
+        estimate["reproj_error"] = result.camera_pose_errors[0]
+        estimate["pose_alt"] = result.camera_pose[1]
+        estimate["reproj_error_alt"] = result.camera_pose_errors[1]
+        # The alternate pose is the identity with an error of 0 when there isn't one
+        estimate["has_alt"] = result.camera_pose_errors[1] != 0.0
+        return self._pose_estimate.view(np.uint8)
+
+    def _pack_tracked_targets(self, result: PipelineResult) -> npt.NDArray[np.uint8]:
+        num_targets = result.num_targets
+        if num_targets > len(self._tracked_targets):
+            self._tracked_targets = np.zeros(result.capacity, dtype=TRACKED_TARGET_DTYPE)
+        targets = self._tracked_targets[:num_targets]
+        targets["id"] = result.target_ids[:num_targets]
+        targets["camera_to_target"] = result.target_poses[:num_targets, 0]
+        targets["reproj_error"] = result.target_errors[:num_targets, 0]
+        targets["camera_to_target_alt"] = result.target_poses[:num_targets, 1]
+        targets["reproj_error_alt"] = result.target_errors[:num_targets, 1]
+        np.not_equal(result.target_errors[:num_targets, 1], 0.0, out=targets["has_alt"])
+        return targets.view(np.uint8)
+
+    def _add_struct_schema(self, struct_type: type):
+        # Registers the schemas of a struct type and the structs it contains, which typed struct publishers do
+        # themselves
+        wpistruct.forEachNested(struct_type,
+                                lambda type_string, schema: self._nt_instance.addSchema(type_string,
+                                                                                        "structschema",
+                                                                                        schema))
 
     def _init_nt(self):
         logger.info("Initializing NT output publisher")
-        table = ntcore.NetworkTableInstance.getDefault().getTable(f"orion/{self._config.network.device_id}/output")
-        pubsub_options = ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True)
+        table = self._nt_instance.getTable(f"orion/{self._config.network.device_id}/output")
+        pubsub_options = ntcore.PubSubOptions(periodic=PUBLISH_PERIOD_S, sendAll=True, keepDuplicates=True)
         self._timestamp_pub = table.getDoubleTopic("timestamp_ns").publish(pubsub_options)
+        self._latency_pub = table.getDoubleTopic("latency_ms").publish(pubsub_options)
         self._fps_pub = table.getDoubleTopic("fps").publish(pubsub_options)
         self._heartbeat_pub = table.getIntegerTopic("heartbeat").publish(pubsub_options)
 
         self._tag_ids_pub = table.getIntegerArrayTopic("tag_ids").publish(pubsub_options)
         self._has_pose_estimate_pub = table.getBooleanTopic("has_pose_estimate").publish(pubsub_options)
         self._has_tracked_targets_pub = table.getBooleanTopic("has_tracked_targets").publish(pubsub_options)
-        self._pose_estimate_pub = table.getStructTopic("pose_estimate", CameraPoseEstimate).publish(pubsub_options)
-        self._tracked_targets_pub = table.getStructArrayTopic("tracked_targets", TrackedTarget).publish(pubsub_options)
+        # Published as raw bytes with the struct type strings, so subscribers see the same topics as typed publishers
+        for struct_type, dtype in ((CameraPoseEstimate, CAMERA_POSE_ESTIMATE_DTYPE),
+                                   (TrackedTarget, TRACKED_TARGET_DTYPE)):
+            if dtype.itemsize != wpistruct.getSize(struct_type):
+                raise RuntimeError(f"Byte layout of {struct_type.__name__} doesn't match its struct schema")
+            self._add_struct_schema(struct_type)
+        self._pose_estimate_pub = table.getRawTopic("pose_estimate").publish(
+            wpistruct.getTypeString(CameraPoseEstimate), pubsub_options)
+        self._tracked_targets_pub = table.getRawTopic("tracked_targets").publish(
+            f"{wpistruct.getTypeString(TrackedTarget)}[]", pubsub_options)
+        self._tag_observations_pub = table.getDoubleArrayTopic("tag_observations").publish(pubsub_options)
+        # Camera matrix (row major) followed by the distortion coefficients, only published when they change
+        self._camera_intrinsics_pub = table.getDoubleArrayTopic("camera_intrinsics").publish()
+        self._camera_intrinsics_pub.getTopic().setRetained(True)
 
         self._nt_initialized = True
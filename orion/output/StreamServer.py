@@ -3,28 +3,53 @@ import socketserver
 import threading
 import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
 
 import cv2
 import numpy as np
 
 from ..config import Config
 from ..pipeline import CaptureFrame
+from ..scheduling import ThreadScheduler
+from .FrameProfiler import FrameProfiler
 
 logger = logging.getLogger(__name__)
 
 IMAGE_DOWNSCALE_FACTOR = 0.50
 
 
+def encode_stream_frame(image: cv2.Mat) -> bytes:
+    # Downscales and JPEG encodes a frame for the MJPEG stream
+    resized_frame = cv2.resize(image, None, fx=IMAGE_DOWNSCALE_FACTOR, fy=IMAGE_DOWNSCALE_FACTOR)
+    _, enc = cv2.imencode(".jpg", resized_frame)
+    return np.array(enc).tobytes()
+
+
 class StreamServer:
     _config: Config
+    _profiler: Optional[FrameProfiler]
+    _scheduler: Optional[ThreadScheduler]
 
-    _frame: cv2.Mat
+    _frame: Optional[CaptureFrame] = None
+    _frame_lock: threading.Lock
     _resolution_width: int
     _resolution_height: int
     _has_frame: bool = False
 
-    def __init__(self, config: Config):
+    def __init__(self,
+                 config: Config,
+                 profiler: Optional[FrameProfiler] = None,
+                 scheduler: Optional[ThreadScheduler] = None):
         self._config = config
+        self._profiler = profiler
+        self._scheduler = scheduler
+        self._frame_lock = threading.Lock()
+
+    def _retain_frame(self) -> CaptureFrame:
+        # Keeps the frame's buffer out of the capture pool while it's being encoded
+        with self._frame_lock:
+            return self._frame.retain()
 
     def _make_handler(self_mjpeg):  # type: ignore
         class StreamingHandler(BaseHTTPRequestHandler):
@@ -54,8 +79,50 @@ class StreamServer:
     </html>
             """
 
+            def _send_content(self, content: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _handle_profiler(self, path: str, query: str):
+                profiler = self_mjpeg._profiler
+                if path == "/profiler":
+                    links = "".join(f'<li><a href="/profiler/{name}">{name}</a></li>'
+                                    for name in profiler.list_profiles())
+                    status = "profiling" if profiler.is_profiling() else "idle"
+                    content = (f"<html><body><p>Profiler is {status}, "
+                               f'<a href="/profiler/arm">profile the next {self_mjpeg._config.profiler.num_frames} '
+                               f"frames</a></p><ul>{links}</ul></body></html>")
+                    self._send_content(content.encode("utf-8"), "text/html")
+                elif path == "/profiler/arm":
+                    try:
+                        num_frames = int(parse_qs(query).get("frames", [self_mjpeg._config.profiler.num_frames])[0])
+                    except ValueError:
+                        self.send_error(400, "frames must be an integer")
+                        return
+                    profiler.arm(num_frames)
+                    self._send_content(f"Profiling the next {num_frames} frames\n".encode("utf-8"), "text/plain")
+                else:
+                    profile_path = profiler.profile_path(path[len("/profiler/"):])
+                    if profile_path is None:
+                        self.send_error(404)
+                        return
+                    with open(profile_path, "rb") as profile_file:
+                        content = profile_file.read()
+                    self._send_content(content,
+                                       "text/plain" if profile_path.endswith(".txt") else "application/octet-stream")
+
             def do_GET(self):
-                if self.path == "/":
+                if self_mjpeg._scheduler is not None:
+                    # Handler threads inherit the server thread's schedule, this only labels them for reporting
+                    self_mjpeg._scheduler.register("stream")
+                url = urlsplit(self.path)
+                if self_mjpeg._profiler is not None and (url.path == "/profiler"
+                                                         or url.path.startswith("/profiler/")):
+                    self._handle_profiler(url.path, url.query)
+                elif self.path == "/":
                     content = self.HTML.encode("utf-8")
                     self.send_response(200)
                     self.send_header("Content-Type", "text/html")
@@ -76,13 +143,11 @@ class StreamServer:
                             if not self_mjpeg._has_frame:
                                 time.sleep(0.1)
                             else:
-                                resized_frame = cv2.resize(self_mjpeg._frame,
-                                                           None,
-                                                           fx=IMAGE_DOWNSCALE_FACTOR,
-                                                           fy=IMAGE_DOWNSCALE_FACTOR)
-                                _, enc = cv2.imencode(".jpg", resized_frame)
-
-                                frame_data = np.array(enc).tobytes()
+                                frame = self_mjpeg._retain_frame()
+                                try:
+                                    frame_data = encode_stream_frame(frame.image)
+                                finally:
+                                    frame.release()
 
                                 self.wfile.write(b"--FRAME\r\n")
                                 self.send_header("Content-Type", "image/jpeg")
@@ -103,6 +168,8 @@ class StreamServer:
         daemon_threads = True
 
     def _run(self, port: int) -> None:
+        if self._scheduler is not None:
+            self._scheduler.apply("stream")
         server = self.StreamingServer(("", port), self._make_handler())
         server.serve_forever()
 
@@ -113,7 +180,11 @@ class StreamServer:
         ).start()
 
     def set_frame(self, frame: CaptureFrame) -> None:
-        self._frame = frame.image
+        with self._frame_lock:
+            previous_frame = self._frame
+            self._frame = frame.retain()
+        if previous_frame is not None:
+            previous_frame.release()
         self._resolution_height = frame.resolution_height
         self._resolution_width = frame.resolution_width
         self._has_frame = True
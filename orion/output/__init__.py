@@ -1,7 +1,11 @@
 __all__ = [
+    "FrameProfiler",
+    "FrameRecorder",
     "NTOutputPublisher",
     "StreamServer"
 ]
 
+from .FrameProfiler import FrameProfiler
+from .FrameRecorder import FrameRecorder
 from .NTOutputPublisher import NTOutputPublisher
 from .StreamServer import StreamServer
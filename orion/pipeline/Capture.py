@@ -1,25 +1,61 @@
+import contextlib
 import dataclasses
+import glob
+import json
 import logging
+import os
 import sys
 import time
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import ContextManager, List, Optional, Tuple
 
 import cv2
+import numpy as np
+
+try:
+    import gi
+
+    gi.require_version("Gst", "1.0")
+    from gi.repository import GLib, Gst
+except (ImportError, ValueError):
+    Gst = None
 
 from ..config import CameraConfig, Config
+from ..scheduling import ThreadScheduler
+from .FrameBufferPool import FrameBufferPool, read_pooled
+from .gstreamer_templates import build_gstreamer_pipeline, gstreamer_source, resolve_template
 from .pipeline_types import CaptureFrame
 
 logger = logging.getLogger(__name__)
 
+# Buffer timestamps older than this are assumed to be bogus (or on an unexpected clock) and are ignored
+MAX_BUFFER_AGE_NS = 1_000_000_000
+SAMPLE_TIMEOUT_NS = 1_000_000_000
+
+
+def _pool_shape(config: CameraConfig) -> Tuple[int, ...]:
+    return FrameBufferPool.shape_for(config.resolution_width, config.resolution_height)
+
+
+def create_gstreamer_capture(config: Config, scheduler: Optional[ThreadScheduler] = None) -> "Capture":
+    # Reads buffer timestamps through an appsink when PyGObject is installed, otherwise falls back to OpenCV
+    if GstAppSinkCapture.is_available():
+        return GstAppSinkCapture(config, scheduler)
+    logger.warning("PyGObject not available, falling back to OpenCV GStreamer capture, capture times are estimated "
+                   "from the pipeline clock")
+    return GStreamerCapture(config, scheduler)
+
 
 class Capture(ABC):
-    @abstractmethod
-    def get_frame(self) -> Tuple[bool, CaptureFrame]:
-        pass
+    _scheduler: Optional[ThreadScheduler] = None
+
+    def _spawning_capture_threads(self) -> ContextManager[None]:
+        # Threads started by the capture backend while opening the camera get the capture role's schedule
+        return self._scheduler.spawning("capture") if self._scheduler is not None else contextlib.nullcontext()
 
     @abstractmethod
-    def _update_config(self):
+    def get_frame(self) -> Tuple[bool, CaptureFrame]:
+        # Frames are read into pooled buffers, the caller must release the frame once it's done with it
         pass
 
 
@@ -28,12 +64,16 @@ class DefaultCapture(Capture):
     _last_config: CameraConfig
     _video: cv2.VideoCapture
     _api: int
+    _pool: FrameBufferPool
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, scheduler: Optional[ThreadScheduler] = None):
         self._config = config.camera
+        self._scheduler = scheduler
         self._last_config = dataclasses.replace(self._config)
         self._api = cv2.CAP_V4L2 if sys.platform.startswith('linux') else cv2.CAP_ANY
-        self._video = cv2.VideoCapture(self._config.id, self._api)
+        with self._spawning_capture_threads():
+            self._video = cv2.VideoCapture(self._config.id, self._api)
+        self._pool = FrameBufferPool(_pool_shape(self._config))
         self._update_config()
 
     def get_frame(self) -> Tuple[bool, CaptureFrame]:
@@ -41,13 +81,25 @@ class DefaultCapture(Capture):
             logger.debug("Camera configuration changed, reapplying settings")
             self._update_config()
 
-        timestamp = time.time_ns()
-        ret, frame = self._video.read()
-        return ret, CaptureFrame(frame, timestamp, self._config.resolution_height, self._config.resolution_width)
+        read_timestamp = time.monotonic_ns()
+        ret, buffer = read_pooled(self._video, self._pool)
+        return ret, CaptureFrame(buffer.image if ret else None,
+                                 self._buffer_timestamp_ns(read_timestamp),
+                                 self._config.resolution_height,
+                                 self._config.resolution_width,
+                                 buffer)
+
+    def _buffer_timestamp_ns(self, fallback_timestamp_ns: int) -> int:
+        # The V4L2 backend reports the kernel buffer timestamp, which is on CLOCK_MONOTONIC for UVC cameras
+        buffer_timestamp_ns = int(self._video.get(cv2.CAP_PROP_POS_MSEC) * 1e6)
+        if 0 <= time.monotonic_ns() - buffer_timestamp_ns < MAX_BUFFER_AGE_NS:
+            return buffer_timestamp_ns
+        return fallback_timestamp_ns
 
     def _update_config(self):
         if self._last_config.id != self._config.id:
-            self._video.open(self._config.id, self._api)
+            with self._spawning_capture_threads():
+                self._video.open(self._config.id, self._api)
         self._video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('M', 'J', 'P', 'G'))
         self._video.set(cv2.CAP_PROP_FRAME_WIDTH, self._config.resolution_width)
         self._video.set(cv2.CAP_PROP_FRAME_HEIGHT, self._config.resolution_height)
@@ -55,6 +107,7 @@ class DefaultCapture(Capture):
         self._video.set(cv2.CAP_PROP_EXPOSURE, self._config.exposure)
         self._video.set(cv2.CAP_PROP_BRIGHTNESS, self._config.brightness)
         self._video.set(cv2.CAP_PROP_GAIN, self._config.gain)
+        self._pool.resize(_pool_shape(self._config))
         self._last_config = dataclasses.replace(self._config)
 
     def __del__(self):
@@ -65,31 +118,250 @@ class GStreamerCapture(Capture):
     _config: CameraConfig
     _last_config: CameraConfig
     _video: cv2.VideoCapture = None
+    _opened_ns: int = 0
+    _pool: FrameBufferPool
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, scheduler: Optional[ThreadScheduler] = None):
         self._config = config.camera
+        self._scheduler = scheduler
+        self._pool = FrameBufferPool(_pool_shape(self._config))
         self._update_config()
 
     def get_frame(self) -> Tuple[bool, CaptureFrame]:
         if self._last_config != self._config:
             logger.debug("Camera configuration changed, restarting capture")
             self._update_config()
-        
-        timestamp = time.time_ns()
-        ret, frame = self._video.read()
-        return ret, CaptureFrame(frame, timestamp, self._config.resolution_height, self._config.resolution_width)
-    
+
+        ret, buffer = read_pooled(self._video, self._pool)
+        return ret, CaptureFrame(buffer.image if ret else None,
+                                 self._buffer_timestamp_ns(),
+                                 self._config.resolution_height,
+                                 self._config.resolution_width,
+                                 buffer)
+
+    def is_opened(self) -> bool:
+        return self._video.isOpened()
+
+    def _buffer_timestamp_ns(self) -> int:
+        # OpenCV doesn't expose buffer timestamps, but reports the position of the last buffer in running time, which
+        # is the pipeline clock (the monotonic clock) minus the base time set when the pipeline started playing. The
+        # base time is set just before the capture finishes opening, so adding the position to the time it opened
+        # gives the capture time, late by at most the rest of opening. GstAppSinkCapture reads the base time instead.
+        read_ns = time.monotonic_ns()
+        capture_ns = self._opened_ns + int(self._video.get(cv2.CAP_PROP_POS_MSEC) * 1e6)
+        if 0 <= read_ns - capture_ns < MAX_BUFFER_AGE_NS:
+            return capture_ns
+        return read_ns
+
     def _update_config(self):
         if self._video is not None:
             self._video.release()
-        gst_device = f"/dev/video{self._config.id}" if type(self._config.id) is int else self._config.id
-        gst_controls = (f"c,auto_exposure={self._config.auto_exposure},"
-                        f"exposure_time_absolute={self._config.exposure},"
-                        f"gain={self._config.gain},"
-                        f"brightness={self._config.brightness}")
-        gst_pipeline_str = (f'v4l2src device="{gst_device}" extra_controls="{gst_controls}" '
-                            f'! image/jpeg,format=MJPG,width={self._config.resolution_width},'
-                            f'height={self._config.resolution_height} '
-                            '! jpegdec ! videoconvert ! appsink drop=1')
-        self._video = cv2.VideoCapture(gst_pipeline_str, cv2.CAP_GSTREAMER)
+        source = gstreamer_source(self._config)
+        for template_name in self._config.capture_pipelines:
+            template = resolve_template(template_name, self._config.capture_templates)
+            if template is None:
+                logger.warning(f'Unknown capture pipeline template "{template_name}", skipping')
+                continue
+            gst_pipeline_str = build_gstreamer_pipeline(template,
+                                                        source,
+                                                        self._config.resolution_width,
+                                                        self._config.resolution_height)
+            with self._spawning_capture_threads():
+                self._video = cv2.VideoCapture(gst_pipeline_str, cv2.CAP_GSTREAMER)
+            if self._video.isOpened():
+                self._opened_ns = time.monotonic_ns()
+                logger.info(f'Opened capture pipeline "{template_name}": {gst_pipeline_str}')
+                break
+            logger.warning(f'Failed to open capture pipeline "{template_name}", trying next template')
+            self._video.release()
+        else:
+            logger.error("No capture pipeline template could be opened")
+            self._video = cv2.VideoCapture()
+        self._pool.resize(_pool_shape(self._config))
+        self._last_config = dataclasses.replace(self._config)
+
+
+class GstAppSinkCapture(Capture):
+    _config: CameraConfig
+    _last_config: CameraConfig
+    _pipeline: Optional["Gst.Pipeline"] = None
+    _appsink: Optional["Gst.Element"] = None
+    _pool: FrameBufferPool
+
+    def __init__(self, config: Config, scheduler: Optional[ThreadScheduler] = None):
+        if not self.is_available():
+            raise RuntimeError("GstAppSinkCapture requires PyGObject with GStreamer bindings")
+        Gst.init(None)
+        self._config = config.camera
+        self._scheduler = scheduler
+        self._pool = FrameBufferPool(_pool_shape(self._config))
+        self._update_config()
+
+    @staticmethod
+    def is_available() -> bool:
+        return Gst is not None
+
+    def get_frame(self) -> Tuple[bool, CaptureFrame]:
+        if self._last_config != self._config:
+            logger.debug("Camera configuration changed, restarting capture")
+            self._update_config()
+
+        sample = self._appsink.emit("try-pull-sample", SAMPLE_TIMEOUT_NS) if self._appsink is not None else None
+        if sample is None:
+            return False, CaptureFrame(None,
+                                       time.monotonic_ns(),
+                                       self._config.resolution_height,
+                                       self._config.resolution_width)
+
+        buffer = sample.get_buffer()
+        caps = sample.get_caps().get_structure(0)
+        width = caps.get_value("width")
+        height = caps.get_value("height")
+        channels = 1 if caps.get_value("format") == "GRAY8" else 3
+        success, map_info = buffer.map(Gst.MapFlags.READ)
+        if not success:
+            return False, CaptureFrame(None, time.monotonic_ns(), height, width)
+        try:
+            # Rows may be padded, so take the stride from the buffer size instead of the width
+            stride = map_info.size // height
+            shape = FrameBufferPool.shape_for(width, height, channels)
+            strides = (stride, 1) if channels == 1 else (stride, channels, 1)
+            self._pool.resize(shape)
+            frame_buffer = self._pool.acquire()
+            np.copyto(frame_buffer.image,
+                      np.ndarray(shape, dtype=np.uint8, buffer=map_info.data, strides=strides))
+        finally:
+            buffer.unmap(map_info)
+
+        return True, CaptureFrame(frame_buffer.image,
+                                  self._buffer_timestamp_ns(buffer.pts),
+                                  height,
+                                  width,
+                                  frame_buffer)
+
+    def is_opened(self) -> bool:
+        return self._pipeline is not None
+
+    def _buffer_timestamp_ns(self, pts: int) -> int:
+        # The buffer PTS is in pipeline running time, measure how long ago that was on the pipeline clock and apply
+        # the same age to the monotonic clock, so that this works regardless of which clock the pipeline uses
+        now = time.monotonic_ns()
+        clock = self._pipeline.get_clock()
+        if pts == Gst.CLOCK_TIME_NONE or clock is None:
+            return now
+        age_ns = clock.get_time() - self._pipeline.get_base_time() - pts
+        if 0 <= age_ns < MAX_BUFFER_AGE_NS:
+            return now - age_ns
+        return now
+
+    def _update_config(self):
+        if self._pipeline is not None:
+            self._pipeline.set_state(Gst.State.NULL)
+            self._pipeline = None
+            self._appsink = None
+        source = gstreamer_source(self._config)
+        for template_name in self._config.capture_pipelines:
+            template = resolve_template(template_name, self._config.capture_templates)
+            if template is None:
+                logger.warning(f'Unknown capture pipeline template "{template_name}", skipping')
+                continue
+            gst_pipeline_str = build_gstreamer_pipeline(template,
+                                                        source,
+                                                        self._config.resolution_width,
+                                                        self._config.resolution_height)
+            with self._spawning_capture_threads():
+                opened = self._open_pipeline(gst_pipeline_str)
+            if opened:
+                logger.info(f'Opened capture pipeline "{template_name}": {gst_pipeline_str}')
+                break
+            logger.warning(f'Failed to open capture pipeline "{template_name}", trying next template')
+        else:
+            logger.error("No capture pipeline template could be opened")
         self._last_config = dataclasses.replace(self._config)
+
+    def _open_pipeline(self, gst_pipeline_str: str) -> bool:
+        try:
+            pipeline = Gst.parse_launch(gst_pipeline_str)
+        except GLib.Error as e:
+            logger.debug(f"Failed to parse capture pipeline: {e}")
+            return False
+
+        appsink = next((element for element in pipeline.iterate_sinks()
+                        if element.get_factory().get_name() == "appsink"), None)
+        if appsink is None:
+            logger.debug("Capture pipeline has no appsink")
+            return False
+        appsink.set_property("caps", Gst.Caps.from_string("video/x-raw,format=BGR;video/x-raw,format=GRAY8"))
+
+        if pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            pipeline.set_state(Gst.State.NULL)
+            return False
+        self._pipeline = pipeline
+        self._appsink = appsink
+        return True
+
+    def __del__(self):
+        if self._pipeline is not None:
+            self._pipeline.set_state(Gst.State.NULL)
+
+
+class RecordingCapture(Capture):
+    # Replays segments written by FrameRecorder, either a single segment or every segment in a directory in order,
+    # with the original capture timestamps from the sidecar metadata. Frames are replayed as recorded, so it takes no
+    # camera config.
+
+    _segments: List[str]
+    _video: Optional[cv2.VideoCapture] = None
+    _timestamps_ns: List[int]
+    _frame_index: int = 0
+    _pool: Optional[FrameBufferPool] = None
+
+    def __init__(self, path: str):
+        if os.path.isdir(path):
+            self._segments = [os.path.splitext(segment)[0]
+                              for segment in sorted(glob.glob(os.path.join(path, "*.avi")))]
+        else:
+            self._segments = [os.path.splitext(path)[0]]
+        self._timestamps_ns = []
+
+    def get_frame(self) -> Tuple[bool, CaptureFrame]:
+        while True:
+            if self._video is not None:
+                ret, buffer = read_pooled(self._video, self._pool)
+                if ret:
+                    timestamp_ns = (self._timestamps_ns[self._frame_index]
+                                    if self._frame_index < len(self._timestamps_ns)
+                                    else time.monotonic_ns())
+                    self._frame_index += 1
+                    image = buffer.image
+                    return True, CaptureFrame(image, timestamp_ns, image.shape[0], image.shape[1], buffer)
+                self._video.release()
+                self._video = None
+            if len(self._segments) == 0:
+                return False, CaptureFrame(None, time.monotonic_ns(), 0, 0)
+            self._open_segment(self._segments.pop(0))
+
+    def _open_segment(self, segment: str):
+        logger.info(f"Replaying {segment}")
+        self._timestamps_ns = []
+        try:
+            with open(f"{segment}.jsonl") as metadata_file:
+                self._timestamps_ns = [json.loads(line)["timestamp_ns"] for line in metadata_file if line.strip()]
+        except FileNotFoundError:
+            logger.warning(f"No metadata for {segment}, using current timestamps")
+        self._video = cv2.VideoCapture(f"{segment}.avi")
+        self._frame_index = 0
+        if not self._video.isOpened():
+            logger.error(f"Failed to open {segment}.avi")
+            self._video = None
+            return
+        shape = FrameBufferPool.shape_for(int(self._video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                          int(self._video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if self._pool is None:
+            self._pool = FrameBufferPool(shape)
+        else:
+            self._pool.resize(shape)
+
+    def __del__(self):
+        if self._video is not None:
+            self._video.release()
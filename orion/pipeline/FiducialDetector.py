@@ -1,41 +1,375 @@
+import collections
+import dataclasses
+import logging
+import math
+import time
 from abc import abstractmethod, ABC
-from typing import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 import numpy.typing as npt
+from wpimath.geometry import Pose3d
 
-from ..config import Config
-from .pipeline_types import FiducialTagDetection, CaptureFrame
+try:
+    import robotpy_apriltag
+except ImportError:
+    robotpy_apriltag = None
+
+from ..config import Config, DetectorConfig
+from .pipeline_types import CaptureFrame
+
+logger = logging.getLogger(__name__)
+
+# Detectors for this many combinations of tag families and detector parameters are kept for switching back
+DETECTOR_CACHE_SIZE = 8
+# IDs of the nth extra tag family are reported offset by n times this
+MULTI_FAMILY_ID_OFFSET = 1000
+
+# Detections of the same tag in overlapping tiles with mean corner distance below this are merged
+TILE_MERGE_DISTANCE_PX = 3.0
 
 
 class FiducialDetector(ABC):
     @abstractmethod
-    def detect_fiducials(self, frame: CaptureFrame) -> tuple[npt.NDArray[np.int32],
-                                                             Sequence[npt.NDArray[np.float64]],
-                                                             Sequence[FiducialTagDetection]]:
+    def detect_fiducials(self, frame: CaptureFrame) -> tuple[Optional[npt.NDArray[np.int32]],
+                                                             Sequence[npt.NDArray[np.float32]]]:
+        # Returns ids (N, 1) and corners as a sequence of (1, 4, 2) arrays, in the format of cv2.aruco.detectMarkers
         pass
 
 
+def make_detector_parameters(detector_config: DetectorConfig) -> cv2.aruco.DetectorParameters:
+    detector_params = cv2.aruco.DetectorParameters()
+    detector_params.adaptiveThreshWinSizeMin = detector_config.adaptive_thresh_win_size_min
+    detector_params.adaptiveThreshWinSizeMax = detector_config.adaptive_thresh_win_size_max
+    detector_params.adaptiveThreshWinSizeStep = detector_config.adaptive_thresh_win_size_step
+    detector_params.adaptiveThreshConstant = detector_config.adaptive_thresh_constant
+    detector_params.minMarkerPerimeterRate = detector_config.min_marker_perimeter_rate
+    detector_params.maxMarkerPerimeterRate = detector_config.max_marker_perimeter_rate
+    detector_params.polygonalApproxAccuracyRate = detector_config.polygonal_approx_accuracy_rate
+    detector_params.cornerRefinementMethod = Config.corner_refinement_methods[detector_config.corner_refinement_method]
+    detector_params.cornerRefinementWinSize = detector_config.corner_refinement_win_size
+    detector_params.cornerRefinementMaxIterations = detector_config.corner_refinement_max_iterations
+    detector_params.cornerRefinementMinAccuracy = detector_config.corner_refinement_min_accuracy
+    detector_params.useAruco3Detection = detector_config.use_aruco3_detection
+    detector_params.minMarkerLengthRatioOriginalImg = detector_config.min_marker_length_ratio_original_img
+    return detector_params
+
+
+def _rotated_codes(dictionary: cv2.aruco.Dictionary) -> npt.NDArray[np.uint64]:
+    # Packs the bits of each code in its four rotations into integers, shape (N, 4)
+    packed = dictionary.bytesList.astype(np.uint64)
+    codes = np.zeros((packed.shape[0], 4), dtype=np.uint64)
+    for byte_index in range(packed.shape[1]):
+        codes = (codes << np.uint64(8)) | packed[:, byte_index, :]
+    return codes
+
+
+def make_family_detectors(families: Sequence[int],
+                          detector_params: cv2.aruco.DetectorParameters,
+                          allowed_ids: Optional[Sequence[int]] = None
+                          ) -> List[Tuple[cv2.aruco.ArucoDetector, Optional[npt.NDArray[np.int32]]]]:
+    # One detector per marker size and correction limit. Families that share both share a detector with a merged
+    # dictionary, so thresholding and contour finding run once for all of them, while each family still corrects as
+    # many bits as its own dictionary. The map converts merged dictionary indices to IDs, offset by
+    # MULTI_FAMILY_ID_OFFSET times the family's index in families. Codes that an earlier family already has in any
+    # rotation are dropped from the later family, since the tag could be either. If allowed_ids is given, dictionaries
+    # only hold the codes of those IDs, and groups without any are skipped.
+    groups = {}
+    seen_codes = {}
+    for index, family in enumerate(families):
+        dictionary = cv2.aruco.getPredefinedDictionary(family)
+        rotated_codes = _rotated_codes(dictionary)
+        codes = np.arange(len(dictionary.bytesList), dtype=np.int32)
+        if dictionary.markerSize in seen_codes:
+            overlapping = np.isin(rotated_codes[:, 0], seen_codes[dictionary.markerSize])
+            if np.all(overlapping):
+                logger.warning(f"Skipping tag family {index}, all its codes are in an earlier family")
+                continue
+            if np.any(overlapping):
+                logger.warning(f"Ignoring {np.count_nonzero(overlapping)} codes of tag family {index} that are in "
+                               f"an earlier family")
+                codes = codes[~overlapping]
+            seen_codes[dictionary.markerSize] = np.concatenate((seen_codes[dictionary.markerSize],
+                                                                rotated_codes[codes].ravel()))
+        else:
+            seen_codes[dictionary.markerSize] = rotated_codes.ravel()
+        if allowed_ids is not None:
+            family_ids = np.asarray(allowed_ids, dtype=np.int32) - index * MULTI_FAMILY_ID_OFFSET
+            num_ids = len(dictionary.bytesList) if len(families) == 1 else min(len(dictionary.bytesList),
+                                                                               MULTI_FAMILY_ID_OFFSET)
+            codes = np.intersect1d(codes, family_ids[(family_ids >= 0) & (family_ids < num_ids)])
+        groups.setdefault((dictionary.markerSize, dictionary.maxCorrectionBits), []).append((index, dictionary,
+                                                                                             codes))
+
+    detectors = []
+    for (marker_size, max_correction_bits), dictionaries in groups.items():
+        if (len(dictionaries) == 1 and dictionaries[0][0] == 0 and allowed_ids is None
+                and len(dictionaries[0][2]) == len(dictionaries[0][1].bytesList)):
+            detectors.append((cv2.aruco.ArucoDetector(dictionaries[0][1], detector_params), None))
+            continue
+        dictionaries = [(index, dictionary, codes) for index, dictionary, codes in dictionaries if len(codes) > 0]
+        if len(dictionaries) == 0:
+            continue
+        # Keeping the family's correction limit means the same codes are accepted as with the full dictionary, the
+        # IDs that were left out can't be within it of the remaining codes
+        merged = cv2.aruco.Dictionary(np.concatenate([dictionary.bytesList[codes]
+                                                      for _, dictionary, codes in dictionaries]),
+                                      marker_size,
+                                      max_correction_bits)
+        id_map = np.concatenate([codes + index * MULTI_FAMILY_ID_OFFSET for index, _, codes in dictionaries])
+        detectors.append((cv2.aruco.ArucoDetector(merged, detector_params), id_map))
+    return detectors
+
+
 class ArUcoFiducialDetector(FiducialDetector):
+    # Detectors are cached by tag families, detector parameters and the layout's IDs, and swapped in at the start of a
+    # frame when the config changes
     _config: Config
-    _detector: cv2.aruco.ArucoDetector
+    _detectors: List[Tuple[cv2.aruco.ArucoDetector, Optional[npt.NDArray[np.int32]]]]
+    _detector_cache: collections.OrderedDict
+    _last_families: tuple = ()
+    _last_detector_config: Optional[DetectorConfig] = None
+    _last_layout: Optional[Dict[int, Pose3d]] = None
+    last_swap_ns: int = 0
 
     def __init__(self, config: Config):
         self._config = config
-        detector_params = cv2.aruco.DetectorParameters()
-        marker_dict = cv2.aruco.getPredefinedDictionary(config.fiducial.tag_family)
-        self._detector = cv2.aruco.ArucoDetector(marker_dict, detector_params)
-
-    def detect_fiducials(self, frame: CaptureFrame) -> tuple[npt.NDArray[np.int32],
-                                                             Sequence[npt.NDArray[np.float64]],
-                                                             Sequence[FiducialTagDetection]]:
-        corners, ids, rejected_pts = self._detector.detectMarkers(frame.image)
-        if len(corners) == 0:
-            return ids, corners, []
-
-        detections = [FiducialTagDetection(tag_id[0], corner_pts[0])
-                      for tag_id, corner_pts in zip(ids, corners)
-                      if not self._config.has_tag_layout()
-                      or (self._config.has_tag_layout() and tag_id[0] in self._config.fiducial.tag_layout)]
-        return ids, corners, detections
+        self._detector_cache = collections.OrderedDict()
+        self._update_detectors()
+
+    def detect_fiducials(self, frame: CaptureFrame) -> tuple[Optional[npt.NDArray[np.int32]],
+                                                             Sequence[npt.NDArray[np.float32]]]:
+        self._update_detectors()
+
+        if len(self._detectors) == 1 and self._detectors[0][1] is None:
+            corners, ids, rejected_pts = self._detectors[0][0].detectMarkers(frame.image)
+            return ids, corners
+
+        all_ids = []
+        all_corners = []
+        for detector, id_map in self._detectors:
+            corners, ids, rejected_pts = detector.detectMarkers(frame.image)
+            if ids is None:
+                continue
+            all_ids.append(ids if id_map is None else id_map[ids])
+            all_corners += corners
+        if len(all_ids) == 0:
+            return None, ()
+        return np.concatenate(all_ids), tuple(all_corners)
+
+    def _update_detectors(self):
+        families = (self._config.fiducial.tag_family, *self._config.fiducial.extra_tag_families)
+        # The layout is replaced rather than modified when it changes, so comparing identity is enough
+        if (families == self._last_families
+                and self._config.detector == self._last_detector_config
+                and self._config.fiducial.tag_layout is self._last_layout):
+            return
+        start = time.perf_counter_ns()
+        allowed_ids = None
+        if self._config.detector.restrict_to_layout and self._config.has_tag_layout():
+            allowed_ids = tuple(sorted(self._config.fiducial.tag_layout))
+        key = (families, dataclasses.astuple(self._config.detector), allowed_ids)
+        detectors = self._detector_cache.get(key)
+        if detectors is None:
+            detectors = make_family_detectors(families, make_detector_parameters(self._config.detector), allowed_ids)
+            self._detector_cache[key] = detectors
+            if len(self._detector_cache) > DETECTOR_CACHE_SIZE:
+                self._detector_cache.popitem(last=False)
+        self._detector_cache.move_to_end(key)
+        # A single assignment, so a frame never sees a partially updated detector
+        self._detectors = detectors
+        self._last_families = families
+        self._last_detector_config = dataclasses.replace(self._config.detector)
+        self._last_layout = self._config.fiducial.tag_layout
+        self.last_swap_ns = time.perf_counter_ns() - start
+        logger.debug(f"Swapped ArUco detector in {self.last_swap_ns / 1e3:.1f} us")
+
+
+class AprilTagFiducialDetector(FiducialDetector):
+    apriltag_families = {
+        cv2.aruco.DICT_APRILTAG_16h5: "tag16h5",
+        cv2.aruco.DICT_APRILTAG_25h9: "tag25h9",
+        cv2.aruco.DICT_APRILTAG_36h10: "tag36h10",
+        cv2.aruco.DICT_APRILTAG_36h11: "tag36h11"
+    }
+
+    _config: Config
+    _detector: "robotpy_apriltag.AprilTagDetector"
+    _last_detector_key: tuple = ()
+    _corners_buffer: list
+
+    def __init__(self, config: Config):
+        if not self.is_available():
+            raise RuntimeError("AprilTagFiducialDetector requires robotpy-apriltag")
+        self._config = config
+        self._corners_buffer = [0.0] * 8
+        self._update_detector()
+
+    @staticmethod
+    def is_available() -> bool:
+        return robotpy_apriltag is not None
+
+    def detect_fiducials(self, frame: CaptureFrame) -> tuple[Optional[npt.NDArray[np.int32]],
+                                                             Sequence[npt.NDArray[np.float32]]]:
+        if self._detector_key() != self._last_detector_key:
+            self._update_detector()
+
+        # Tiles are views into the frame, which the AprilTag detector can't take directly
+        image = (np.ascontiguousarray(frame.image) if frame.image.ndim == 2
+                 else cv2.cvtColor(frame.image, cv2.COLOR_BGR2GRAY))
+        raw_detections = [d for d in self._detector.detect(image)
+                          if d.getDecisionMargin() >= self._config.detector.apriltag_min_decision_margin
+                          and d.getHamming() <= self._config.detector.apriltag_max_hamming]
+        if len(raw_detections) == 0:
+            return None, ()
+
+        ids = np.array([[d.getId()] for d in raw_detections], dtype=np.int32)
+        # AprilTag corners go counter-clockwise from the bottom left with the origin at the corner of the first pixel,
+        # reorder them to match ArUco (clockwise from the top left) and shift to OpenCV's pixel-center origin
+        corners = tuple(np.array(d.getCorners(self._corners_buffer), dtype=np.float32).reshape(1, 4, 2)[:, [1, 0, 3, 2]]
+                        - 0.5 for d in raw_detections)
+        return ids, corners
+
+    def _detector_key(self) -> tuple:
+        # The tag family and the parameters the detector is built with. The decision margin and Hamming distance
+        # limits filter detections with the current config on every frame, so they don't need a new detector.
+        detector = self._config.detector
+        return (self._config.fiducial.tag_family,
+                detector.apriltag_num_threads,
+                detector.apriltag_quad_decimate,
+                detector.apriltag_quad_sigma,
+                detector.apriltag_refine_edges,
+                detector.apriltag_decode_sharpening)
+
+    def _update_detector(self):
+        self._detector = robotpy_apriltag.AprilTagDetector()
+        family = self.apriltag_families.get(self._config.fiducial.tag_family)
+        if family is None or not self._detector.addFamily(family):
+            logger.error("Tag family is not supported by the AprilTag detector, no tags will be detected")
+
+        detector_config = robotpy_apriltag.AprilTagDetector.Config()
+        detector_config.numThreads = self._config.detector.apriltag_num_threads
+        detector_config.quadDecimate = self._config.detector.apriltag_quad_decimate
+        detector_config.quadSigma = self._config.detector.apriltag_quad_sigma
+        detector_config.refineEdges = self._config.detector.apriltag_refine_edges
+        detector_config.decodeSharpening = self._config.detector.apriltag_decode_sharpening
+        self._detector.setConfig(detector_config)
+
+        self._last_detector_key = self._detector_key()
+
+
+class TiledFiducialDetector(FiducialDetector):
+    # Splits the frame into overlapping tiles and detects each tile with its own detector in a thread pool. OpenCV
+    # and the AprilTag detector release the GIL, so tiles are detected in parallel. Tags on tile boundaries that are
+    # detected in more than one tile are merged.
+    _config: Config
+    _make_detector: Callable[[Config], FiducialDetector]
+
+    # Copy of the config with detector parameters relative to the image size rescaled to the tile size
+    _tile_config: Config
+    _last_detector_config: Optional[DetectorConfig] = None
+    _tile_shape: Tuple[int, ...] = ()
+    _tiles: List[Tuple[int, int, int, int]]
+    _detectors: List[FiducialDetector]
+    _executor: Optional[ThreadPoolExecutor] = None
+    _num_threads: int = 0
+
+    def __init__(self, config: Config, make_detector: Callable[[Config], FiducialDetector]):
+        self._config = config
+        self._make_detector = make_detector
+        # Only the fiducial and detector configs are used by detectors. The fiducial config is shared so tiles follow
+        # family and layout changes, the detector config is a rescaled copy.
+        self._tile_config = Config(config.network_config_file, config.calibration_file, config.detector_config_file)
+        self._tile_config.fiducial = config.fiducial
+        self._tiles = []
+        self._detectors = []
+
+    def detect_fiducials(self, frame: CaptureFrame) -> tuple[Optional[npt.NDArray[np.int32]],
+                                                             Sequence[npt.NDArray[np.float32]]]:
+        self._update_tiles(frame.image.shape)
+        futures = [self._executor.submit(detector.detect_fiducials,
+                                         CaptureFrame(frame.image[y0:y1, x0:x1],
+                                                      frame.timestamp_ns,
+                                                      y1 - y0,
+                                                      x1 - x0))
+                   for detector, (x0, y0, x1, y1) in zip(self._detectors, self._tiles)]
+
+        ids = []
+        corners = []
+        margins = []
+        height, width = frame.image.shape[:2]
+        for future, (x0, y0, x1, y1) in zip(futures, self._tiles):
+            tile_ids, tile_corners = future.result()
+            if tile_ids is None or len(tile_ids) == 0:
+                continue
+            for tag_id, tag_corners in zip(np.asarray(tile_ids).reshape(-1), tile_corners):
+                tag_corners = tag_corners.reshape(4, 2) + np.array([x0, y0], dtype=np.float32)
+                # Distance to the nearest tile edge that isn't a frame edge, the detection furthest from one is kept
+                inner_edges = [tag_corners[:, 0].min() - x0 if x0 > 0 else np.inf,
+                               x1 - tag_corners[:, 0].max() if x1 < width else np.inf,
+                               tag_corners[:, 1].min() - y0 if y0 > 0 else np.inf,
+                               y1 - tag_corners[:, 1].max() if y1 < height else np.inf]
+                margin = min(inner_edges)
+                duplicate = next((i for i in range(len(ids)) if ids[i] == tag_id
+                                  and np.mean(np.linalg.norm(corners[i] - tag_corners, axis=1))
+                                  < TILE_MERGE_DISTANCE_PX), None)
+                if duplicate is None:
+                    ids.append(tag_id)
+                    corners.append(tag_corners)
+                    margins.append(margin)
+                elif margin > margins[duplicate]:
+                    corners[duplicate] = tag_corners
+                    margins[duplicate] = margin
+
+        if len(ids) == 0:
+            return None, ()
+        return (np.array(ids, dtype=np.int32).reshape(-1, 1),
+                tuple(tag_corners.reshape(1, 4, 2) for tag_corners in corners))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _update_tiles(self, shape: Tuple[int, ...]):
+        detector_config = self._config.detector
+        self._tile_config.fiducial = self._config.fiducial
+        if shape == self._tile_shape and detector_config == self._last_detector_config:
+            return
+        height, width = shape[:2]
+        rows = max(detector_config.tile_rows, 1)
+        cols = max(detector_config.tile_cols, 1)
+        self._tiles = [(x0, y0, x1, y1)
+                       for y0, y1 in self._tile_ranges(height, rows, detector_config.tile_overlap)
+                       for x0, x1 in self._tile_ranges(width, cols, detector_config.tile_overlap)]
+
+        # Perimeter and marker length limits are relative to the largest image dimension, keep them relative to the
+        # frame so the tiles accept the same tags as a full frame detection would
+        tile_scale = max(height, width) / max(max(y1 - y0, x1 - x0) for x0, y0, x1, y1 in self._tiles)
+        self._tile_config.detector = dataclasses.replace(
+            detector_config,
+            min_marker_perimeter_rate=detector_config.min_marker_perimeter_rate * tile_scale,
+            max_marker_perimeter_rate=detector_config.max_marker_perimeter_rate * tile_scale,
+            min_marker_length_ratio_original_img=min(
+                detector_config.min_marker_length_ratio_original_img * tile_scale, 1.0))
+        if len(self._detectors) != len(self._tiles):
+            logger.info(f"Detecting in {rows}x{cols} tiles")
+            self._detectors = [self._make_detector(self._tile_config) for _ in self._tiles]
+
+        num_threads = detector_config.tile_threads if detector_config.tile_threads > 0 else len(self._tiles)
+        if self._executor is None or num_threads != self._num_threads:
+            self.close()
+            self._executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="tile-detector")
+            self._num_threads = num_threads
+
+        self._tile_shape = shape
+        self._last_detector_config = dataclasses.replace(detector_config)
+
+    @staticmethod
+    def _tile_ranges(size: int, count: int, overlap: float) -> List[Tuple[int, int]]:
+        overlap_px = int(round(overlap * size)) if count > 1 else 0
+        tile_size = math.ceil((size + (count - 1) * overlap_px) / count)
+        starts = [min(i * (tile_size - overlap_px), size - tile_size) for i in range(count)]
+        return [(start, start + tile_size) for start in starts]
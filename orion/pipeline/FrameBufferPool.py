@@ -0,0 +1,103 @@
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Buffers in flight at once: the frame being processed, the frame held by the stream server and one being encoded
+INITIAL_POOL_SIZE = 3
+
+
+class FrameBuffer:
+    # A pooled image that is returned to its pool once every holder has released it. Capture returns frames with one
+    # reference owned by the caller, anything that keeps the frame past the current loop iteration must retain it.
+    __slots__ = ("image", "_pool", "_ref_count")
+
+    image: np.ndarray
+    _pool: "FrameBufferPool"
+    _ref_count: int
+
+    def __init__(self, image: np.ndarray, pool: "FrameBufferPool"):
+        self.image = image
+        self._pool = pool
+        self._ref_count = 0
+
+    def retain(self) -> "FrameBuffer":
+        with self._pool.lock:
+            self._ref_count += 1
+        return self
+
+    def release(self):
+        with self._pool.lock:
+            self._ref_count -= 1
+            if self._ref_count == 0:
+                self._pool.return_buffer(self)
+            elif self._ref_count < 0:
+                logger.error("Frame buffer released more times than it was retained")
+                self._ref_count = 0
+
+
+class FrameBufferPool:
+    lock: threading.Lock
+
+    _shape: Tuple[int, ...]
+    _free_buffers: List[FrameBuffer]
+    _num_allocated: int = 0
+
+    def __init__(self, shape: Tuple[int, ...]):
+        self.lock = threading.Lock()
+        self._shape = shape
+        self._free_buffers = [FrameBuffer(np.empty(shape, dtype=np.uint8), self) for _ in range(INITIAL_POOL_SIZE)]
+        self._num_allocated = INITIAL_POOL_SIZE
+
+    @staticmethod
+    def shape_for(width: int, height: int, channels: int = 3) -> Tuple[int, ...]:
+        return (height, width) if channels == 1 else (height, width, channels)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self._shape
+
+    def acquire(self) -> FrameBuffer:
+        with self.lock:
+            if len(self._free_buffers) > 0:
+                buffer = self._free_buffers.pop()
+            else:
+                # Every buffer is still held, so grow the pool rather than blocking capture
+                buffer = FrameBuffer(np.empty(self._shape, dtype=np.uint8), self)
+                self._num_allocated += 1
+                logger.debug(f"Frame buffer pool grew to {self._num_allocated} buffers")
+            buffer._ref_count = 1
+        return buffer
+
+    def resize(self, shape: Tuple[int, ...]):
+        # Buffers of the old shape that are still held are dropped when they are released
+        with self.lock:
+            if shape == self._shape:
+                return
+            logger.info(f"Resizing frame buffer pool from {self._shape} to {shape}")
+            self._shape = shape
+            self._free_buffers = [FrameBuffer(np.empty(shape, dtype=np.uint8), self) for _ in range(INITIAL_POOL_SIZE)]
+            self._num_allocated = INITIAL_POOL_SIZE
+
+    def return_buffer(self, buffer: FrameBuffer):
+        # Called with the lock held
+        if buffer.image.shape == self._shape:
+            self._free_buffers.append(buffer)
+
+
+def read_pooled(video: cv2.VideoCapture, pool: FrameBufferPool) -> Tuple[bool, Optional[FrameBuffer]]:
+    # Reads a frame from a cv2.VideoCapture into a pooled buffer. If the frame doesn't match the pool's shape OpenCV
+    # allocates a new image, in which case the pool is resized to match.
+    buffer = pool.acquire()
+    ret, image = video.read(image=buffer.image)
+    if not ret:
+        buffer.release()
+        return False, None
+    if image is not buffer.image:
+        pool.resize(image.shape)
+        buffer.image = image
+    return True, buffer
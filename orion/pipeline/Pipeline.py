@@ -1,10 +1,14 @@
 import logging
 import time
+from typing import Dict, Optional
 
 import cv2
+import numpy as np
+import numpy.typing as npt
+from wpimath.geometry import Pose3d
 
 from . import PoseEstimator
-from .FiducialDetector import ArUcoFiducialDetector, FiducialDetector
+from .FiducialDetector import AprilTagFiducialDetector, ArUcoFiducialDetector, FiducialDetector
 from .pipeline_types import CaptureFrame, PipelineResult
 from ..config import Config
 
@@ -14,33 +18,71 @@ logger = logging.getLogger(__name__)
 class Pipeline:
     _config: Config
     _fiducial_detector: FiducialDetector
+    _detector_backend: str
     _pose_estimator: PoseEstimator
+    _result: PipelineResult
+
+    # Whether each tag ID is in the layout, indexed by ID and rebuilt when the layout changes
+    _layout_mask: npt.NDArray[np.bool_]
+    _mask_layout: Optional[Dict[int, Pose3d]] = None
 
     def __init__(self, config: Config):
         self._config = config
-        self._fiducial_detector = ArUcoFiducialDetector(config)
+        self._update_detector_backend()
         self._pose_estimator = PoseEstimator(config)
+        self._result = PipelineResult()
+        self._layout_mask = np.zeros(0, dtype=bool)
         if not self._config.has_calibration():
             logger.warning("No calibration provided, tag transforms will not be calculated")
         if not self._config.has_tag_layout():
             logger.warning("No tag layout provided, pose estimation will not be performed")
 
+    def _update_detector_backend(self):
+        self._detector_backend = self._config.detector.backend
+        if self._detector_backend == "apriltag":
+            if AprilTagFiducialDetector.is_available():
+                logger.info("Using AprilTag detector backend")
+                self._fiducial_detector = AprilTagFiducialDetector(self._config)
+                return
+            logger.error("robotpy-apriltag is not installed, falling back to ArUco detector backend")
+        logger.info("Using ArUco detector backend")
+        self._fiducial_detector = ArUcoFiducialDetector(self._config)
+
     def process_frame(self, frame: CaptureFrame) -> PipelineResult:
-        process_dt_nanos = time.perf_counter_ns()
-        raw_corners, raw_ids, detections = self._fiducial_detector.detect_fiducials(frame)
-        image = cv2.aruco.drawDetectedMarkers(frame.image, raw_ids, raw_corners)
+        # The returned result is reused for the next frame
+        if self._detector_backend != self._config.detector.backend:
+            self._update_detector_backend()
+
+        start_time = time.perf_counter_ns()
+        result = self._result
+        result.reset(frame.timestamp_ns)
+        ids, corners = self._fiducial_detector.detect_fiducials(frame)
+        # Annotates the frame for the stream. The result only holds copies of detections, never the pooled image.
+        cv2.aruco.drawDetectedMarkers(frame.image, corners, ids)
+
+        result.set_detections(ids, corners)
+        if self._config.has_tag_layout() and result.num_tags > 0:
+            # The ArUco backend only decodes layout IDs unless restrict_to_layout is disabled, the AprilTag backend
+            # decodes every ID in the family
+            result.retain_tags(self._in_layout(result.seen_tag_ids))
 
-        tracked_targets = []
-        pose_result = None
         if self._config.has_calibration():
             if self._config.has_tag_layout():
-                pose_result, tracked_targets = self._pose_estimator.solve_camera_pose(detections)
+                self._pose_estimator.solve_camera_pose(result)
             else:
-                tracked_targets = self._pose_estimator.solve_target_poses(detections)
-
-        return PipelineResult(frame.timestamp_ns,
-                              process_dt_nanos,
-                              image,
-                              [detection.id for detection in detections],
-                              tracked_targets,
-                              pose_result)
+                self._pose_estimator.solve_target_poses(result)
+
+        result.process_dt_ns = time.perf_counter_ns() - start_time
+        return result
+
+    def _in_layout(self, tag_ids: npt.NDArray[np.int64]) -> npt.NDArray[np.bool_]:
+        layout = self._config.fiducial.tag_layout
+        if layout is not self._mask_layout:
+            layout_ids = [tag_id for tag_id in layout if tag_id >= 0]
+            self._layout_mask = np.zeros(max(layout_ids, default=-1) + 1, dtype=bool)
+            self._layout_mask[layout_ids] = True
+            self._mask_layout = layout
+        in_range = (tag_ids >= 0) & (tag_ids < len(self._layout_mask))
+        keep = np.zeros(len(tag_ids), dtype=bool)
+        keep[in_range] = self._layout_mask[tag_ids[in_range]]
+        return keep
@@ -1,121 +1,224 @@
 import logging
-from typing import Sequence, Optional
+from typing import Dict, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 import numpy.typing as npt
-from wpimath.geometry import Pose3d, Rotation3d, Transform3d
+from wpimath.geometry import Pose3d
 
 from ..config import Config
-from ..coordinate_util import to_opencv_translation, from_opencv_translation, from_opencv_rotation
-from .pipeline_types import FiducialTagDetection, CameraPoseEstimate, TrackedTarget
+from ..coordinate_util import (tag_corner_offsets,
+                               to_opencv_translation,
+                               from_opencv_translations,
+                               from_opencv_rotation_matrices,
+                               quaternion_to_rotation_matrix,
+                               to_pose_vectors)
+from .batch_ippe import solve_ippe_square_batch, supports_distortion
+from .pipeline_types import IDENTITY_POSE, PipelineResult
 
 logger = logging.getLogger(__name__)
 
+# Below this many tags, per-tag solvePnPGeneric calls are cheaper than the batched solver's fixed NumPy overhead
+BATCH_SOLVE_MIN_TAGS = 8
+
 
 class PoseEstimator:
     config: Config
 
+    # Field corner points (in OpenCV coordinates), rotation matrix and translation of each tag in the layout, rebuilt
+    # when the layout or tag size changes
+    _layout_cache: Dict[int, Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.float64]]]
+    _cached_layout: Optional[Dict[int, Pose3d]] = None
+    _cached_tag_size: float = 0.0
+
     def __init__(self, config: Config):
         self.config = config
+        self._layout_cache = {}
 
-    def solve_camera_pose(self, observed_tags: Sequence[FiducialTagDetection]) -> tuple[Optional[CameraPoseEstimate],
-                                                                                        Sequence[TrackedTarget]]:
+    def solve_camera_pose(self, result: PipelineResult):
+        # Solves the camera pose and the targets in the tag layout from the detections in result
         if (not self.config.has_tag_layout()
                 or not self.config.has_calibration()
                 or len(self.config.fiducial.tag_layout) == 0
-                or len(observed_tags) == 0):
-            return None, []
-
-        if len(observed_tags) == 1:
-            # Single tag visible, use IPPE_SQUARE
-            if observed_tags[0].id not in self.config.fiducial.tag_layout:
-                return None, []
+                or result.num_tags == 0):
+            return
 
-            object_points = self._get_single_tag_object_pts()
-            image_points = observed_tags[0].corners
+        layout = self._get_layout_cache()
+        tag_ids = result.tag_ids[:result.num_tags].tolist()
+        indices = [i for i, tag_id in enumerate(tag_ids) if tag_id in layout]
+        if len(indices) == 0:
+            return
 
+        if len(indices) == 1:
+            # Single tag visible, use IPPE_SQUARE
+            tag_id = tag_ids[indices[0]]
             try:
-                retval, rvecs, tvecs, reproj_errors = cv2.solvePnPGeneric(object_points,
-                                                                          image_points,
+                retval, rvecs, tvecs, reproj_errors = cv2.solvePnPGeneric(self._get_single_tag_object_pts(),
+                                                                          result.tag_corners[indices[0]],
                                                                           self.config.calibration.intrinsics_matrix,
                                                                           self.config.calibration.distortion_coeffs,
                                                                           flags=cv2.SOLVEPNP_IPPE_SQUARE)
             except cv2.error as e:
                 logger.error(f"Error in SOLVEPNP_IPPE_SQUARE, no solution will be returned: {e}")
-                return None, []
-
-            tag_pose = self.config.fiducial.tag_layout[observed_tags[0].id]
-            camera_pose = tag_pose.transformBy(
-                Transform3d(from_opencv_translation(tvecs[0]), from_opencv_rotation(rvecs[0])).inverse())
-            camera_pose_alt = tag_pose.transformBy(
-                Transform3d(from_opencv_translation(tvecs[0]), from_opencv_rotation(rvecs[0])).inverse())
-
-            return (CameraPoseEstimate(camera_pose, reproj_errors[0][0], camera_pose_alt, reproj_errors[1][0]),
-                    [TrackedTarget(observed_tags[0].id,
-                                   tag_pose - camera_pose,
-                                   reproj_errors[0][0],
-                                   tag_pose - camera_pose_alt,
-                                   reproj_errors[1][0])])
+                return
+
+            # Camera to tag transforms for both solutions, and the camera poses they imply
+            rotation_mats = from_opencv_rotation_matrices(np.array([cv2.Rodrigues(rvec)[0] for rvec in rvecs]))
+            translations = from_opencv_translations(np.array(tvecs).reshape(-1, 3))
+            errors = np.array(reproj_errors).reshape(-1)
+            _, tag_rotation, tag_translation = layout[tag_id]
+            camera_rotations = tag_rotation @ rotation_mats.swapaxes(-1, -2)
+            camera_translations = tag_translation - (camera_rotations @ translations[..., np.newaxis])[..., 0]
+
+            to_pose_vectors(camera_rotations, camera_translations, out=result.camera_pose)
+            result.camera_pose_errors[:] = errors
+            result.has_pose_estimate = True
+            self._add_targets(result, [tag_id], rotation_mats[np.newaxis], translations[np.newaxis], errors[np.newaxis])
         else:
             # Do multi-tag estimation
-            object_points = []
-            image_points = []
-            for tag in observed_tags:
-                if tag.id not in self.config.fiducial.tag_layout or len(tag.corners) != 4:
-                    continue
-
-                object_points += self._get_multi_tag_object_pts(tag)
-                image_points += [[tag.corners[0][0], tag.corners[0][1]],
-                                 [tag.corners[1][0], tag.corners[1][1]],
-                                 [tag.corners[2][0], tag.corners[2][1]],
-                                 [tag.corners[3][0], tag.corners[3][1]]]
-
-            if len(object_points) == 0:
-                return None, []
+            object_points = np.concatenate([layout[tag_ids[i]][0] for i in indices])
+            image_points = result.tag_corners[indices].reshape(-1, 2)
 
             try:
-                retval, rvecs, tvecs, reproj_errors = cv2.solvePnPGeneric(np.array(object_points),
-                                                                          np.array(image_points),
+                retval, rvecs, tvecs, reproj_errors = cv2.solvePnPGeneric(object_points,
+                                                                          image_points,
                                                                           self.config.calibration.intrinsics_matrix,
                                                                           self.config.calibration.distortion_coeffs,
                                                                           flags=cv2.SOLVEPNP_SQPNP)
             except cv2.error as e:
                 logger.error(f"Error in SOLVEPNP_SQPNP, no solution will be returned: {e}")
-                return None, []
-
-            camera_pose = Pose3d().transformBy(Transform3d(from_opencv_translation(tvecs[0]),
-                                                           from_opencv_rotation(rvecs[0])).inverse())
-            return (CameraPoseEstimate(camera_pose, reproj_errors[0][0]),
-                    [TrackedTarget(tag.id, self.config.fiducial.tag_layout[tag.id] - camera_pose, reproj_errors[0][0])
-                     for tag in observed_tags])
-
-    def solve_target_poses(self, observed_tags: Sequence[FiducialTagDetection]) -> Sequence[TrackedTarget]:
-        if not self.config.has_calibration or len(observed_tags) == 0:
-            return []
+                return
+
+            # Field to camera transform, inverted for the camera pose
+            field_rotation = from_opencv_rotation_matrices(cv2.Rodrigues(rvecs[0])[0])
+            field_translation = from_opencv_translations(tvecs[0].reshape(3))
+            camera_rotation = field_rotation.T
+            to_pose_vectors(camera_rotation, -camera_rotation @ field_translation, out=result.camera_pose[0])
+            result.camera_pose[1] = IDENTITY_POSE
+            result.camera_pose_errors[0] = reproj_errors[0][0]
+            result.camera_pose_errors[1] = 0.0
+            result.has_pose_estimate = True
+
+            tag_rotations = np.array([layout[tag_ids[i]][1] for i in indices])
+            tag_translations = np.array([layout[tag_ids[i]][2] for i in indices])
+            self._add_single_solution_targets(result,
+                                              [tag_ids[i] for i in indices],
+                                              field_rotation @ tag_rotations,
+                                              tag_translations @ field_rotation.T + field_translation,
+                                              reproj_errors[0][0])
+
+    def solve_target_poses(self, result: PipelineResult):
+        # Solves the camera to target transform of each detection in result
+        if not self.config.has_calibration() or result.num_tags == 0:
+            return
+
+        indices = range(result.num_tags)
+        if self.config.has_tag_layout():
+            tag_ids = result.tag_ids[:result.num_tags].tolist()
+            indices = [i for i, tag_id in enumerate(tag_ids) if tag_id in self.config.fiducial.tag_layout]
+        if len(indices) == 0:
+            return
+        if (len(indices) < BATCH_SOLVE_MIN_TAGS
+                or not supports_distortion(self.config.calibration.distortion_coeffs)):
+            self.solve_target_poses_per_tag(result, indices)
+        else:
+            self.solve_target_poses_batched(result, indices)
+
+    def solve_target_poses_batched(self, result: PipelineResult, indices: Sequence[int]):
+        if not self.config.has_calibration() or len(indices) == 0:
+            return
+
+        # A range selects a view of the detections instead of copying them
+        selected = slice(indices.start, indices.stop, indices.step) if isinstance(indices, range) else indices
+        rotation_mats, tvecs, reproj_errors, solved = solve_ippe_square_batch(
+            self._get_single_tag_object_pts(),
+            result.tag_corners[selected],
+            self.config.calibration.intrinsics_matrix,
+            self.config.calibration.distortion_coeffs)
+        if np.all(solved):
+            self._add_targets(result,
+                              result.tag_ids[selected],
+                              from_opencv_rotation_matrices(rotation_mats),
+                              from_opencv_translations(tvecs),
+                              reproj_errors)
+            return
+        self._add_targets(result,
+                          result.tag_ids[selected][solved],
+                          from_opencv_rotation_matrices(rotation_mats[solved]),
+                          from_opencv_translations(tvecs[solved]),
+                          reproj_errors[solved])
+        self.solve_target_poses_per_tag(result, np.asarray(indices)[~solved])
+
+    def solve_target_poses_per_tag(self, result: PipelineResult, indices: Sequence[int]):
+        if not self.config.has_calibration():
+            return
 
-        tracked_targets = []
         object_points = self._get_single_tag_object_pts()
-        for tag in observed_tags:
-            if self.config.has_tag_layout() and tag.id not in self.config.fiducial.tag_layout:
-                continue
+        for i in indices:
             try:
                 retval, rvecs, tvecs, reproj_errors = cv2.solvePnPGeneric(object_points,
-                                                                          tag.corners,
+                                                                          result.tag_corners[i],
                                                                           self.config.calibration.intrinsics_matrix,
                                                                           self.config.calibration.distortion_coeffs,
                                                                           flags=cv2.SOLVEPNP_IPPE_SQUARE)
             except cv2.error as e:
-                logger.error(f"Error in SOLVEPNP_IPPE_SQUARE, could not compute pose for tag {tag.id}: {e}")
+                logger.error(f"Error in SOLVEPNP_IPPE_SQUARE, could not compute pose for tag {result.tag_ids[i]}: {e}")
                 continue
-            tracked_targets.append(TrackedTarget(tag.id,
-                                                 Transform3d(from_opencv_translation(tvecs[0]),
-                                                             from_opencv_rotation(rvecs[0])),
-                                                 reproj_errors[0][0],
-                                                 Transform3d(from_opencv_translation(tvecs[1]),
-                                                             from_opencv_rotation(rvecs[1])),
-                                                 reproj_errors[1][0]))
-        return tracked_targets
+            self._add_targets(result,
+                              result.tag_ids[i:i + 1],
+                              from_opencv_rotation_matrices(np.array([[cv2.Rodrigues(rvec)[0] for rvec in rvecs]])),
+                              from_opencv_translations(np.array(tvecs).reshape(1, -1, 3)),
+                              np.array(reproj_errors).reshape(1, -1))
+
+    @staticmethod
+    def _add_targets(result: PipelineResult,
+                     tag_ids: Sequence[int],
+                     rotation_mats: npt.NDArray[np.float64],
+                     translations: npt.NDArray[np.float64],
+                     reproj_errors: npt.NDArray[np.float64]):
+        # Appends camera to target transforms in WPILib coordinates, with shapes (N, 2, 3, 3), (N, 2, 3) and (N, 2)
+        start = result.num_targets
+        end = start + len(tag_ids)
+        result.reserve(end)
+        result.target_ids[start:end] = tag_ids
+        to_pose_vectors(rotation_mats, translations, out=result.target_poses[start:end])
+        result.target_errors[start:end] = reproj_errors
+        result.num_targets = end
+
+    @staticmethod
+    def _add_single_solution_targets(result: PipelineResult,
+                                     tag_ids: Sequence[int],
+                                     rotation_mats: npt.NDArray[np.float64],
+                                     translations: npt.NDArray[np.float64],
+                                     reproj_error: float):
+        # Appends camera to target transforms without an alternate solution, with shapes (N, 3, 3) and (N, 3)
+        start = result.num_targets
+        end = start + len(tag_ids)
+        result.reserve(end)
+        result.target_ids[start:end] = tag_ids
+        to_pose_vectors(rotation_mats, translations, out=result.target_poses[start:end, 0])
+        result.target_poses[start:end, 1] = IDENTITY_POSE
+        result.target_errors[start:end, 0] = reproj_error
+        result.target_errors[start:end, 1] = 0.0
+        result.num_targets = end
+
+    def _get_layout_cache(self) -> Dict[int, Tuple[npt.NDArray[np.float64],
+                                                   npt.NDArray[np.float64],
+                                                   npt.NDArray[np.float64]]]:
+        if (self._cached_layout is not self.config.fiducial.tag_layout
+                or self._cached_tag_size != self.config.fiducial.tag_size_m):
+            self._layout_cache = {}
+            for tag_id, tag_pose in self.config.fiducial.tag_layout.items():
+                quaternion = tag_pose.rotation().getQuaternion()
+                self._layout_cache[tag_id] = (np.array(self._get_multi_tag_object_pts(tag_pose)),
+                                              quaternion_to_rotation_matrix(quaternion.W(),
+                                                                            quaternion.X(),
+                                                                            quaternion.Y(),
+                                                                            quaternion.Z()),
+                                              np.array([tag_pose.x, tag_pose.y, tag_pose.z]))
+            self._cached_layout = self.config.fiducial.tag_layout
+            self._cached_tag_size = self.config.fiducial.tag_size_m
+        return self._layout_cache
 
     def _get_single_tag_object_pts(self) -> npt.NDArray[np.float64]:
         return np.array([[-self.config.fiducial.tag_size_m / 2.0, self.config.fiducial.tag_size_m / 2.0, 0],
@@ -123,11 +226,6 @@ class PoseEstimator:
                          [self.config.fiducial.tag_size_m / 2.0, -self.config.fiducial.tag_size_m / 2.0, 0],
                          [-self.config.fiducial.tag_size_m / 2.0, -self.config.fiducial.tag_size_m / 2.0, 0]])
 
-    def _get_multi_tag_object_pts(self, observed_tag: FiducialTagDetection) -> Sequence[npt.NDArray[np.float64]]:
-        tag_pose = self.config.fiducial.tag_layout[observed_tag.id]
-        tag_size = self.config.fiducial.tag_size_m
-        corners = [tag_pose.transformBy(Transform3d(0, tag_size / 2.0, -tag_size / 2.0, Rotation3d())),
-                   tag_pose.transformBy(Transform3d(0, -tag_size / 2.0, -tag_size / 2.0, Rotation3d())),
-                   tag_pose.transformBy(Transform3d(0, -tag_size / 2.0, tag_size / 2.0, Rotation3d())),
-                   tag_pose.transformBy(Transform3d(0, tag_size / 2.0, tag_size / 2.0, Rotation3d()))]
-        return [to_opencv_translation(corner.translation()) for corner in corners]
+    def _get_multi_tag_object_pts(self, tag_pose: Pose3d) -> Sequence[npt.NDArray[np.float64]]:
+        return [to_opencv_translation(tag_pose.transformBy(offset).translation())
+                for offset in tag_corner_offsets(self.config.fiducial.tag_size_m)]
@@ -2,10 +2,16 @@ __all__ = [
     "Capture",
     "DefaultCapture",
     "GStreamerCapture",
+    "GstAppSinkCapture",
+    "RecordingCapture",
+    "create_gstreamer_capture",
     "CaptureFrame",
+    "FrameBuffer",
+    "FrameBufferPool",
     "FiducialDetector",
     "ArUcoFiducialDetector",
-    "FiducialTagDetection",
+    "AprilTagFiducialDetector",
+    "TiledFiducialDetector",
     "PoseEstimator",
     "CameraPoseEstimate",
     "TrackedTarget",
@@ -13,12 +19,20 @@ __all__ = [
     "PipelineResult"
 ]
 
-from .Capture import Capture, DefaultCapture, GStreamerCapture
-from .FiducialDetector import ArUcoFiducialDetector
+from .Capture import (Capture,
+                      DefaultCapture,
+                      GStreamerCapture,
+                      GstAppSinkCapture,
+                      RecordingCapture,
+                      create_gstreamer_capture)
+from .FrameBufferPool import FrameBuffer, FrameBufferPool
+from .FiducialDetector import (AprilTagFiducialDetector,
+                               ArUcoFiducialDetector,
+                               FiducialDetector,
+                               TiledFiducialDetector)
 from .PoseEstimator import PoseEstimator
 from .Pipeline import Pipeline
 from .pipeline_types import (CaptureFrame,
-                             FiducialTagDetection,
                              CameraPoseEstimate,
                              PipelineResult,
                              TrackedTarget)
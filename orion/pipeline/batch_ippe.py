@@ -0,0 +1,198 @@
+from typing import Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+# Distortion models that project_points can evaluate (none, k1-k2 + p1-p2, + k3, + rational k4-k6)
+SUPPORTED_DISTORTION_COEFFS = (0, 4, 5, 8)
+
+
+def supports_distortion(distortion_coeffs: npt.NDArray[np.float64]) -> bool:
+    return distortion_coeffs is None or distortion_coeffs.size in SUPPORTED_DISTORTION_COEFFS
+
+
+def project_points(camera_points: npt.NDArray[np.float64],
+                   intrinsics_matrix: npt.NDArray[np.float64],
+                   distortion_coeffs: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # Same model as cv2.projectPoints, for points already in camera coordinates with shape (..., 3). The polynomials
+    # are evaluated in Horner form, and the projection reuses the array of normalized points.
+    k = [0.0] * 8
+    if distortion_coeffs is not None:
+        k[:distortion_coeffs.size] = distortion_coeffs.ravel().tolist()
+    projected = camera_points[..., :2] / camera_points[..., 2:]
+    x = projected[..., 0]
+    y = projected[..., 1]
+    r2 = x * x + y * y
+    radial = ((k[4] * r2 + k[1]) * r2 + k[0]) * r2 + 1
+    if k[5] != 0.0 or k[6] != 0.0 or k[7] != 0.0:
+        radial /= ((k[7] * r2 + k[6]) * r2 + k[5]) * r2 + 1
+    xy2 = 2 * x * y
+    x_distorted = x * radial + k[2] * xy2 + k[3] * (r2 + 2 * x * x)
+    y_distorted = y * radial + k[2] * (r2 + 2 * y * y) + k[3] * xy2
+    projected[..., 0] = (intrinsics_matrix[0, 0] * x_distorted
+                         + intrinsics_matrix[0, 1] * y_distorted
+                         + intrinsics_matrix[0, 2])
+    projected[..., 1] = intrinsics_matrix[1, 1] * y_distorted + intrinsics_matrix[1, 2]
+    return projected
+
+
+def _square_homographies(object_points: npt.NDArray[np.float64],
+                         normalized_points: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # Closed form homographies from the square object points to each tag's corners (Heckbert, 1989), like OpenCV's
+    # IPPE::PoseSolver::homographyFromSquarePoints, normalized so h22 = 1. This avoids solving an 8x8 system per tag.
+    x0, x1, x2, x3 = (normalized_points[:, i, 0] for i in range(4))
+    y0, y1, y2, y3 = (normalized_points[:, i, 1] for i in range(4))
+    dx1 = x1 - x2
+    dx2 = x3 - x2
+    dx3 = x0 - x1 + x2 - x3
+    dy1 = y1 - y2
+    dy2 = y3 - y2
+    dy3 = y0 - y1 + y2 - y3
+    det = dx1 * dy2 - dx2 * dy1
+    g = (dx3 * dy2 - dx2 * dy3) / det
+    h = (dx1 * dy3 - dx3 * dy1) / det
+
+    # The unit square to quad mapping composed with the mapping of the object points (-s, s), (s, s), (s, -s), (-s, -s)
+    # to the unit square corners (0, 0), (1, 0), (1, 1), (0, 1)
+    scale = 0.5 / object_points[1, 0]
+    homographies = np.empty((len(normalized_points), 3, 3))
+    homographies[:, 0, 0] = (x1 - x0 + g * x1) * scale
+    homographies[:, 0, 1] = -(x3 - x0 + h * x3) * scale
+    homographies[:, 0, 2] = 0.5 * (x1 + x3 + g * x1 + h * x3)
+    homographies[:, 1, 0] = (y1 - y0 + g * y1) * scale
+    homographies[:, 1, 1] = -(y3 - y0 + h * y3) * scale
+    homographies[:, 1, 2] = 0.5 * (y1 + y3 + g * y1 + h * y3)
+    homographies[:, 2, 0] = g * scale
+    homographies[:, 2, 1] = -h * scale
+    homographies[:, 2, 2] = 0.5 * (g + h) + 1
+    homographies /= homographies[:, 2:, 2:]
+    return homographies
+
+
+def _ippe_rotations(homographies: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # IPPE (Collins & Bartoli, 2014), following OpenCV's IPPE::PoseSolver::computeRotations. Returns both rotation
+    # solutions for each homography, with shape (N, 2, 3, 3). Works on stacked 2x2 blocks rather than one array per
+    # matrix element, which keeps the number of temporaries small.
+    n = len(homographies)
+    center = homographies[:, :2, 2]
+    # Jacobian of the homography at the tag center
+    jacobian = homographies[:, :2, :2] - center[:, :, np.newaxis] * homographies[:, np.newaxis, 2, :2]
+
+    # Rotation that takes the camera's principal axis to the direction of the tag center
+    norm = np.sqrt(1 + np.sum(center * center, axis=1))
+    axis = center / norm[:, np.newaxis]
+    d = 1.0 / (1.0 + 1.0 / norm)
+    rv = np.empty((n, 1, 3, 3))
+    rv[:, 0, :2, :2] = -d[:, np.newaxis, np.newaxis] * axis[:, :, np.newaxis] * axis[:, np.newaxis, :]
+    rv[:, 0, 0, 0] += 1
+    rv[:, 0, 1, 1] += 1
+    rv[:, 0, :2, 2] = axis
+    rv[:, 0, 2, :2] = -axis
+    rv[:, 0, 2, 2] = 1 - np.sum(axis * axis, axis=1) * d
+
+    # A = B^-1 J, with the 2x2 inverse written out so a singular B only fails its own tag
+    b = rv[:, 0, :2, :2] + center[:, :, np.newaxis] * axis[:, np.newaxis, :]
+    adjugate = np.empty((n, 2, 2))
+    adjugate[:, 0, 0] = b[:, 1, 1]
+    adjugate[:, 0, 1] = -b[:, 0, 1]
+    adjugate[:, 1, 0] = -b[:, 1, 0]
+    adjugate[:, 1, 1] = b[:, 0, 0]
+    a = adjugate @ jacobian / (b[:, 0, 0] * b[:, 1, 1] - b[:, 0, 1] * b[:, 1, 0])[:, np.newaxis, np.newaxis]
+
+    # Largest singular value of A
+    aat = a @ a.swapaxes(-1, -2)
+    trace = aat[:, 0, 0] + aat[:, 1, 1]
+    gamma = np.sqrt(0.5 * (trace + np.sqrt((aat[:, 0, 0] - aat[:, 1, 1]) ** 2 + 4 * aat[:, 0, 1] ** 2)))
+    r = a / gamma[:, np.newaxis, np.newaxis]
+    # Out-of-plane components of the first two columns
+    out_of_plane = np.sqrt(np.maximum(1 - np.sum(r * r, axis=1), 0))
+    out_of_plane[:, 1] = np.where(np.sum(r[:, :, 0] * r[:, :, 1], axis=1) > 0, -out_of_plane[:, 1], out_of_plane[:, 1])
+
+    # The two solutions differ by the sign of the out-of-plane components, the third column is the cross product of
+    # the first two
+    rotation_tilde = np.empty((n, 2, 3, 3))
+    rotation_tilde[:, :, :2, :2] = r[:, np.newaxis]
+    rotation_tilde[:, :, 2, 2] = (r[:, 0, 0] * r[:, 1, 1] - r[:, 0, 1] * r[:, 1, 0])[:, np.newaxis]
+    rotation_tilde[:, 0, 0, 2] = r[:, 1, 0] * out_of_plane[:, 1] - out_of_plane[:, 0] * r[:, 1, 1]
+    rotation_tilde[:, 0, 1, 2] = out_of_plane[:, 0] * r[:, 0, 1] - r[:, 0, 0] * out_of_plane[:, 1]
+    rotation_tilde[:, 0, 2, :2] = out_of_plane
+    rotation_tilde[:, 1, :2, 2] = -rotation_tilde[:, 0, :2, 2]
+    rotation_tilde[:, 1, 2, :2] = -out_of_plane
+    return rv @ rotation_tilde
+
+
+def _translations(object_points: npt.NDArray[np.float64],
+                  normalized_points: npt.NDArray[np.float64],
+                  rotations: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # Least squares for t in u * (r3 . X + tz) = r1 . X + tx, v * (r3 . X + tz) = r2 . X + ty. The normal matrix only
+    # depends on the image points, so it is shared by both rotation solutions.
+    u = normalized_points[:, np.newaxis, :, 0]
+    v = normalized_points[:, np.newaxis, :, 1]
+    sum_u = u.sum(axis=-1)[:, 0]
+    sum_v = v.sum(axis=-1)[:, 0]
+    num_points = object_points.shape[0]
+    normal = np.zeros((len(normalized_points), 3, 3))
+    normal[:, 0, 0] = num_points
+    normal[:, 1, 1] = num_points
+    normal[:, 0, 2] = normal[:, 2, 0] = -sum_u
+    normal[:, 1, 2] = normal[:, 2, 1] = -sum_v
+    normal[:, 2, 2] = (u * u + v * v).sum(axis=-1)[:, 0]
+
+    rotated = rotations @ object_points.T
+    bx = u * rotated[..., 2, :] - rotated[..., 0, :]
+    by = v * rotated[..., 2, :] - rotated[..., 1, :]
+    rhs = np.empty(rotations.shape[:-2] + (3,))
+    rhs[..., 0] = bx.sum(axis=-1)
+    rhs[..., 1] = by.sum(axis=-1)
+    rhs[..., 2] = -(u * bx + v * by).sum(axis=-1)
+    return (np.linalg.inv(normal)[:, np.newaxis] @ rhs[..., np.newaxis])[..., 0]
+
+
+def _reprojection_errors(object_points: npt.NDArray[np.float64],
+                         image_points: npt.NDArray[np.float64],
+                         rotations: npt.NDArray[np.float64],
+                         translations: npt.NDArray[np.float64],
+                         intrinsics_matrix: npt.NDArray[np.float64],
+                         distortion_coeffs: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    # RMS error per coordinate, as reported by cv2.solvePnPGeneric
+    camera_points = object_points @ rotations.swapaxes(-1, -2)
+    camera_points += translations[..., np.newaxis, :]
+    residuals = project_points(camera_points, intrinsics_matrix, distortion_coeffs)
+    residuals -= image_points[:, np.newaxis]
+    residuals *= residuals
+    return np.sqrt(np.mean(residuals, axis=(-2, -1)))
+
+
+def solve_ippe_square_batch(object_points: npt.NDArray[np.float64],
+                            image_points: npt.NDArray[np.float64],
+                            intrinsics_matrix: npt.NDArray[np.float64],
+                            distortion_coeffs: npt.NDArray[np.float64]) -> Tuple[npt.NDArray[np.float64],
+                                                                                 npt.NDArray[np.float64],
+                                                                                 npt.NDArray[np.float64],
+                                                                                 npt.NDArray[np.bool_]]:
+    # Batched equivalent of cv2.solvePnPGeneric(..., flags=cv2.SOLVEPNP_IPPE_SQUARE) for N tags that share the same
+    # square object points (4, 3) in the order IPPE_SQUARE expects, with image points of shape (N, 4, 2). Returns
+    # rotation matrices (N, 2, 3, 3), translations (N, 2, 3) and reprojection errors (N, 2) with the lower-error
+    # solution first, and a mask of the tags that were solved successfully.
+    n = image_points.shape[0]
+    normalized_points = cv2.undistortPoints(image_points.reshape(-1, 1, 2),
+                                            intrinsics_matrix,
+                                            distortion_coeffs).reshape(n, 4, 2)
+
+    # Degenerate corners give non-finite homographies or make the translation systems singular. Non-finite results only
+    # mark their own tag as unsolved, a singular system marks every tag in the batch.
+    with np.errstate(all="ignore"):
+        try:
+            rotations = _ippe_rotations(_square_homographies(object_points, normalized_points))
+            translations = _translations(object_points, normalized_points, rotations)
+        except np.linalg.LinAlgError:
+            return np.zeros((n, 2, 3, 3)), np.zeros((n, 2, 3)), np.zeros((n, 2)), np.zeros(n, dtype=bool)
+        errors = _reprojection_errors(object_points, image_points, rotations, translations,
+                                      intrinsics_matrix, distortion_coeffs)
+
+    # Put the lower-error solution first by swapping the pairs in place
+    swap = np.flatnonzero(errors[:, 1] < errors[:, 0])
+    for solutions in (rotations, translations, errors):
+        solutions[swap] = solutions[swap, ::-1]
+    return rotations, translations, errors, np.all(np.isfinite(errors), axis=1)
@@ -0,0 +1,48 @@
+from typing import Dict, Mapping, Optional
+
+from ..config import CameraConfig
+
+# Capture pipeline templates. Each template is formatted with a source element ({source}, see gstreamer_source) and the
+# requested resolution ({width}, {height}). Templates that use elements missing on the current device will fail to open,
+# and GStreamerCapture will move on to the next template in the configured chain.
+GSTREAMER_TEMPLATES: Dict[str, str] = {
+    "mjpeg_jpegdec": ("{source} ! image/jpeg,format=MJPG,width={width},height={height} "
+                      "! jpegdec ! videoconvert ! appsink drop=1"),
+    "mjpeg_jpegdec_leaky": ("{source} ! image/jpeg,format=MJPG,width={width},height={height} "
+                            "! queue leaky=downstream max-size-buffers=1 "
+                            "! jpegdec ! videoconvert ! appsink drop=1 max-buffers=1 sync=false"),
+    "mjpeg_mppjpegdec": ("{source} ! image/jpeg,format=MJPG,width={width},height={height} "
+                         "! mppjpegdec ! videoconvert ! appsink drop=1 max-buffers=1 sync=false"),
+    "mjpeg_v4l2jpegdec": ("{source} ! image/jpeg,format=MJPG,width={width},height={height} "
+                          "! v4l2jpegdec ! videoconvert ! appsink drop=1 max-buffers=1 sync=false"),
+    "yuyv": ("{source} ! video/x-raw,format=YUY2,width={width},height={height} "
+             "! videoconvert ! appsink drop=1 max-buffers=1 sync=false"),
+    "grey": ("{source} ! video/x-raw,format=GRAY8,width={width},height={height} "
+             "! appsink drop=1 max-buffers=1 sync=false")
+}
+
+
+def gstreamer_source(camera: CameraConfig) -> str:
+    device = f"/dev/video{camera.id}" if type(camera.id) is int else camera.id
+    controls = (f"c,auto_exposure={camera.auto_exposure},"
+                f"exposure_time_absolute={camera.exposure},"
+                f"gain={camera.gain},"
+                f"brightness={camera.brightness}")
+    return f'v4l2src device="{device}" extra_controls="{controls}"'
+
+
+def test_source(template: str) -> str:
+    # videotestsrc only produces raw video, so compressed templates need an encoder in front of their caps
+    if "image/jpeg" in template:
+        return "videotestsrc is-live=false pattern=smpte ! jpegenc"
+    return "videotestsrc is-live=false pattern=smpte"
+
+
+def build_gstreamer_pipeline(template: str, source: str, width: int, height: int) -> str:
+    return template.format(source=source, width=width, height=height)
+
+
+def resolve_template(name: str, custom_templates: Mapping[str, str]) -> Optional[str]:
+    if name in custom_templates:
+        return custom_templates[name]
+    return GSTREAMER_TEMPLATES.get(name)
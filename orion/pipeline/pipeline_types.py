@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Sequence, Optional
+from typing import Optional, Sequence
 
 import cv2
 import numpy as np
@@ -7,6 +7,8 @@ from numpy import typing as npt
 from wpimath.geometry import Pose3d, Transform3d
 from wpiutil.wpistruct import make_wpistruct
 
+from .FrameBufferPool import FrameBuffer
+
 
 @dataclass(frozen=True)
 class CaptureFrame:
@@ -14,12 +16,17 @@ class CaptureFrame:
     timestamp_ns: int
     resolution_height: int
     resolution_width: int
+    # Pooled buffer backing image, if any. The image must not be used after the frame is released.
+    buffer: Optional[FrameBuffer] = None
 
+    def retain(self) -> "CaptureFrame":
+        if self.buffer is not None:
+            self.buffer.retain()
+        return self
 
-@dataclass(frozen=True)
-class FiducialTagDetection:
-    id: int
-    corners: npt.NDArray[np.float64]
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.release()
 
 
 @make_wpistruct(name="TrackedTarget")
@@ -49,12 +56,116 @@ class CameraPoseEstimate:
         self.has_alt = self.pose_alt != Pose3d() and self.reproj_error_alt != 0.0
 
 
-@dataclass(frozen=True)
+# Poses are stored as (x, y, z, qw, qx, qy, qz) in WPILib coordinates
+POSE_SIZE = 7
+IDENTITY_POSE = np.array([0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0])
+INITIAL_TAG_CAPACITY = 32
+
+
 class PipelineResult:
+    # The pipeline reuses one result with preallocated buffers across frames to avoid creating garbage every frame, so
+    # a result is only valid until the next frame is processed (use copy_from to keep it). Only the first num_tags
+    # detections and num_targets targets are valid. Alternate solutions are stored at index 1 of the pose and error
+    # arrays, with an error of 0 if there isn't one. Poses are packed into the byte layouts of the WPILib struct types
+    # TrackedTarget and CameraPoseEstimate when publishing.
+    __slots__ = ("capture_timestamp_ns",
+                 "process_dt_ns",
+                 "num_tags",
+                 "tag_ids",
+                 "tag_corners",
+                 "num_targets",
+                 "target_ids",
+                 "target_poses",
+                 "target_errors",
+                 "has_pose_estimate",
+                 "camera_pose",
+                 "camera_pose_errors")
+
     capture_timestamp_ns: int
     process_dt_ns: int
-    processed_image: cv2.Mat
 
-    seen_tag_ids: Sequence[int]
-    tracked_targets: Sequence[TrackedTarget]
-    pose_estimate: Optional[CameraPoseEstimate]
+    num_tags: int
+    tag_ids: npt.NDArray[np.int64]
+    tag_corners: npt.NDArray[np.float64]
+
+    num_targets: int
+    target_ids: npt.NDArray[np.int64]
+    target_poses: npt.NDArray[np.float64]
+    target_errors: npt.NDArray[np.float64]
+
+    has_pose_estimate: bool
+    camera_pose: npt.NDArray[np.float64]
+    camera_pose_errors: npt.NDArray[np.float64]
+
+    def __init__(self, capacity: int = INITIAL_TAG_CAPACITY):
+        self.capture_timestamp_ns = 0
+        self.process_dt_ns = 0
+        self.num_tags = 0
+        self.tag_ids = np.zeros(capacity, dtype=np.int64)
+        self.tag_corners = np.zeros((capacity, 4, 2))
+        self.num_targets = 0
+        self.target_ids = np.zeros(capacity, dtype=np.int64)
+        self.target_poses = np.tile(IDENTITY_POSE, (capacity, 2, 1))
+        self.target_errors = np.zeros((capacity, 2))
+        self.has_pose_estimate = False
+        self.camera_pose = np.tile(IDENTITY_POSE, (2, 1))
+        self.camera_pose_errors = np.zeros(2)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.tag_ids)
+
+    @property
+    def seen_tag_ids(self) -> npt.NDArray[np.int64]:
+        return self.tag_ids[:self.num_tags]
+
+    def reserve(self, capacity: int):
+        # Buffers only grow, so allocation stops once the largest number of tags has been seen
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity)
+        grown = PipelineResult(new_capacity)
+        grown.copy_from(self)
+        for name in ("tag_ids", "tag_corners", "target_ids", "target_poses", "target_errors"):
+            setattr(self, name, getattr(grown, name))
+
+    def reset(self, capture_timestamp_ns: int):
+        self.capture_timestamp_ns = capture_timestamp_ns
+        self.process_dt_ns = 0
+        self.num_tags = 0
+        self.num_targets = 0
+        self.has_pose_estimate = False
+
+    def set_detections(self, ids: Optional[npt.NDArray[np.int32]], corners: Sequence[npt.NDArray[np.float32]]):
+        # Takes ids (N, 1) and corners as a sequence of (1, 4, 2) arrays, as returned by the fiducial detectors
+        num_tags = 0 if ids is None else len(ids)
+        self.reserve(num_tags)
+        self.num_tags = num_tags
+        if num_tags > 0:
+            self.tag_ids[:num_tags] = ids[:, 0]
+            np.concatenate(corners, axis=0, out=self.tag_corners[:num_tags])
+
+    def retain_tags(self, keep: npt.NDArray[np.bool_]):
+        # Drops the detections that aren't marked to keep, preserving order. Nothing is copied if all are kept, which
+        # is the usual case when the detector only decodes layout IDs.
+        if np.all(keep):
+            return
+        kept = np.flatnonzero(keep)
+        self.tag_ids[:len(kept)] = self.tag_ids[kept]
+        self.tag_corners[:len(kept)] = self.tag_corners[kept]
+        self.num_tags = len(kept)
+
+    def copy_from(self, other: "PipelineResult"):
+        self.reserve(max(other.num_tags, other.num_targets))
+        self.capture_timestamp_ns = other.capture_timestamp_ns
+        self.process_dt_ns = other.process_dt_ns
+        self.num_tags = other.num_tags
+        self.tag_ids[:other.num_tags] = other.tag_ids[:other.num_tags]
+        self.tag_corners[:other.num_tags] = other.tag_corners[:other.num_tags]
+        self.num_targets = other.num_targets
+        self.target_ids[:other.num_targets] = other.target_ids[:other.num_targets]
+        self.target_poses[:other.num_targets] = other.target_poses[:other.num_targets]
+        self.target_errors[:other.num_targets] = other.target_errors[:other.num_targets]
+        self.has_pose_estimate = other.has_pose_estimate
+        self.camera_pose[:] = other.camera_pose
+        self.camera_pose_errors[:] = other.camera_pose_errors
@@ -0,0 +1,178 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import cv2
+import ntcore
+
+from ..config import Config, RoleSchedule
+
+logger = logging.getLogger(__name__)
+
+ROLES = ("capture", "vision", "stream", "nt")
+TASK_DIR = "/proc/self/task"
+
+
+def _thread_ids() -> Set[int]:
+    try:
+        return {int(tid) for tid in os.listdir(TASK_DIR)}
+    except OSError:
+        return set()
+
+
+def _read_thread_stat(tid: int) -> Optional[Tuple[str, int, int]]:
+    # Returns the thread's name, CPU time in clock ticks and the CPU it last ran on
+    try:
+        with open(f"{TASK_DIR}/{tid}/stat") as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+    # The name is in parentheses and may contain spaces, the remaining fields start after it
+    name = stat[stat.index("(") + 1:stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2:].split()
+    return name, int(fields[11]) + int(fields[12]), int(fields[36])
+
+
+class ThreadScheduler:
+    # Pins the threads of each role (capture, vision, stream and NT) to a set of CPUs and applies their priorities,
+    # and reports the CPU usage of every thread in the process. Threads inherit the affinity of the thread
+    # that creates them, so threads started by native libraries are scheduled by creating them inside spawning().
+    _config: Config
+    _nt_instance: ntcore.NetworkTableInstance
+
+    _roles_by_tid: Dict[int, str]
+    _lock: threading.Lock
+    _supported: bool
+
+    _last_report_s: float = 0.0
+    _last_cpu_ticks: Dict[int, int]
+    _clock_ticks: int
+
+    _nt_initialized: bool = False
+    _names_pub: ntcore.StringArrayPublisher
+    _cpu_percent_pub: ntcore.DoubleArrayPublisher
+    _last_cpu_pub: ntcore.IntegerArrayPublisher
+
+    def __init__(self, config: Config, nt_instance: Optional[ntcore.NetworkTableInstance] = None):
+        self._config = config
+        self._nt_instance = nt_instance if nt_instance is not None else ntcore.NetworkTableInstance.getDefault()
+        self._roles_by_tid = {}
+        self._lock = threading.Lock()
+        self._last_cpu_ticks = {}
+        self._supported = hasattr(os, "sched_setaffinity") and os.path.isdir(TASK_DIR)
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        for role in config.scheduling.roles:
+            if role not in ROLES:
+                logger.warning(f'Unknown scheduling role "{role}", expected one of {", ".join(ROLES)}')
+
+    def apply(self, role: str, tid: Optional[int] = None):
+        # Schedules a thread (the calling thread by default) with the settings of a role
+        tid = tid if tid is not None else threading.get_native_id()
+        with self._lock:
+            self._roles_by_tid[tid] = role
+        if role == "vision" and self._config.scheduling.opencv_threads >= 0:
+            # OpenCV's worker threads are created by the vision thread, so they share its CPUs
+            cv2.setNumThreads(self._config.scheduling.opencv_threads)
+        schedule = self._config.scheduling.roles.get(role)
+        if schedule is not None and self._supported:
+            self._apply_schedule(schedule, tid, role)
+
+    def register(self, role: str):
+        # Labels the calling thread with a role for reporting, for threads that already inherited its schedule
+        with self._lock:
+            self._roles_by_tid[threading.get_native_id()] = role
+
+    @contextlib.contextmanager
+    def spawning(self, role: str) -> Iterator[None]:
+        # Threads created inside the block get the role's schedule. Only the calling thread's affinity is changed
+        # temporarily, since lowering priority again needs CAP_SYS_NICE. Priorities are applied to the new threads
+        # afterwards.
+        schedule = self._config.scheduling.roles.get(role)
+        if schedule is None or not self._supported:
+            yield
+            return
+        existing_threads = _thread_ids()
+        previous_cpus = os.sched_getaffinity(0)
+        if len(schedule.cpus) > 0:
+            try:
+                os.sched_setaffinity(0, schedule.cpus)
+            except OSError as e:
+                logger.warning(f"Failed to pin {role} threads to CPUs {schedule.cpus}: {e}")
+        try:
+            yield
+        finally:
+            try:
+                os.sched_setaffinity(0, previous_cpus)
+            except OSError as e:
+                logger.error(f"Failed to restore the CPUs of thread {threading.get_native_id()} after starting "
+                             f"{role} threads: {e}")
+            for new_tid in _thread_ids() - existing_threads:
+                self.apply(role, new_tid)
+
+    def report(self):
+        # Publishes the CPU usage of each thread since the last report, rate limited to report_interval_s
+        now_s = time.monotonic()
+        interval_s = now_s - self._last_report_s
+        if interval_s < self._config.scheduling.report_interval_s or not self._supported:
+            return
+        if not self._nt_initialized:
+            self._init_nt()
+        self._last_report_s = now_s
+
+        python_names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        names = []
+        cpu_percent = []
+        last_cpus = []
+        cpu_ticks = {}
+        for tid in sorted(_thread_ids()):
+            stat = self._read_stat(tid)
+            if stat is None:
+                continue
+            name, ticks, last_cpu = stat
+            cpu_ticks[tid] = ticks
+            if tid not in self._last_cpu_ticks:
+                continue
+            role = self._roles_by_tid.get(tid)
+            name = python_names.get(tid, name)
+            names.append(f"{name} [{role}]" if role is not None else name)
+            cpu_percent.append((ticks - self._last_cpu_ticks[tid]) / self._clock_ticks / interval_s * 100)
+            last_cpus.append(last_cpu)
+        self._last_cpu_ticks = cpu_ticks
+        with self._lock:
+            self._roles_by_tid = {tid: role for tid, role in self._roles_by_tid.items() if tid in cpu_ticks}
+
+        self._names_pub.set(names)
+        self._cpu_percent_pub.set(cpu_percent)
+        self._last_cpu_pub.set(last_cpus)
+
+    @staticmethod
+    def _read_stat(tid: int) -> Optional[Tuple[str, int, int]]:
+        try:
+            return _read_thread_stat(tid)
+        except (ValueError, IndexError):
+            return None
+
+    def _apply_schedule(self, schedule: RoleSchedule, tid: int, role: str):
+        try:
+            if len(schedule.cpus) > 0:
+                os.sched_setaffinity(tid, schedule.cpus)
+        except OSError as e:
+            logger.warning(f"Failed to pin {role} thread {tid} to CPUs {schedule.cpus}: {e}")
+        try:
+            if schedule.realtime_priority > 0:
+                os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(schedule.realtime_priority))
+            elif schedule.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, schedule.nice)
+        except OSError as e:
+            # Real-time priorities and negative nice values need root or CAP_SYS_NICE
+            logger.warning(f"Failed to set the priority of {role} thread {tid}: {e}")
+
+    def _init_nt(self):
+        table = self._nt_instance.getTable(f"orion/{self._config.network.device_id}/threads")
+        self._names_pub = table.getStringArrayTopic("names").publish()
+        self._cpu_percent_pub = table.getDoubleArrayTopic("cpu_percent").publish()
+        self._last_cpu_pub = table.getIntegerArrayTopic("last_cpu").publish()
+        self._nt_initialized = True
@@ -0,0 +1,5 @@
+__all__ = [
+    "ThreadScheduler"
+]
+
+from .ThreadScheduler import ThreadScheduler
@@ -0,0 +1,29 @@
+__all__ = [
+    "run_allocation_benchmark",
+    "run_capture_probe",
+    "run_detector_benchmark",
+    "run_fusion_check",
+    "run_layout_filter_benchmark",
+    "run_nt_load_test",
+    "run_offline_calibration",
+    "run_pose_benchmark",
+    "run_regression_benchmark",
+    "run_replay",
+    "tune_detector",
+    "generate_synthetic_frames",
+    "load_image_frames",
+    "reference_labels",
+    "LabeledFrame"
+]
+
+from .allocation_benchmark import run_allocation_benchmark
+from .capture_probe import run_capture_probe
+from .detector_benchmark import run_detector_benchmark, run_layout_filter_benchmark
+from .fusion_check import run_fusion_check
+from .nt_load_test import run_nt_load_test
+from .offline_calibration import run_offline_calibration
+from .pose_benchmark import run_pose_benchmark
+from .regression_benchmark import run_regression_benchmark
+from .replay import run_replay
+from .detector_tuner import tune_detector, reference_labels
+from .synthetic_frames import LabeledFrame, generate_synthetic_frames, load_image_frames
@@ -0,0 +1,203 @@
+import gc
+import linecache
+import logging
+import os.path
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import ntcore
+import numpy as np
+from wpimath.geometry import Pose3d, Rotation3d, Translation3d
+
+from ..config import Config
+from ..output import NTOutputPublisher
+from ..pipeline import ArUcoFiducialDetector, CaptureFrame, FiducialDetector, Pipeline
+from .pose_benchmark import synthetic_calibration
+from .synthetic_frames import LabeledFrame
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass(frozen=True)
+class LineAllocation:
+    file_name: str
+    line_number: int
+    kb_per_frame: float
+
+
+@dataclass(frozen=True)
+class AllocationBenchmarkResult:
+    name: str
+    frames: int
+    ms_per_frame: float
+    kb_per_frame: float
+    gc_collections: int
+    gc_pause_ms: float
+    gc_max_pause_ms: float
+    # Lines of Orion code with the most transient allocations, largest first
+    lines: Tuple[LineAllocation, ...] = ()
+
+
+class _PrecomputedDetector(FiducialDetector):
+    # Replays detections of each frame, so the benchmark measures everything after detection
+
+    def __init__(self, detections: Sequence[tuple]):
+        self._detections = detections
+        self._index = 0
+
+    def detect_fiducials(self, frame: CaptureFrame) -> tuple:
+        detections = self._detections[self._index % len(self._detections)]
+        self._index += 1
+        return detections
+
+
+def synthetic_tag_layout(tag_ids: Sequence[int]) -> dict:
+    return {int(tag_id): Pose3d(Translation3d(0.5 * tag_id, 2.0, 0.5), Rotation3d(0.0, 0.0, np.pi))
+            for tag_id in tag_ids}
+
+
+def allocations_by_line(run_frame: Callable[[int], None], iterations: int) -> List[LineAllocation]:
+    # Attributes the peak traced memory above the start of each line of Orion code to the innermost such line that is
+    # running. A line that calls into Orion code counts its own allocations and what the callee still holds when it
+    # returns. Lines are ordered by their sum over all frames.
+    line_bytes: Dict[Tuple[str, int], int] = {}
+    # File name, line number and traced memory at the start of the running line of each frame, reused so the tracer
+    # allocates as little as possible
+    running_lines: Dict[int, list] = {}
+
+    def trace_line(frame, event, _):
+        if event != "line" and event != "return":
+            return trace_line
+        _, peak = tracemalloc.get_traced_memory()
+        running = running_lines.get(id(frame))
+        if running is not None:
+            key = (running[0], running[1])
+            line_bytes[key] = line_bytes.get(key, 0) + peak - running[2]
+        if event == "return":
+            running_lines.pop(id(frame), None)
+        else:
+            if running is None:
+                running = running_lines[id(frame)] = [None, 0, 0]
+            running[0] = frame.f_code.co_filename
+            running[1] = frame.f_lineno
+        tracemalloc.reset_peak()
+        if running is not None:
+            running[2] = tracemalloc.get_traced_memory()[0]
+        return trace_line
+
+    def trace_call(frame, event, _):
+        if frame.f_code.co_filename.startswith(PACKAGE_DIR) and frame.f_code.co_filename != __file__:
+            return trace_line
+        return None
+
+    tracemalloc.start()
+    sys.settrace(trace_call)
+    try:
+        for i in range(iterations):
+            run_frame(i)
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+    lines = sorted(line_bytes.items(), key=lambda item: item[1], reverse=True)
+    return [LineAllocation(file_name, line_number, total / iterations / 1024)
+            for (file_name, line_number), total in lines]
+
+
+def benchmark_allocations(name: str,
+                          config: Config,
+                          frames: Sequence[LabeledFrame],
+                          iterations: int,
+                          top_lines: int = 0) -> AllocationBenchmarkResult:
+    pipeline = Pipeline(config)
+    output = NTOutputPublisher(config)
+    images = [frame.image.copy() for frame in frames]
+    detector = ArUcoFiducialDetector(config)
+    pipeline._fiducial_detector = _PrecomputedDetector([detector.detect_fiducials(CaptureFrame(image, 0, 0, 0))
+                                                        for image in images])
+
+    def run_frame(i: int):
+        image = images[i % len(images)]
+        result = pipeline.process_frame(CaptureFrame(image, time.monotonic_ns(), image.shape[0], image.shape[1]))
+        output.publish(result, 0, i)
+
+    for i in range(len(images)):
+        run_frame(i)
+
+    # Peak traced memory above the starting point for each frame, which counts transient allocations that are freed
+    # before the frame finishes. Memory allocated natively by OpenCV and WPILib isn't traced.
+    tracemalloc.start()
+    frame_peaks = np.zeros(iterations)
+    for i in range(iterations):
+        tracemalloc.reset_peak()
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        run_frame(i)
+        frame_peaks[i] = tracemalloc.get_traced_memory()[1] - start_bytes
+    tracemalloc.stop()
+
+    pause_start_ns = 0
+    pauses_ms = []
+
+    def gc_callback(phase, _):
+        nonlocal pause_start_ns
+        if phase == "start":
+            pause_start_ns = time.perf_counter_ns()
+        else:
+            pauses_ms.append((time.perf_counter_ns() - pause_start_ns) / 1e6)
+
+    gc.collect()
+    gc.callbacks.append(gc_callback)
+    start = time.perf_counter_ns()
+    try:
+        for i in range(iterations):
+            run_frame(i)
+    finally:
+        gc.callbacks.remove(gc_callback)
+    ms_per_frame = (time.perf_counter_ns() - start) / 1e6 / iterations
+
+    lines = ()
+    if top_lines > 0:
+        lines = tuple(allocations_by_line(run_frame, iterations)[:top_lines])
+
+    return AllocationBenchmarkResult(name,
+                                     iterations,
+                                     ms_per_frame,
+                                     float(np.mean(frame_peaks)) / 1024,
+                                     len(pauses_ms),
+                                     float(np.sum(pauses_ms)),
+                                     max(pauses_ms, default=0.0),
+                                     lines)
+
+
+def run_allocation_benchmark(config: Config, frames: Sequence[LabeledFrame], iterations: int, top_lines: int = 0):
+    nt_instance = ntcore.NetworkTableInstance.getDefault()
+    nt_instance.startLocal()
+    if not config.has_calibration():
+        logger.info("No calibration loaded, using synthetic camera intrinsics")
+        config.calibration = synthetic_calibration()
+    tag_ids = sorted({int(tag_id) for frame in frames for tag_id in frame.ids})
+
+    results = []
+    config.fiducial.tag_layout = None
+    results.append(benchmark_allocations("target poses", config, frames, iterations, top_lines))
+    config.fiducial.tag_layout = synthetic_tag_layout(tag_ids)
+    results.append(benchmark_allocations("camera pose", config, frames, iterations, top_lines))
+    nt_instance.stopLocal()
+
+    print(f"{'mode':<16}{'frames':>8}{'ms/frame':>10}{'KB/frame':>10}{'gc runs':>9}{'gc ms':>9}{'max gc ms':>11}")
+    for r in results:
+        print(f"{r.name:<16}{r.frames:>8}{r.ms_per_frame:>10.3f}{r.kb_per_frame:>10.1f}{r.gc_collections:>9}"
+              f"{r.gc_pause_ms:>9.2f}{r.gc_max_pause_ms:>11.3f}")
+    for r in results:
+        if len(r.lines) == 0:
+            continue
+        print(f"\n{r.name}, KB/frame by line")
+        for line in r.lines:
+            source = linecache.getline(line.file_name, line.line_number).strip()
+            print(f"{line.kb_per_frame:>8.2f}  {os.path.relpath(line.file_name, PACKAGE_DIR)}:{line.line_number:<5}"
+                  f"{source[:80]}")
+    return results
@@ -0,0 +1,112 @@
+import dataclasses
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import numpy as np
+
+from ..config import Config
+from ..pipeline import create_gstreamer_capture
+from ..pipeline.gstreamer_templates import GSTREAMER_TEMPLATES, resolve_template, test_source
+
+logger = logging.getLogger(__name__)
+
+PROBE_TEMPLATE_NAME = "probe"
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    template_name: str
+    frames: int
+    fps: float
+    cpu_percent: float
+    # CPU time of the GStreamer streaming threads, which decode and convert frames
+    pipeline_cpu_ms_per_frame: float
+    # CPU time of the reading thread, which pulls frames and copies them into the frame pool
+    read_cpu_ms_per_frame: float
+    read_latency_mean_ms: float
+    read_latency_p95_ms: float
+
+
+def probe_template(config: Config, template_name: str, num_frames: int, warmup_frames: int) -> Optional[ProbeResult]:
+    # Opens the template through the same capture class the pipeline uses, with config.camera.capture_pipelines set
+    # to only this template
+    capture = create_gstreamer_capture(config)
+    if not capture.is_opened():
+        logger.warning(f'Failed to open capture pipeline "{template_name}"')
+        return None
+    logger.info(f"Probing through {type(capture).__name__}")
+
+    for _ in range(warmup_frames):
+        _, frame = capture.get_frame()
+        frame.release()
+
+    read_latencies_ns = np.zeros(num_frames, dtype=np.int64)
+    frame_count = 0
+    cpu_start = time.process_time_ns()
+    thread_cpu_start = time.thread_time_ns()
+    wall_start = time.perf_counter_ns()
+    for i in range(num_frames):
+        read_start = time.perf_counter_ns()
+        ret, frame = capture.get_frame()
+        read_latencies_ns[i] = time.perf_counter_ns() - read_start
+        frame.release()
+        if not ret:
+            break
+        frame_count += 1
+    wall_ns = time.perf_counter_ns() - wall_start
+    thread_cpu_ns = time.thread_time_ns() - thread_cpu_start
+    cpu_ns = time.process_time_ns() - cpu_start
+    del capture
+
+    if frame_count == 0:
+        logger.warning(f'Capture pipeline "{template_name}" opened but produced no frames')
+        return None
+
+    latencies_ms = read_latencies_ns[:frame_count] / 1e6
+    return ProbeResult(template_name,
+                       frame_count,
+                       frame_count / (wall_ns / 1e9),
+                       100.0 * cpu_ns / wall_ns,
+                       (cpu_ns - thread_cpu_ns) / 1e6 / frame_count,
+                       thread_cpu_ns / 1e6 / frame_count,
+                       float(np.mean(latencies_ms)),
+                       float(np.percentile(latencies_ms, 95)))
+
+
+def run_capture_probe(config: Config,
+                      template_names: Sequence[str],
+                      use_test_source: bool,
+                      num_frames: int,
+                      warmup_frames: int) -> Sequence[ProbeResult]:
+    camera = config.camera
+    if len(template_names) == 0:
+        template_names = list(GSTREAMER_TEMPLATES.keys()) + list(camera.capture_templates.keys())
+
+    results = []
+    for template_name in template_names:
+        template = resolve_template(template_name, camera.capture_templates)
+        if template is None:
+            logger.warning(f'Unknown capture pipeline template "{template_name}", skipping')
+            continue
+        if use_test_source:
+            # Templates are formatted with str.format, so fill in the source and leave the other placeholders
+            template = template.replace("{source}", test_source(template))
+        config.camera = dataclasses.replace(camera,
+                                            capture_pipelines=[PROBE_TEMPLATE_NAME],
+                                            capture_templates={PROBE_TEMPLATE_NAME: template})
+        logger.info(f'Probing capture pipeline "{template_name}"...')
+        result = probe_template(config, template_name, num_frames, warmup_frames)
+        if result is not None:
+            results.append(result)
+    config.camera = camera
+
+    results.sort(key=lambda r: r.fps, reverse=True)
+    print(f"{'template':<24}{'frames':>8}{'fps':>10}{'cpu %':>10}{'gst ms/f':>10}{'read cpu':>10}{'read ms':>10}"
+          f"{'read p95':>10}")
+    for r in results:
+        print(f"{r.template_name:<24}{r.frames:>8}{r.fps:>10.1f}{r.cpu_percent:>10.1f}"
+              f"{r.pipeline_cpu_ms_per_frame:>10.2f}{r.read_cpu_ms_per_frame:>10.2f}{r.read_latency_mean_ms:>10.2f}"
+              f"{r.read_latency_p95_ms:>10.2f}")
+    return results
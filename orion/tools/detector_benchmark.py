@@ -0,0 +1,160 @@
+import dataclasses
+import logging
+import time
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from ..config import Config
+from ..pipeline import (AprilTagFiducialDetector,
+                        ArUcoFiducialDetector,
+                        CaptureFrame,
+                        FiducialDetector,
+                        TiledFiducialDetector)
+from .allocation_benchmark import synthetic_tag_layout
+from .synthetic_frames import LabeledFrame, match_detections
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DetectorBenchmarkResult:
+    name: str
+    ms_per_frame: float
+    ms_p95: float
+    recall: float
+    corner_error_px: float
+    false_positives: int
+
+
+def benchmark_detector(name: str,
+                       detector: FiducialDetector,
+                       frames: Sequence[LabeledFrame]) -> DetectorBenchmarkResult:
+    capture_frames = [CaptureFrame(frame.image, 0, frame.image.shape[0], frame.image.shape[1]) for frame in frames]
+    detector.detect_fiducials(capture_frames[0])
+
+    frame_times_ns = np.zeros(len(frames), dtype=np.int64)
+    num_labels = 0
+    num_matched = 0
+    corner_errors = []
+    false_positives = 0
+    for i, (frame, capture_frame) in enumerate(zip(frames, capture_frames)):
+        start = time.perf_counter_ns()
+        ids, corners = detector.detect_fiducials(capture_frame)
+        frame_times_ns[i] = time.perf_counter_ns() - start
+
+        frame_matched, frame_errors, frame_false_positives = match_detections(frame, ids, corners)
+        num_labels += len(frame.ids)
+        num_matched += frame_matched
+        corner_errors += frame_errors
+        false_positives += frame_false_positives
+
+    frame_times_ms = frame_times_ns / 1e6
+    return DetectorBenchmarkResult(name,
+                                   float(np.mean(frame_times_ms)),
+                                   float(np.percentile(frame_times_ms, 95)),
+                                   num_matched / num_labels if num_labels > 0 else 1.0,
+                                   float(np.mean(corner_errors)) if len(corner_errors) > 0 else float("inf"),
+                                   false_positives)
+
+
+def run_detector_benchmark(config: Config,
+                           frames: Sequence[LabeledFrame],
+                           apriltag_threads: Sequence[int] = (1,),
+                           tile_layouts: Sequence[Tuple[int, int]] = ()) -> List[DetectorBenchmarkResult]:
+    results = [benchmark_detector("aruco", ArUcoFiducialDetector(config), frames)]
+    base_detector = config.detector
+    for rows, cols in tile_layouts:
+        config.detector = dataclasses.replace(base_detector, tile_rows=rows, tile_cols=cols)
+        detector = TiledFiducialDetector(config, ArUcoFiducialDetector)
+        results.append(benchmark_detector(f"aruco ({rows}x{cols} tiles)", detector, frames))
+        detector.close()
+    config.detector = base_detector
+    if AprilTagFiducialDetector.is_available():
+        for num_threads in apriltag_threads:
+            config.detector = dataclasses.replace(base_detector, backend="apriltag", apriltag_num_threads=num_threads)
+            results.append(benchmark_detector(f"apriltag ({num_threads} threads)",
+                                              AprilTagFiducialDetector(config),
+                                              frames))
+        config.detector = base_detector
+    else:
+        logger.warning("robotpy-apriltag is not installed, skipping AprilTag detector backend")
+
+    print(f"{'backend':<24}{'ms/frame':>10}{'p95 ms':>10}{'recall':>8}{'err px':>8}{'fp':>5}")
+    for r in results:
+        print(f"{r.name:<24}{r.ms_per_frame:>10.2f}{r.ms_p95:>10.2f}{r.recall:>8.3f}{r.corner_error_px:>8.3f}"
+              f"{r.false_positives:>5}")
+    return results
+
+
+@dataclass(frozen=True)
+class LayoutFilterResult:
+    name: str
+    ms_per_frame: float
+    ms_p95: float
+    recall: float
+    false_positives: int
+    # Detections outside the layout that were decoded and then thrown away
+    discarded: int
+
+
+def benchmark_layout_filter(name: str,
+                            config: Config,
+                            frames: Sequence[LabeledFrame],
+                            layout_ids: Sequence[int]) -> LayoutFilterResult:
+    detector = ArUcoFiducialDetector(config)
+    capture_frames = [CaptureFrame(frame.image, 0, frame.image.shape[0], frame.image.shape[1]) for frame in frames]
+    detector.detect_fiducials(capture_frames[0])
+    layout_ids = np.asarray(layout_ids)
+
+    frame_times_ns = np.zeros(len(frames), dtype=np.int64)
+    num_labels = 0
+    num_matched = 0
+    false_positives = 0
+    discarded = 0
+    for i, (frame, capture_frame) in enumerate(zip(frames, capture_frames)):
+        start = time.perf_counter_ns()
+        ids, corners = detector.detect_fiducials(capture_frame)
+        keep = np.isin(ids.reshape(-1), layout_ids) if ids is not None else np.zeros(0, dtype=bool)
+        frame_times_ns[i] = time.perf_counter_ns() - start
+
+        discarded += int(np.count_nonzero(~keep))
+        kept_ids = ids[keep] if ids is not None else None
+        kept_corners = [tag_corners for tag_corners, kept in zip(corners, keep) if kept]
+        label_mask = np.isin(frame.ids, layout_ids)
+        layout_frame = LabeledFrame(frame.image, frame.ids[label_mask], frame.corners[label_mask])
+        frame_matched, _, frame_false_positives = match_detections(layout_frame, kept_ids, kept_corners)
+        num_labels += len(layout_frame.ids)
+        num_matched += frame_matched
+        false_positives += frame_false_positives
+
+    frame_times_ms = frame_times_ns / 1e6
+    return LayoutFilterResult(name,
+                              float(np.mean(frame_times_ms)),
+                              float(np.percentile(frame_times_ms, 95)),
+                              num_matched / num_labels if num_labels > 0 else 1.0,
+                              false_positives,
+                              discarded)
+
+
+def run_layout_filter_benchmark(config: Config,
+                                frames: Sequence[LabeledFrame],
+                                layout_ids: Sequence[int]) -> List[LayoutFilterResult]:
+    # Compares decoding only the layout's IDs with decoding the whole family and filtering by the layout afterwards
+    base_detector = config.detector
+    base_layout = config.fiducial.tag_layout
+    config.fiducial.tag_layout = synthetic_tag_layout(layout_ids)
+    results = []
+    for name, restrict in (("filter after decode", False), ("layout dictionary", True)):
+        config.detector = dataclasses.replace(base_detector, backend="aruco", restrict_to_layout=restrict)
+        results.append(benchmark_layout_filter(name, config, frames, layout_ids))
+    config.detector = base_detector
+    config.fiducial.tag_layout = base_layout
+
+    print(f"{len(layout_ids)} layout IDs")
+    print(f"{'mode':<22}{'ms/frame':>10}{'p95 ms':>10}{'recall':>8}{'fp':>5}{'discarded':>11}")
+    for r in results:
+        print(f"{r.name:<22}{r.ms_per_frame:>10.2f}{r.ms_p95:>10.2f}{r.recall:>8.3f}{r.false_positives:>5}"
+              f"{r.discarded:>11}")
+    return results
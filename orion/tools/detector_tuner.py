@@ -0,0 +1,138 @@
+import dataclasses
+import itertools
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+from ..config import DetectorConfig
+from ..pipeline.FiducialDetector import make_detector_parameters
+from .synthetic_frames import LabeledFrame, match_detections
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP: Dict[str, Sequence[Any]] = {
+    "adaptive_thresh_win_size_step": [4, 10, 20],
+    "adaptive_thresh_win_size_max": [15, 23, 35],
+    "min_marker_perimeter_rate": [0.01, 0.03, 0.06],
+    "polygonal_approx_accuracy_rate": [0.02, 0.03, 0.05],
+    "corner_refinement_method": ["none", "subpix", "contour"],
+    "use_aruco3_detection": [False, True]
+}
+
+
+@dataclass(frozen=True)
+class TuningResult:
+    detector: DetectorConfig
+    ms_per_frame: float
+    recall: float
+    corner_error_px: float
+    false_positives: int
+
+
+def reference_labels(images: Sequence[cv2.Mat], tag_family: int) -> List[LabeledFrame]:
+    # Without ground truth, use a slow and thorough profile as the reference for recall and corner error
+    reference = DetectorConfig(adaptive_thresh_win_size_step=2,
+                               adaptive_thresh_win_size_max=43,
+                               min_marker_perimeter_rate=0.01,
+                               corner_refinement_method="subpix")
+    detector = cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(tag_family),
+                                       make_detector_parameters(reference))
+    frames = []
+    for image in images:
+        corners, ids, _ = detector.detectMarkers(image)
+        if ids is None:
+            frames.append(LabeledFrame(image, np.zeros(0, dtype=np.int32), np.zeros((0, 4, 2))))
+        else:
+            frames.append(LabeledFrame(image, ids.flatten(), np.array(corners).reshape(-1, 4, 2)))
+    return frames
+
+
+def evaluate_profile(detector_config: DetectorConfig,
+                     tag_family: int,
+                     frames: Sequence[LabeledFrame]) -> TuningResult:
+    detector = cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(tag_family),
+                                       make_detector_parameters(detector_config))
+    detector.detectMarkers(frames[0].image)
+
+    total_ns = 0
+    num_labels = 0
+    num_matched = 0
+    false_positives = 0
+    corner_errors = []
+    for frame in frames:
+        start = time.perf_counter_ns()
+        corners, ids, _ = detector.detectMarkers(frame.image)
+        total_ns += time.perf_counter_ns() - start
+
+        frame_matched, frame_errors, frame_false_positives = match_detections(frame, ids, corners)
+        num_labels += len(frame.ids)
+        num_matched += frame_matched
+        corner_errors += frame_errors
+        false_positives += frame_false_positives
+
+    return TuningResult(detector_config,
+                        total_ns / 1e6 / len(frames),
+                        num_matched / num_labels if num_labels > 0 else 1.0,
+                        float(np.mean(corner_errors)) if len(corner_errors) > 0 else float("inf"),
+                        false_positives)
+
+
+def pareto_front(results: Sequence[TuningResult]) -> List[TuningResult]:
+    def dominates(a: TuningResult, b: TuningResult) -> bool:
+        no_worse = (a.ms_per_frame <= b.ms_per_frame
+                    and a.recall >= b.recall
+                    and a.corner_error_px <= b.corner_error_px)
+        better = (a.ms_per_frame < b.ms_per_frame
+                  or a.recall > b.recall
+                  or a.corner_error_px < b.corner_error_px)
+        return no_worse and better
+
+    front = [r for r in results if not any(dominates(other, r) for other in results)]
+    return sorted(front, key=lambda r: r.ms_per_frame)
+
+
+def tune_detector(base: DetectorConfig,
+                  tag_family: int,
+                  frames: Sequence[LabeledFrame],
+                  sweep: Optional[Dict[str, Sequence[Any]]] = None,
+                  max_profiles: Optional[int] = None,
+                  min_recall: float = 0.99,
+                  output_file: Optional[str] = None) -> List[TuningResult]:
+    if sweep is None:
+        sweep = DEFAULT_SWEEP
+    profiles = [dataclasses.replace(base, **dict(zip(sweep.keys(), values)))
+                for values in itertools.product(*sweep.values())]
+    profiles = [p for p in profiles if p.adaptive_thresh_win_size_max >= p.adaptive_thresh_win_size_min]
+    if max_profiles is not None and len(profiles) > max_profiles:
+        rng = np.random.default_rng(0)
+        profiles = [profiles[i] for i in sorted(rng.choice(len(profiles), size=max_profiles, replace=False))]
+
+    logger.info(f"Evaluating {len(profiles)} detector profiles on {len(frames)} frames...")
+    results = [evaluate_profile(base, tag_family, frames)]
+    for profile in profiles:
+        results.append(evaluate_profile(profile, tag_family, frames))
+    baseline = results[0]
+
+    front = pareto_front(results)
+    print(f"Baseline: {baseline.ms_per_frame:.2f} ms/frame, recall {baseline.recall:.3f}, "
+          f"corner error {baseline.corner_error_px:.3f} px, {baseline.false_positives} false positives")
+    print(f"{'ms/frame':>10}{'recall':>8}{'err px':>8}{'fp':>5}  profile")
+    default_fields = dataclasses.asdict(base)
+    for r in front:
+        changed = {k: v for k, v in dataclasses.asdict(r.detector).items() if default_fields[k] != v}
+        print(f"{r.ms_per_frame:>10.2f}{r.recall:>8.3f}{r.corner_error_px:>8.3f}{r.false_positives:>5}  {changed}")
+
+    if output_file is not None:
+        # The fastest profile that keeps most of the best achievable recall
+        best_recall = max(r.recall for r in front)
+        chosen = next(r for r in front if r.recall >= min_recall * best_recall)
+        with open(output_file, "w") as f:
+            f.write(json.dumps(dataclasses.asdict(chosen.detector), indent=4))
+        logger.info(f"Wrote detector profile ({chosen.ms_per_frame:.2f} ms/frame, recall {chosen.recall:.3f}) "
+                    f"to {output_file}")
+    return front
@@ -0,0 +1,247 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import cv2
+import ntcore
+import numpy as np
+import numpy.typing as npt
+from wpimath.geometry import Pose3d, Rotation3d, Transform3d, Translation3d
+
+from ..config import Calibration, Config
+from ..coordinate_util import OPENCV_TO_WPILIB, quaternion_to_rotation_matrix, tag_corner_offsets
+from ..fusion import CameraObservation, FusionNode, jacobian_error
+from ..nt_time_util import nt_now_us
+from .pose_benchmark import synthetic_calibration
+from .regression_benchmark import wall_tag_layout
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WIDTH = 1280
+IMAGE_HEIGHT = 720
+# Capture timestamps of consecutive timesteps are this far apart
+FRAME_PERIOD_NS = 20_000_000
+# Fraction of max_time_skew_ms the devices' capture timestamps of a timestep are spread over
+SKEW_FRACTION = 0.8
+# Fused timestamps further than this from the mean capture timestamp of a timestep are grouping errors. Nanosecond
+# timestamps published as doubles are only exact to a few hundred nanoseconds.
+TIMESTAMP_TOLERANCE_NS = 1000.0
+
+
+@dataclass(frozen=True)
+class _FakeDevice:
+    device_id: str
+    robot_to_camera: Transform3d
+    calibration: Calibration
+
+
+@dataclass(frozen=True)
+class FusionCheckResult:
+    steps: int
+    fused: int
+    # Timesteps that were not fused exactly once with the expected devices and timestamp
+    grouping_errors: int
+    translation_error_m: float
+    max_translation_error_m: float
+    max_rotation_error_rad: float
+    reprojection_error_px: float
+    jacobian_error: float
+
+
+def _fake_devices() -> List[_FakeDevice]:
+    # Two cameras at the front corners of the robot, turned outwards, with different intrinsics
+    right_calibration = synthetic_calibration()
+    right_calibration.intrinsics_matrix[0, 0] = right_calibration.intrinsics_matrix[1, 1] = 1100.0
+    return [_FakeDevice("fake_left",
+                        Transform3d(Translation3d(0.25, 0.2, 0.5), Rotation3d(0.0, -0.1, 0.3)),
+                        synthetic_calibration()),
+            _FakeDevice("fake_right",
+                        Transform3d(Translation3d(0.25, -0.2, 0.4), Rotation3d(0.0, 0.0, -0.3)),
+                        right_calibration)]
+
+
+def _rotation_matrix(rotation: Rotation3d) -> npt.NDArray[np.float64]:
+    quaternion = rotation.getQuaternion()
+    return quaternion_to_rotation_matrix(quaternion.W(), quaternion.X(), quaternion.Y(), quaternion.Z())
+
+
+def _project_layout(layout_corners: Dict[int, npt.NDArray[np.float64]],
+                    camera_pose: Pose3d,
+                    calibration: Calibration,
+                    rng: np.random.Generator,
+                    noise_px: float) -> Tuple[npt.NDArray[np.int32], npt.NDArray[np.float64]]:
+    # Returns the IDs and noisy pixel corners (N, 4, 2) of the layout tags fully in view of a camera
+    field_to_camera = OPENCV_TO_WPILIB.T @ _rotation_matrix(camera_pose.rotation()).T
+    camera_position = np.array([camera_pose.x, camera_pose.y, camera_pose.z])
+    ids = []
+    corners = []
+    for tag_id, tag_corners in layout_corners.items():
+        camera_points = (tag_corners - camera_position) @ field_to_camera.T
+        if np.any(camera_points[:, 2] < 0.1):
+            continue
+        image_points, _ = cv2.projectPoints(camera_points,
+                                            np.zeros(3),
+                                            np.zeros(3),
+                                            calibration.intrinsics_matrix,
+                                            calibration.distortion_coeffs)
+        image_points = image_points.reshape(4, 2)
+        if (np.any(image_points < 0) or np.any(image_points[:, 0] >= IMAGE_WIDTH)
+                or np.any(image_points[:, 1] >= IMAGE_HEIGHT)):
+            continue
+        ids.append(tag_id)
+        corners.append(image_points + rng.normal(0, noise_px, (4, 2)))
+    return np.array(ids, dtype=np.int32), np.array(corners).reshape(-1, 4, 2)
+
+
+def _layout_corners(config: Config) -> Dict[int, npt.NDArray[np.float64]]:
+    # Corners in the order FusionNode and the detector use
+    offsets = tag_corner_offsets(config.fiducial.tag_size_m)
+    layout_corners = {}
+    for tag_id, tag_pose in config.fiducial.tag_layout.items():
+        corners = [tag_pose.transformBy(offset) for offset in offsets]
+        layout_corners[tag_id] = np.array([[corner.x, corner.y, corner.z] for corner in corners])
+    return layout_corners
+
+
+def run_fusion_check(config: Config,
+                     steps: int,
+                     noise_px: float = 0.3,
+                     dropout_every: int = 10,
+                     seed: int = 0) -> FusionCheckResult:
+    # Publishes the tag observations of two fake devices at known robot poses to a local NT instance, runs the fusion
+    # node on them and compares the fused poses with the true ones. The second device skips every dropout_every-th
+    # timestep, which must then be fused from the first device alone.
+    rng = np.random.default_rng(seed)
+    devices = _fake_devices()
+    config.fiducial.tag_layout = wall_tag_layout(16)
+    config.fusion.cameras = {device.device_id: device.robot_to_camera for device in devices}
+    layout_corners = _layout_corners(config)
+
+    nt_instance = ntcore.NetworkTableInstance.create()
+    nt_instance.startLocal()
+    observations_pubs = []
+    intrinsics_pubs = []
+    for device in devices:
+        table = nt_instance.getTable(f"orion/{device.device_id}/output")
+        observations_pubs.append(table.getDoubleArrayTopic("tag_observations").publish(
+            ntcore.PubSubOptions(sendAll=True, keepDuplicates=True)))
+        intrinsics_pubs.append(table.getDoubleArrayTopic("camera_intrinsics").publish())
+        intrinsics_pubs[-1].set(np.concatenate([device.calibration.intrinsics_matrix.reshape(-1),
+                                           device.calibration.distortion_coeffs.reshape(-1)]).tolist())
+    node = FusionNode(config, nt_instance)
+    output_table = nt_instance.getTable(f"orion/{config.fusion.device_id}/output")
+    queue_options = ntcore.PubSubOptions(sendAll=True, keepDuplicates=True)
+    timestamp_sub = output_table.getDoubleTopic("timestamp_ns").subscribe(0.0, queue_options)
+    num_cameras_sub = output_table.getIntegerTopic("num_cameras").subscribe(0, queue_options)
+    has_pose_sub = output_table.getBooleanTopic("has_pose_estimate").subscribe(False, queue_options)
+    robot_pose_sub = output_table.getStructTopic("robot_pose", Pose3d).subscribe(Pose3d(), queue_options)
+    reprojection_error_sub = output_table.getDoubleTopic("reprojection_error").subscribe(0.0, queue_options)
+
+    # Fused timestamp, number of devices and true robot pose of each timestep
+    expected: List[Tuple[float, int, Pose3d]] = []
+    jacobian_errors = []
+    fused_outputs = []
+    start_ns = nt_now_us() * 1000
+    max_skew_ns = config.fusion.max_time_skew_ms * 1e6 * SKEW_FRACTION
+    for step in range(steps):
+        robot_pose = Pose3d(Translation3d(rng.uniform(-1.0, 1.0), rng.uniform(-0.5, 0.5), 0.0),
+                            Rotation3d(0.0, 0.0, rng.uniform(-0.2, 0.2)))
+        timestamps_ns = []
+        camera_observations = []
+        for i, (device, observations_pub) in enumerate(zip(devices, observations_pubs)):
+            if i > 0 and dropout_every > 0 and step % dropout_every == dropout_every - 1:
+                continue
+            ids, corners = _project_layout(layout_corners,
+                                           robot_pose.transformBy(device.robot_to_camera),
+                                           device.calibration,
+                                           rng,
+                                           noise_px)
+            timestamp_ns = float(start_ns + step * FRAME_PERIOD_NS + rng.uniform(0, max_skew_ns))
+            values = np.empty((len(ids), 9))
+            values[:, 0] = ids
+            values[:, 1:] = corners.reshape(-1, 8)
+            observations_pub.set([timestamp_ns] + values.reshape(-1).tolist())
+            timestamps_ns.append(timestamp_ns)
+            if len(ids) > 0:
+                robot_to_camera_rotation = _rotation_matrix(device.robot_to_camera.rotation())
+                camera_observations.append(CameraObservation(np.concatenate([layout_corners[tag_id] for tag_id in ids]),
+                                                             corners.reshape(-1, 2),
+                                                             device.calibration.intrinsics_matrix,
+                                                             device.calibration.distortion_coeffs,
+                                                             robot_to_camera_rotation,
+                                                             np.array([device.robot_to_camera.x,
+                                                                       device.robot_to_camera.y,
+                                                                       device.robot_to_camera.z])))
+        expected.append((float(np.mean(timestamps_ns)), len(timestamps_ns), robot_pose))
+
+        # The Jacobian the solver uses, against central differences near the true robot from field transform
+        robot_rotation = _rotation_matrix(robot_pose.rotation())
+        robot_translation = np.array([robot_pose.x, robot_pose.y, robot_pose.z])
+        perturbation = cv2.Rodrigues(rng.normal(0, 0.01, 3))[0]
+        jacobian_errors.append(jacobian_error(camera_observations,
+                                              perturbation @ robot_rotation.T,
+                                              -perturbation @ robot_rotation.T @ robot_translation
+                                              + rng.normal(0, 0.05, 3)))
+
+        node.update()
+        fused_outputs += _read_fused(timestamp_sub, num_cameras_sub, has_pose_sub, robot_pose_sub,
+                                     reprojection_error_sub)
+    # If the second device skipped the last timestep, it's only fused once max_wait_ms has passed
+    time.sleep(config.fusion.max_wait_ms / 1000)
+    node.update()
+    fused_outputs += _read_fused(timestamp_sub, num_cameras_sub, has_pose_sub, robot_pose_sub, reprojection_error_sub)
+    ntcore.NetworkTableInstance.destroy(nt_instance)
+
+    grouping_errors = abs(len(fused_outputs) - len(expected))
+    translation_errors = []
+    rotation_errors = []
+    reprojection_errors = []
+    for (timestamp_ns, num_cameras, robot_pose), fused in zip(expected, fused_outputs):
+        fused_timestamp_ns, fused_num_cameras, fused_pose, reprojection_error = fused
+        if (abs(fused_timestamp_ns - timestamp_ns) > TIMESTAMP_TOLERANCE_NS
+                or fused_num_cameras != num_cameras
+                or fused_pose is None):
+            grouping_errors += 1
+            continue
+        error = fused_pose.relativeTo(robot_pose)
+        translation_errors.append(error.translation().norm())
+        rotation_errors.append(error.rotation().angle)
+        reprojection_errors.append(reprojection_error)
+
+    result = FusionCheckResult(steps,
+                               len(fused_outputs),
+                               grouping_errors,
+                               float(np.mean(translation_errors)) if len(translation_errors) > 0 else np.nan,
+                               max(translation_errors, default=np.nan),
+                               max(rotation_errors, default=np.nan),
+                               float(np.mean(reprojection_errors)) if len(reprojection_errors) > 0 else np.nan,
+                               max(jacobian_errors, default=0.0))
+    print(f"{'steps':>6}{'fused':>7}{'grouping errors':>17}{'mean dt mm':>12}{'max dt mm':>11}{'max dr deg':>12}"
+          f"{'reproj px':>11}{'jacobian err':>14}")
+    print(f"{result.steps:>6}{result.fused:>7}{result.grouping_errors:>17}{result.translation_error_m * 1000:>12.2f}"
+          f"{result.max_translation_error_m * 1000:>11.2f}{np.degrees(result.max_rotation_error_rad):>12.3f}"
+          f"{result.reprojection_error_px:>11.3f}{result.jacobian_error:>14.2e}")
+    if result.grouping_errors > 0:
+        logger.error(f"{result.grouping_errors} timesteps were not grouped as published")
+    return result
+
+
+def _read_fused(timestamp_sub: ntcore.DoubleSubscriber,
+                num_cameras_sub: ntcore.IntegerSubscriber,
+                has_pose_sub: ntcore.BooleanSubscriber,
+                robot_pose_sub: ntcore.StructSubscriber,
+                reprojection_error_sub: ntcore.DoubleSubscriber) -> List[tuple]:
+    # Every fused timestep publishes a timestamp, camera count and whether it has a pose, and a pose and reprojection
+    # error only if it has one
+    robot_poses = [value.value for value in robot_pose_sub.readQueue()]
+    reprojection_errors = [value.value for value in reprojection_error_sub.readQueue()]
+    fused = []
+    for timestamp, num_cameras, has_pose in zip(timestamp_sub.readQueue(),
+                                                num_cameras_sub.readQueue(),
+                                                has_pose_sub.readQueue()):
+        if has_pose.value and len(robot_poses) > 0:
+            fused.append((timestamp.value, num_cameras.value, robot_poses.pop(0), reprojection_errors.pop(0)))
+        else:
+            fused.append((timestamp.value, num_cameras.value, None, np.nan))
+    return fused
@@ -0,0 +1,340 @@
+import copy
+import dataclasses
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import ntcore
+import numpy as np
+
+from ..calibration import CalibrationController
+from ..config import Config
+from ..nt_time_util import nt_now_us
+from ..output import NTOutputPublisher
+from ..pipeline import PipelineResult
+
+logger = logging.getLogger(__name__)
+
+# Rough NT4 MessagePack framing per value: array header, topic id, timestamp, type and value header
+VALUE_OVERHEAD_BYTES = 14
+CONNECT_TIMEOUT_S = 5.0
+WARMUP_S = 0.5
+CALIBRATION_COMMAND_INTERVAL_S = 0.5
+
+
+@dataclass(frozen=True)
+class LoadScenario:
+    # One topic layout: how many Orion instances publish, how many targets each result has, and how the simulated
+    # dashboards subscribe
+    instances: int
+    targets: int
+    rate_hz: float
+    subscribers: int
+    send_all: bool
+    subscriber_periodic_s: float
+
+    @property
+    def name(self) -> str:
+        return (f"{self.instances}x{self.targets} targets @ {self.rate_hz:g} Hz, {self.subscribers} subs "
+                f"{'sendAll' if self.send_all else 'latest'} {self.subscriber_periodic_s * 1000:g} ms")
+
+
+@dataclass(frozen=True)
+class TopicStats:
+    topic: str
+    messages_per_s: float
+    mean_latency_ms: float
+    p95_latency_ms: float
+    max_latency_ms: float
+    bytes_per_s: float
+
+
+@dataclass(frozen=True)
+class LoadTestResult:
+    scenario: LoadScenario
+    frames: int
+    publish_us: float
+    max_publish_us: float
+    calibration_poll_us: float
+    calibration_command_ms: float
+    process_cpu_percent: float
+    loopback_bytes_per_s: Optional[float]
+    topics: List[TopicStats]
+
+
+def synthetic_pipeline_result(num_targets: int, seed: int = 0) -> PipelineResult:
+    rng = np.random.default_rng(seed)
+    result = PipelineResult(max(num_targets, 1))
+    result.reset(time.monotonic_ns())
+    result.num_tags = num_targets
+    result.tag_ids[:num_targets] = np.arange(1, num_targets + 1)
+    result.tag_corners[:num_targets] = rng.uniform(0, 1280, (num_targets, 4, 2))
+    result.num_targets = num_targets
+    result.target_ids[:num_targets] = result.tag_ids[:num_targets]
+    result.target_poses[:num_targets, :, :3] = rng.uniform(-3.0, 3.0, (num_targets, 2, 3))
+    quaternions = rng.normal(size=(num_targets, 2, 4))
+    result.target_poses[:num_targets, :, 3:] = quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    result.target_errors[:num_targets] = rng.uniform(0.0, 0.5, (num_targets, 2))
+    result.has_pose_estimate = num_targets > 0
+    if result.has_pose_estimate:
+        result.camera_pose[:] = result.target_poses[0]
+        result.camera_pose_errors[:] = result.target_errors[0]
+    return result
+
+
+def _value_size(value: ntcore.Value) -> int:
+    value_type = value.type()
+    if value_type == ntcore.NetworkTableType.kRaw:
+        return len(value.getRaw())
+    if value_type == ntcore.NetworkTableType.kBoolean:
+        return 1
+    if value_type == ntcore.NetworkTableType.kString:
+        return len(value.getString())
+    if value_type in (ntcore.NetworkTableType.kBooleanArray,):
+        return len(value.value())
+    if value_type in (ntcore.NetworkTableType.kDoubleArray,
+                      ntcore.NetworkTableType.kIntegerArray,
+                      ntcore.NetworkTableType.kFloatArray):
+        return 9 * len(value.value())
+    if value_type == ntcore.NetworkTableType.kStringArray:
+        return sum(len(item) + 1 for item in value.value())
+    return 9
+
+
+def _loopback_bytes() -> Optional[int]:
+    # Bytes sent over the loopback interface, which carries every NT message in the test
+    try:
+        with open("/proc/net/dev") as net_dev:
+            for line in net_dev:
+                interface, _, counters = line.partition(":")
+                if interface.strip() == "lo":
+                    return int(counters.split()[8])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class _Subscriber:
+    # A simulated dashboard, a separate NT client that subscribes to every Orion topic and records the latency and
+    # size of each value it receives. Duplicates are kept since the output publisher sends them anyway.
+
+    def __init__(self, name: str, port: int, scenario: LoadScenario):
+        self.instance = ntcore.NetworkTableInstance.create()
+        self.instance.startClient4(name)
+        self.instance.setServer("127.0.0.1", port)
+        self._subscriber = ntcore.MultiSubscriber(self.instance,
+                                                  ["/orion/"],
+                                                  ntcore.PubSubOptions(sendAll=scenario.send_all,
+                                                                       periodic=scenario.subscriber_periodic_s,
+                                                                       keepDuplicates=True))
+        self._lock = threading.Lock()
+        self._recording = False
+        self.latencies_us: Dict[str, List[int]] = {}
+        self.sizes: Dict[str, int] = {}
+        self._listener = self.instance.addListener(self._subscriber, ntcore.EventFlags.kValueAll, self._on_value)
+
+    def _on_value(self, event: ntcore.Event):
+        received_us = nt_now_us()
+        if not self._recording:
+            return
+        value = event.data.value
+        topic = event.data.topic.getName()
+        with self._lock:
+            self.latencies_us.setdefault(topic, []).append(received_us - value.time())
+            self.sizes[topic] = self.sizes.get(topic, 0) + _value_size(value) + VALUE_OVERHEAD_BYTES
+
+    def start_recording(self):
+        with self._lock:
+            self._recording = True
+
+    def stop_recording(self):
+        with self._lock:
+            self._recording = False
+
+    def close(self):
+        self.instance.removeListener(self._listener)
+        self._subscriber.close()
+        ntcore.NetworkTableInstance.destroy(self.instance)
+
+
+class _SimulatedOrion:
+    # One Orion instance with its own NT client, output publisher and calibration controller
+
+    def __init__(self, config: Config, index: int, port: int):
+        self.config = copy.copy(config)
+        self.config.network = dataclasses.replace(config.network, device_id=f"load_test_{index}")
+        self.instance = ntcore.NetworkTableInstance.create()
+        self.instance.startClient4(self.config.network.device_id)
+        self.instance.setServer("127.0.0.1", port)
+        self.output = NTOutputPublisher(self.config, self.instance)
+        self.calibration = CalibrationController(self.config, self.instance)
+
+    def close(self):
+        ntcore.NetworkTableInstance.destroy(self.instance)
+
+
+def _wait_for_connections(instances: Sequence[ntcore.NetworkTableInstance]) -> bool:
+    deadline = time.monotonic() + CONNECT_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if all(instance.isConnected() for instance in instances):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def run_load_scenario(config: Config, scenario: LoadScenario, duration_s: float, port: int) -> LoadTestResult:
+    server = ntcore.NetworkTableInstance.create()
+    server.startServer("", "127.0.0.1", 0, port)
+    orions: List[_SimulatedOrion] = []
+    subscribers: List[_Subscriber] = []
+    try:
+        orions = [_SimulatedOrion(config, i, port) for i in range(scenario.instances)]
+        subscribers = [_Subscriber(f"load_test_dashboard_{i}", port, scenario) for i in range(scenario.subscribers)]
+        if not _wait_for_connections([orion.instance for orion in orions]
+                                     + [subscriber.instance for subscriber in subscribers]):
+            raise RuntimeError(f"NT clients failed to connect to the local server on port {port}")
+
+        # The first dashboard also drives calibration, setting capture_frame the way the calibration UI does
+        dashboard = subscribers[0].instance if len(subscribers) > 0 else server
+        calibration_pubs = [(dashboard.getBooleanTopic(f"/orion/{orion.config.network.device_id}/calibration/"
+                                                       "is_calibrating").publish(),
+                             dashboard.getBooleanTopic(f"/orion/{orion.config.network.device_id}/calibration/"
+                                                       "capture_frame").publish())
+                            for orion in orions]
+
+        results = [synthetic_pipeline_result(scenario.targets, seed) for seed in range(scenario.instances)]
+        frame_period_s = 1.0 / scenario.rate_hz
+        publish_ns: List[int] = []
+        poll_ns: List[int] = []
+        command_latencies_us: List[int] = []
+        command_sent_us: Optional[int] = None
+
+        def run_frame(heartbeat: int, record: bool):
+            nonlocal command_sent_us
+            for orion, result in zip(orions, results):
+                result.capture_timestamp_ns = time.monotonic_ns()
+                start = time.thread_time_ns()
+                orion.calibration.is_calibrating()
+                captured = orion.calibration.should_capture_frame()
+                poll_end = time.thread_time_ns()
+                orion.output.publish(result, scenario.rate_hz, heartbeat)
+                publish_end = time.thread_time_ns()
+                if record:
+                    poll_ns.append(poll_end - start)
+                    publish_ns.append(publish_end - poll_end)
+                if captured and record and command_sent_us is not None and orion is orions[0]:
+                    command_latencies_us.append(nt_now_us() - command_sent_us)
+                    command_sent_us = None
+
+        heartbeat = 0
+        next_frame_s = time.monotonic()
+        warmup_end_s = next_frame_s + WARMUP_S
+        while time.monotonic() < warmup_end_s:
+            run_frame(heartbeat, False)
+            heartbeat += 1
+            next_frame_s += frame_period_s
+            time.sleep(max(next_frame_s - time.monotonic(), 0))
+
+        # Controllers reset is_calibrating when they initialize on the first frame, so start calibrating after that
+        for is_calibrating_pub, _ in calibration_pubs:
+            is_calibrating_pub.set(True)
+        last_command_s = time.monotonic()
+        for subscriber in subscribers:
+            subscriber.start_recording()
+        loopback_start = _loopback_bytes()
+        cpu_start = time.process_time_ns()
+        start_s = time.monotonic()
+        frames = 0
+        while time.monotonic() - start_s < duration_s:
+            now_s = time.monotonic()
+            if len(calibration_pubs) > 0 and now_s - last_command_s > CALIBRATION_COMMAND_INTERVAL_S:
+                calibration_pubs[0][1].set(True)
+                command_sent_us = nt_now_us()
+                last_command_s = now_s
+            run_frame(heartbeat, True)
+            heartbeat += 1
+            frames += 1
+            next_frame_s += frame_period_s
+            time.sleep(max(next_frame_s - time.monotonic(), 0))
+        # Let values still in flight arrive before stopping
+        time.sleep(max(scenario.subscriber_periodic_s * 2, 0.1))
+        elapsed_s = time.monotonic() - start_s
+        cpu_ns = time.process_time_ns() - cpu_start
+        loopback_end = _loopback_bytes()
+        for subscriber in subscribers:
+            subscriber.stop_recording()
+
+        topics = []
+        topic_names = sorted({topic for subscriber in subscribers for topic in subscriber.latencies_us})
+        for topic in topic_names:
+            latencies = np.concatenate([subscriber.latencies_us.get(topic, []) for subscriber in subscribers]) / 1000
+            total_bytes = sum(subscriber.sizes.get(topic, 0) for subscriber in subscribers)
+            topics.append(TopicStats(topic,
+                                     len(latencies) / elapsed_s / len(subscribers),
+                                     float(np.mean(latencies)),
+                                     float(np.percentile(latencies, 95)),
+                                     float(np.max(latencies)),
+                                     total_bytes / elapsed_s / len(subscribers)))
+
+        for publishers in calibration_pubs:
+            for publisher in publishers:
+                publisher.close()
+
+        return LoadTestResult(scenario,
+                              frames,
+                              float(np.mean(publish_ns)) / 1000 if len(publish_ns) > 0 else 0.0,
+                              float(np.max(publish_ns)) / 1000 if len(publish_ns) > 0 else 0.0,
+                              float(np.mean(poll_ns)) / 1000 if len(poll_ns) > 0 else 0.0,
+                              float(np.mean(command_latencies_us)) / 1000 if len(command_latencies_us) > 0 else 0.0,
+                              cpu_ns / 1e9 / elapsed_s * 100,
+                              (loopback_end - loopback_start) / elapsed_s
+                              if loopback_start is not None and loopback_end is not None else None,
+                              topics)
+    finally:
+        # Listeners and instances have to be torn down before exit, ntcore aborts otherwise
+        for subscriber in subscribers:
+            subscriber.close()
+        for orion in orions:
+            orion.close()
+        ntcore.NetworkTableInstance.destroy(server)
+
+
+def run_nt_load_test(config: Config,
+                     instance_counts: Sequence[int],
+                     target_counts: Sequence[int],
+                     rate_hz: float,
+                     subscribers: int,
+                     send_all: bool,
+                     subscriber_periodic_s: float,
+                     duration_s: float,
+                     port: int,
+                     per_topic: bool = False) -> List[LoadTestResult]:
+    results = []
+    for instances in instance_counts:
+        for targets in target_counts:
+            scenario = LoadScenario(instances, targets, rate_hz, subscribers, send_all, subscriber_periodic_s)
+            logger.info(f"Running {scenario.name} for {duration_s:g} s")
+            results.append(run_load_scenario(config, scenario, duration_s, port))
+
+    print(f"{'instances':>10}{'targets':>9}{'frames':>8}{'publish us':>12}{'max us':>9}{'calib us':>10}"
+          f"{'calib cmd ms':>14}{'cpu %':>8}{'p95 ms':>9}{'max ms':>9}{'est KB/s':>10}{'lo KB/s':>10}")
+    for r in results:
+        output_topics = [topic for topic in r.topics if "/output/" in topic.topic]
+        p95_latency = max((topic.p95_latency_ms for topic in output_topics), default=0.0)
+        max_latency = max((topic.max_latency_ms for topic in output_topics), default=0.0)
+        estimated_kb = sum(topic.bytes_per_s for topic in r.topics) / 1024
+        loopback_kb = f"{r.loopback_bytes_per_s / 1024:>10.1f}" if r.loopback_bytes_per_s is not None else f"{'-':>10}"
+        print(f"{r.scenario.instances:>10}{r.scenario.targets:>9}{r.frames:>8}{r.publish_us:>12.1f}"
+              f"{r.max_publish_us:>9.0f}{r.calibration_poll_us:>10.1f}{r.calibration_command_ms:>14.1f}"
+              f"{r.process_cpu_percent:>8.1f}{p95_latency:>9.2f}{max_latency:>9.2f}{estimated_kb:>10.1f}{loopback_kb}")
+
+    if per_topic:
+        for r in results:
+            print(f"\n{r.scenario.name}")
+            print(f"{'topic':<48}{'msg/s':>8}{'mean ms':>9}{'p95 ms':>9}{'max ms':>9}{'est KB/s':>10}")
+            for topic in r.topics:
+                print(f"{topic.topic:<48}{topic.messages_per_s:>8.1f}{topic.mean_latency_ms:>9.2f}"
+                      f"{topic.p95_latency_ms:>9.2f}{topic.max_latency_ms:>9.2f}{topic.bytes_per_s / 1024:>10.2f}")
+    return results
@@ -0,0 +1,183 @@
+import glob
+import logging
+import os.path
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from ..calibration import make_charuco_board, write_calibration
+
+logger = logging.getLogger(__name__)
+
+# Frames with a per-view error above this multiple of the median are rejected along with those above max_frame_error
+OUTLIER_MEDIAN_FACTOR = 3.0
+# Cells per side of the grid used to report how much of the image the accepted corners cover
+COVERAGE_GRID_SIZE = 8
+
+_detector: Optional[cv2.aruco.CharucoDetector] = None
+_board: Optional[cv2.aruco.CharucoBoard] = None
+
+
+@dataclass(frozen=True)
+class BoardObservation:
+    path: str
+    image_size: Tuple[int, int]
+    object_points: npt.NDArray[np.float32]
+    image_points: npt.NDArray[np.float32]
+    # Fraction of the image covered by the convex hull of the detected corners
+    hull_coverage: float
+
+
+@dataclass(frozen=True)
+class CalibrationCandidate:
+    rms_error: float
+    camera_matrix: npt.NDArray[np.float64]
+    distortion_coeffs: npt.NDArray[np.float64]
+    per_view_errors: npt.NDArray[np.float64]
+
+
+def _init_worker():
+    # One detector per worker process, and no OpenCV threads on top of the process pool
+    global _detector, _board
+    cv2.setNumThreads(1)
+    _board = make_charuco_board()
+    _detector = cv2.aruco.CharucoDetector(_board, cv2.aruco.CharucoParameters(), cv2.aruco.DetectorParameters())
+
+
+def _detect_board(path: str) -> Optional[BoardObservation]:
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    corners, ids, _, _ = _detector.detectBoard(image)
+    if corners is None or ids is None or len(corners) < 4:
+        return BoardObservation(path, (image.shape[1], image.shape[0]), np.empty((0, 1, 3), np.float32),
+                                np.empty((0, 1, 2), np.float32), 0.0)
+    object_points, image_points = _board.matchImagePoints(corners, ids)
+    hull_area = cv2.contourArea(cv2.convexHull(image_points.reshape(-1, 2)))
+    return BoardObservation(path,
+                            (image.shape[1], image.shape[0]),
+                            object_points,
+                            image_points,
+                            hull_area / (image.shape[0] * image.shape[1]))
+
+
+def _calibrate(object_points: Sequence[npt.NDArray[np.float32]],
+               image_points: Sequence[npt.NDArray[np.float32]],
+               image_size: Tuple[int, int]) -> CalibrationCandidate:
+    rms_error, camera_matrix, distortion_coeffs, _, _, _, _, per_view_errors = cv2.calibrateCameraExtended(
+        list(object_points), list(image_points), image_size, None, None)
+    return CalibrationCandidate(rms_error, camera_matrix, distortion_coeffs, per_view_errors.reshape(-1))
+
+
+def _calibrate_subset(args: Tuple[Sequence[npt.NDArray[np.float32]],
+                                  Sequence[npt.NDArray[np.float32]],
+                                  Tuple[int, int]]) -> CalibrationCandidate:
+    return _calibrate(*args)
+
+
+def _grid_coverage(observations: Sequence[BoardObservation], image_size: Tuple[int, int]) -> float:
+    grid = np.zeros((COVERAGE_GRID_SIZE, COVERAGE_GRID_SIZE), dtype=bool)
+    for observation in observations:
+        points = observation.image_points.reshape(-1, 2)
+        cols = np.clip((points[:, 0] / image_size[0] * COVERAGE_GRID_SIZE).astype(int), 0, COVERAGE_GRID_SIZE - 1)
+        rows = np.clip((points[:, 1] / image_size[1] * COVERAGE_GRID_SIZE).astype(int), 0, COVERAGE_GRID_SIZE - 1)
+        grid[rows, cols] = True
+    return float(np.mean(grid))
+
+
+def _intrinsics_vector(candidate: CalibrationCandidate) -> npt.NDArray[np.float64]:
+    camera_matrix = candidate.camera_matrix
+    return np.concatenate([[camera_matrix[0, 0], camera_matrix[1, 1], camera_matrix[0, 2], camera_matrix[1, 2]],
+                           candidate.distortion_coeffs.reshape(-1)])
+
+
+def run_offline_calibration(image_dir: str,
+                            output_file: str,
+                            workers: Optional[int] = None,
+                            min_corners: int = 12,
+                            min_coverage: float = 0.02,
+                            max_frame_error: float = 1.0,
+                            subsets: int = 0,
+                            subset_fraction: float = 0.7,
+                            seed: int = 0) -> Optional[CalibrationCandidate]:
+    paths = sorted(glob.glob(os.path.join(image_dir, "*")))
+    if len(paths) == 0:
+        logger.error(f"No images found in {image_dir}")
+        return None
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        observations = [observation for observation in executor.map(_detect_board, paths, chunksize=4)
+                         if observation is not None]
+        logger.info(f"Detected boards in {len(observations)} images in {time.perf_counter() - start:.1f} s")
+        if len(observations) == 0:
+            logger.error("No readable images")
+            return None
+
+        image_size = observations[0].image_size
+        accepted = []
+        for observation in observations:
+            if observation.image_size != image_size:
+                logger.warning(f"Rejected {observation.path}: image size {observation.image_size} doesn't match "
+                               f"{image_size}")
+            elif len(observation.image_points) < min_corners:
+                logger.info(f"Rejected {observation.path}: {len(observation.image_points)} corners detected")
+            elif observation.hull_coverage < min_coverage:
+                logger.info(f"Rejected {observation.path}: board covers {observation.hull_coverage:.1%} of the image")
+            else:
+                accepted.append(observation)
+        if len(accepted) < 4:
+            logger.error(f"Only {len(accepted)} usable frames, at least 4 are needed")
+            return None
+
+        # Calibrate on every accepted frame, then drop frames that don't fit it and calibrate again
+        candidate = _calibrate([o.object_points for o in accepted], [o.image_points for o in accepted], image_size)
+        error_limit = min(max_frame_error, OUTLIER_MEDIAN_FACTOR * float(np.median(candidate.per_view_errors)))
+        kept = [o for o, error in zip(accepted, candidate.per_view_errors) if error <= error_limit]
+        for o, error in zip(accepted, candidate.per_view_errors):
+            if error > error_limit:
+                logger.info(f"Rejected {o.path}: reprojection error {error:.3f} px")
+        if len(kept) < 4:
+            logger.warning("Too few frames left after rejecting by reprojection error, keeping all accepted frames")
+            kept = accepted
+        if len(kept) != len(accepted):
+            candidate = _calibrate([o.object_points for o in kept], [o.image_points for o in kept], image_size)
+
+        if subsets > 0:
+            # Calibrate random subsets in parallel, and keep the one closest to the median of all of them so a few
+            # unlucky frames can't pull the result
+            rng = np.random.default_rng(seed)
+            subset_size = max(4, int(round(len(kept) * subset_fraction)))
+            subset_indices = [rng.choice(len(kept), size=min(subset_size, len(kept)), replace=False)
+                              for _ in range(subsets)]
+            subset_candidates = list(executor.map(_calibrate_subset,
+                                                  [([kept[i].object_points for i in indices],
+                                                    [kept[i].image_points for i in indices],
+                                                    image_size) for indices in subset_indices]))
+            vectors = np.array([_intrinsics_vector(c) for c in subset_candidates])
+            spread = np.std(vectors, axis=0)
+            distances = np.linalg.norm((vectors - np.median(vectors, axis=0)) / np.maximum(spread, 1e-12), axis=1)
+            logger.info(f"Subset spread: fx {spread[0]:.2f} fy {spread[1]:.2f} cx {spread[2]:.2f} "
+                        f"cy {spread[3]:.2f} px")
+            candidate = subset_candidates[int(np.argmin(distances))]
+
+    coverage = _grid_coverage(kept, image_size)
+    print(f"frames: {len(paths)} read, {len(accepted)} passed coverage, {len(kept)} kept")
+    print(f"image coverage: {coverage:.0%} of a {COVERAGE_GRID_SIZE}x{COVERAGE_GRID_SIZE} grid")
+    print(f"rms reprojection error: {candidate.rms_error:.3f} px")
+    print(f"camera matrix:\n{candidate.camera_matrix}")
+    print(f"distortion coefficients: {candidate.distortion_coeffs.reshape(-1)}")
+    print(f"total time: {time.perf_counter() - start:.1f} s")
+    if coverage < 0.75:
+        logger.warning("Calibration frames don't cover much of the image, distortion near the edges may be inaccurate")
+    if candidate.rms_error >= 1:
+        logger.warning(f"High reprojection error {candidate.rms_error:.3f}, calibration may be inaccurate")
+
+    write_calibration(output_file, candidate.camera_matrix, candidate.distortion_coeffs, candidate.rms_error)
+    logger.info(f"Calibration saved to {output_file}")
+    return candidate
@@ -0,0 +1,88 @@
+import logging
+import time
+from typing import List
+
+import cv2
+import numpy as np
+
+from ..config import Calibration, Config
+from ..pipeline import PipelineResult, PoseEstimator
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_calibration() -> Calibration:
+    return Calibration(np.array([[900.0, 0.0, 640.0], [0.0, 900.0, 360.0], [0.0, 0.0, 1.0]]),
+                       np.array([[0.05, -0.1, 0.0005, -0.0005, 0.02]]))
+
+
+def synthetic_tag_observations(config: Config,
+                               num_tags: int,
+                               seed: int = 0,
+                               noise_px: float = 0.3) -> PipelineResult:
+    rng = np.random.default_rng(seed)
+    size = config.fiducial.tag_size_m
+    object_points = np.array([[-size / 2.0, size / 2.0, 0],
+                              [size / 2.0, size / 2.0, 0],
+                              [size / 2.0, -size / 2.0, 0],
+                              [-size / 2.0, -size / 2.0, 0]])
+    ids = np.arange(num_tags, dtype=np.int32).reshape(-1, 1)
+    corners = []
+    for tag_id in range(num_tags):
+        rvec = np.array([np.pi, 0.0, 0.0]) + rng.uniform(-0.6, 0.6, 3)
+        tvec = np.array([rng.uniform(-1.0, 1.0), rng.uniform(-0.5, 0.5), rng.uniform(1.0, 5.0)])
+        image_points, _ = cv2.projectPoints(object_points,
+                                            rvec,
+                                            tvec,
+                                            config.calibration.intrinsics_matrix,
+                                            config.calibration.distortion_coeffs)
+        corners.append((image_points.reshape(1, 4, 2) + rng.normal(0, noise_px, (1, 4, 2))).astype(np.float32))
+    result = PipelineResult()
+    result.set_detections(ids, corners)
+    return result
+
+
+def run_pose_benchmark(config: Config, tag_counts: List[int], iterations: int):
+    if not config.has_calibration():
+        logger.info("No calibration loaded, using synthetic camera intrinsics")
+        config.calibration = synthetic_calibration()
+    config.fiducial.tag_layout = None
+    estimator = PoseEstimator(config)
+
+    print(f"{'tags':>6}{'per-tag ms':>12}{'batched ms':>12}{'max dt m':>12}{'max dr rad':>12}{'max derr px':>12}")
+    for num_tags in tag_counts:
+        observations = synthetic_tag_observations(config, num_tags)
+
+        indices = range(num_tags)
+        expected = PipelineResult()
+        actual = PipelineResult()
+        for result in (expected, actual):
+            result.copy_from(observations)
+
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            expected.num_targets = 0
+            estimator.solve_target_poses_per_tag(expected, indices)
+        per_tag_ms = (time.perf_counter_ns() - start) / 1e6 / iterations
+
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            actual.num_targets = 0
+            estimator.solve_target_poses_batched(actual, indices)
+        batched_ms = (time.perf_counter_ns() - start) / 1e6 / iterations
+
+        if expected.num_targets != actual.num_targets:
+            logger.error(f"Per-tag path solved {expected.num_targets} tags but batched path solved "
+                         f"{actual.num_targets}")
+        num_targets = min(expected.num_targets, actual.num_targets)
+        expected_poses = expected.target_poses[:num_targets]
+        actual_poses = actual.target_poses[:num_targets]
+        max_translation_diff = np.max(np.linalg.norm(expected_poses[..., :3] - actual_poses[..., :3], axis=-1),
+                                      initial=0.0)
+        quaternion_dots = np.abs(np.sum(expected_poses[..., 3:] * actual_poses[..., 3:], axis=-1))
+        max_rotation_diff = np.max(2 * np.arccos(np.minimum(quaternion_dots, 1.0)), initial=0.0)
+        max_error_diff = np.max(np.abs(expected.target_errors[:num_targets] - actual.target_errors[:num_targets]),
+                                initial=0.0)
+
+        print(f"{num_tags:>6}{per_tag_ms:>12.3f}{batched_ms:>12.3f}{max_translation_diff:>12.2e}"
+              f"{max_rotation_diff:>12.2e}{max_error_diff:>12.2e}")
@@ -0,0 +1,373 @@
+import json
+import logging
+import os
+import platform
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import cv2
+import ntcore
+import numpy as np
+from wpimath.geometry import Pose3d, Rotation3d, Translation3d
+
+from ..config import Config
+from ..coordinate_util import (from_opencv_rotation,
+                               from_opencv_rotation_matrices,
+                               from_opencv_translation,
+                               from_opencv_translations,
+                               quaternion_to_rotation_matrix,
+                               to_opencv_translation,
+                               to_pose_vectors)
+from ..output import NTOutputPublisher
+from ..output.StreamServer import encode_stream_frame
+from ..pipeline import ArUcoFiducialDetector, CaptureFrame, PipelineResult, PoseEstimator
+from .pose_benchmark import synthetic_calibration, synthetic_tag_observations
+from .synthetic_frames import generate_synthetic_frames
+
+logger = logging.getLogger(__name__)
+
+BASELINE_VERSION = 1
+# Rounds shorter than this are lengthened by running the benchmark several times per round, so timer overhead
+# doesn't dominate the microsecond benchmarks
+MIN_ROUND_S = 0.002
+WARMUP_ROUNDS = 5
+
+
+@dataclass(frozen=True)
+class _Benchmark:
+    run: Callable[[], None]
+    # Called before every run without being timed, for benchmarks that need fresh state each run
+    prepare: Optional[Callable[[], None]] = None
+
+
+@dataclass(frozen=True)
+class BenchmarkTiming:
+    name: str
+    rounds: int
+    median_us: float
+    p90_us: float
+
+
+@dataclass(frozen=True)
+class BenchmarkComparison:
+    timing: BenchmarkTiming
+    baseline_us: Optional[float]
+
+    @property
+    def change(self) -> Optional[float]:
+        if self.baseline_us is None:
+            return None
+        return self.timing.median_us / self.baseline_us - 1.0
+
+
+def machine_info() -> Dict[str, object]:
+    # Timings are only comparable to a baseline taken on the same machine with the same libraries
+    return {"machine": platform.machine(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "opencv_threads": cv2.getNumThreads()}
+
+
+def benchmark_config() -> Config:
+    # Fixed defaults, so results don't depend on the device config of the machine running the benchmarks
+    config = Config("", "", "")
+    config.calibration = synthetic_calibration()
+    config.fiducial.tag_family = cv2.aruco.DICT_APRILTAG_36h11
+    config.fiducial.tag_layout = None
+    return config
+
+
+def wall_tag_layout(num_tags: int) -> Dict[int, Pose3d]:
+    # Tags in a row on a wall 4 m in front of the field origin, facing back towards it
+    return {tag_id: Pose3d(Translation3d(4.0, 0.4 * (tag_id - (num_tags - 1) / 2.0), 0.8 + 0.2 * (tag_id % 2)),
+                           Rotation3d(0.0, 0.0, np.pi))
+            for tag_id in range(num_tags)}
+
+
+def _tag_layout_json(layout: Dict[int, Pose3d]) -> str:
+    tags = []
+    for tag_id, pose in layout.items():
+        quaternion = pose.rotation().getQuaternion()
+        tags.append({"ID": tag_id,
+                     "pose": {"translation": {"x": pose.x, "y": pose.y, "z": pose.z},
+                              "rotation": {"quaternion": {"w": quaternion.W(),
+                                                          "x": quaternion.X(),
+                                                          "y": quaternion.Y(),
+                                                          "z": quaternion.Z()}}}})
+    return json.dumps({"tags": tags, "field": {"length": 16.54, "width": 8.21}})
+
+
+def _layout_observations(config: Config, estimator: PoseEstimator, tag_ids: Sequence[int]) -> PipelineResult:
+    # Projects the layout corners of the tags from a fixed camera pose near the field origin, with fixed pixel noise
+    rng = np.random.default_rng(0)
+    layout = estimator._get_layout_cache()
+    rvec = np.array([0.02, -0.05, 0.01])
+    tvec = np.array([0.1, 0.3, -0.2])
+    corners = []
+    for tag_id in tag_ids:
+        image_points, _ = cv2.projectPoints(layout[tag_id][0],
+                                            rvec,
+                                            tvec,
+                                            config.calibration.intrinsics_matrix,
+                                            config.calibration.distortion_coeffs)
+        corners.append((image_points.reshape(1, 4, 2) + rng.normal(0, 0.2, (1, 4, 2))).astype(np.float32))
+    result = PipelineResult()
+    result.set_detections(np.array(tag_ids, dtype=np.int32).reshape(-1, 1), corners)
+    return result
+
+
+def _detect_fiducials() -> _Benchmark:
+    config = benchmark_config()
+    detector = ArUcoFiducialDetector(config)
+    frames = [CaptureFrame(frame.image, 0, frame.image.shape[0], frame.image.shape[1])
+              for frame in generate_synthetic_frames(config.fiducial.tag_family, 4, tags_per_frame=8)]
+    index = 0
+
+    def run():
+        nonlocal index
+        detector.detect_fiducials(frames[index % len(frames)])
+        index += 1
+
+    return _Benchmark(run)
+
+
+def _detect_fiducials_layout() -> _Benchmark:
+    # Frames show 64 different IDs, of which only the 16 in the layout are decoded
+    config = benchmark_config()
+    config.fiducial.tag_layout = wall_tag_layout(16)
+    detector = ArUcoFiducialDetector(config)
+    frames = [CaptureFrame(frame.image, 0, frame.image.shape[0], frame.image.shape[1])
+              for frame in generate_synthetic_frames(config.fiducial.tag_family, 4, tags_per_frame=12,
+                                                     tag_ids=range(64))]
+    index = 0
+
+    def run():
+        nonlocal index
+        detector.detect_fiducials(frames[index % len(frames)])
+        index += 1
+
+    return _Benchmark(run)
+
+
+def _solve_camera_pose(num_tags: int) -> Callable[[], _Benchmark]:
+    def make() -> _Benchmark:
+        config = benchmark_config()
+        config.fiducial.tag_layout = wall_tag_layout(8)
+        estimator = PoseEstimator(config)
+        result = _layout_observations(config, estimator, list(range(num_tags)))
+
+        def prepare():
+            result.num_targets = 0
+            result.has_pose_estimate = False
+
+        return _Benchmark(lambda: estimator.solve_camera_pose(result), prepare)
+
+    return make
+
+
+def _solve_target_poses(num_tags: int) -> Callable[[], _Benchmark]:
+    def make() -> _Benchmark:
+        config = benchmark_config()
+        estimator = PoseEstimator(config)
+        result = synthetic_tag_observations(config, num_tags)
+
+        def prepare():
+            result.num_targets = 0
+
+        return _Benchmark(lambda: estimator.solve_target_poses(result), prepare)
+
+    return make
+
+
+def _coordinate_util_single() -> _Benchmark:
+    tvec = np.array([0.3, -0.2, 2.5])
+    rvec = np.array([3.0, 0.1, -0.2])
+    translation = Translation3d(2.5, -0.3, 0.2)
+
+    def run():
+        from_opencv_translation(tvec)
+        from_opencv_rotation(rvec)
+        to_opencv_translation(translation)
+        quaternion_to_rotation_matrix(0.5, 0.5, 0.5, 0.5)
+
+    return _Benchmark(run)
+
+
+def _coordinate_util_batch() -> _Benchmark:
+    rng = np.random.default_rng(0)
+    rotation_mats = np.array([cv2.Rodrigues(rvec)[0] for rvec in rng.uniform(-1.0, 1.0, (16, 2, 3)).reshape(-1, 3)])
+    rotation_mats = rotation_mats.reshape(16, 2, 3, 3)
+    tvecs = rng.uniform(-2.0, 2.0, (16, 2, 3))
+    out = np.empty((16, 2, 7))
+
+    def run():
+        to_pose_vectors(from_opencv_rotation_matrices(rotation_mats), from_opencv_translations(tvecs), out=out)
+
+    return _Benchmark(run)
+
+
+def _refresh_nt_layout() -> _Benchmark:
+    config = benchmark_config()
+    layout_entry = (ntcore.NetworkTableInstance.getDefault().getTable(f"orion/{config.network.device_id}/config")
+                    .getStringTopic("tag_layout").getEntry(""))
+    # Alternate between two layouts so every refresh sees a change and parses the layout
+    layouts = [_tag_layout_json(wall_tag_layout(16)), _tag_layout_json(wall_tag_layout(22))]
+    layout_entry.set(layouts[0])
+    config.refresh_nt()
+    index = 1
+
+    def prepare():
+        nonlocal index
+        layout_entry.set(layouts[index % len(layouts)])
+        index += 1
+
+    return _Benchmark(config.refresh_nt, prepare)
+
+
+def _publish() -> _Benchmark:
+    config = benchmark_config()
+    config.fiducial.tag_layout = wall_tag_layout(8)
+    estimator = PoseEstimator(config)
+    result = _layout_observations(config, estimator, list(range(8)))
+    estimator.solve_camera_pose(result)
+    result.capture_timestamp_ns = time.monotonic_ns()
+    output = NTOutputPublisher(config)
+    heartbeat = 0
+
+    def run():
+        nonlocal heartbeat
+        heartbeat += 1
+        output.publish(result, 60, heartbeat)
+
+    return _Benchmark(run)
+
+
+def _stream_encode() -> _Benchmark:
+    image = generate_synthetic_frames(cv2.aruco.DICT_APRILTAG_36h11, 1, tags_per_frame=8)[0].image
+    return _Benchmark(lambda: encode_stream_frame(image))
+
+
+BENCHMARKS: Dict[str, Callable[[], _Benchmark]] = {
+    "detect_fiducials 1280x720 8 tags": _detect_fiducials,
+    "detect_fiducials layout 16 of 64": _detect_fiducials_layout,
+    "solve_camera_pose 1 tag": _solve_camera_pose(1),
+    "solve_camera_pose 8 tags": _solve_camera_pose(8),
+    "solve_target_poses 2 tags": _solve_target_poses(2),
+    "solve_target_poses 16 tags": _solve_target_poses(16),
+    "coordinate_util single": _coordinate_util_single,
+    "coordinate_util 16x2 poses": _coordinate_util_batch,
+    "refresh_nt tag layout": _refresh_nt_layout,
+    "publish camera pose 8 targets": _publish,
+    "stream jpeg encode 1280x720": _stream_encode,
+}
+
+
+def time_benchmark(name: str, benchmark: _Benchmark, min_time_s: float) -> BenchmarkTiming:
+    # Runs the benchmark in rounds for at least min_time_s, returning the median and 90th percentile of the mean
+    # time per run of each round
+    runs_per_round = 1
+    if benchmark.prepare is None:
+        start = time.perf_counter()
+        benchmark.run()
+        elapsed_s = time.perf_counter() - start
+        runs_per_round = max(1, int(MIN_ROUND_S / max(elapsed_s, 1e-9)))
+
+    round_times_us = []
+    deadline = time.perf_counter() + min_time_s
+    while len(round_times_us) < WARMUP_ROUNDS + 10 or time.perf_counter() < deadline:
+        if benchmark.prepare is not None:
+            benchmark.prepare()
+        start = time.perf_counter_ns()
+        for _ in range(runs_per_round):
+            benchmark.run()
+        round_times_us.append((time.perf_counter_ns() - start) / 1e3 / runs_per_round)
+    round_times_us = round_times_us[WARMUP_ROUNDS:]
+    return BenchmarkTiming(name,
+                           len(round_times_us),
+                           float(np.median(round_times_us)),
+                           float(np.percentile(round_times_us, 90)))
+
+
+def load_baseline(baseline_file: str) -> Optional[dict]:
+    try:
+        with open(baseline_file, "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        logger.warning(f"Baseline file {baseline_file} is invalid, ignoring it")
+        return None
+    if baseline.get("version") != BASELINE_VERSION:
+        logger.warning(f"Baseline file {baseline_file} has an unsupported version, ignoring it")
+        return None
+    return baseline
+
+
+def save_baseline(baseline_file: str, timings: Sequence[BenchmarkTiming], previous: Optional[dict]):
+    # Benchmarks that weren't run keep their previous baseline
+    benchmarks = dict(previous["benchmarks"]) if previous is not None else {}
+    for timing in timings:
+        benchmarks[timing.name] = {"median_us": timing.median_us, "p90_us": timing.p90_us}
+    directory = os.path.dirname(baseline_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(baseline_file, "w") as f:
+        json.dump({"version": BASELINE_VERSION, "machine": machine_info(), "benchmarks": benchmarks}, f, indent=4)
+
+
+def run_regression_benchmark(baseline_file: str,
+                             names: Optional[List[str]] = None,
+                             threshold: float = 0.15,
+                             min_time_s: float = 1.0,
+                             update_baseline: bool = False) -> List[BenchmarkComparison]:
+    # Times each hot path on fixed synthetic fixtures and compares the medians with the stored baseline, returning
+    # the comparisons. A benchmark regressed if its median is more than threshold slower than the baseline.
+    selected = [name for name in BENCHMARKS
+                if names is None or len(names) == 0 or any(pattern in name for pattern in names)]
+    if len(selected) == 0:
+        logger.error(f"No benchmarks match {', '.join(names)}, available: {', '.join(BENCHMARKS)}")
+        return []
+
+    baseline = load_baseline(baseline_file)
+    if baseline is None:
+        logger.info(f"No baseline at {baseline_file}, run with --save-baseline to store one")
+    elif baseline.get("machine") != machine_info():
+        logger.warning(f"Baseline was recorded on a different machine or library versions ({baseline.get('machine')}), "
+                       "comparisons may not be meaningful")
+    baseline_benchmarks = baseline["benchmarks"] if baseline is not None else {}
+
+    nt_instance = ntcore.NetworkTableInstance.getDefault()
+    nt_instance.startLocal()
+    comparisons = []
+    try:
+        print(f"{'benchmark':<34}{'rounds':>8}{'median us':>12}{'p90 us':>12}{'baseline us':>13}{'change':>9}")
+        for name in selected:
+            timing = time_benchmark(name, BENCHMARKS[name](), min_time_s)
+            baseline_us = baseline_benchmarks.get(name, {}).get("median_us")
+            comparison = BenchmarkComparison(timing, baseline_us)
+            comparisons.append(comparison)
+
+            change = comparison.change
+            if change is None:
+                status = ""
+                change_str = "-"
+            else:
+                status = " REGRESSION" if change > threshold else " improved" if change < -threshold else ""
+                change_str = f"{change:+.1%}"
+            baseline_str = f"{baseline_us:.1f}" if baseline_us is not None else "-"
+            print(f"{name:<34}{timing.rounds:>8}{timing.median_us:>12.1f}{timing.p90_us:>12.1f}{baseline_str:>13}"
+                  f"{change_str:>9}{status}")
+    finally:
+        nt_instance.stopLocal()
+
+    regressions = [c for c in comparisons if c.change is not None and c.change > threshold]
+    if len(regressions) > 0:
+        print(f"{len(regressions)} of {len(comparisons)} benchmarks regressed by more than {threshold:.0%}")
+    if update_baseline:
+        save_baseline(baseline_file, [c.timing for c in comparisons], baseline)
+        logger.info(f"Saved baseline to {baseline_file}")
+    return comparisons
@@ -0,0 +1,35 @@
+import logging
+import time
+
+import numpy as np
+
+from ..config import Config
+from ..pipeline import Pipeline, RecordingCapture
+
+logger = logging.getLogger(__name__)
+
+
+def run_replay(config: Config, path: str, verbose: bool = False):
+    capture = RecordingCapture(path)
+    pipeline = Pipeline(config)
+
+    process_times_ms = []
+    frames_with_tags = 0
+    while True:
+        ret, frame = capture.get_frame()
+        if not ret:
+            break
+        start = time.perf_counter_ns()
+        result = pipeline.process_frame(frame)
+        process_times_ms.append((time.perf_counter_ns() - start) / 1e6)
+        if len(result.seen_tag_ids) > 0:
+            frames_with_tags += 1
+        if verbose:
+            print(f"{frame.timestamp_ns:>20}{process_times_ms[-1]:>10.2f} ms  tags {result.seen_tag_ids.tolist()}")
+        frame.release()
+
+    if len(process_times_ms) == 0:
+        logger.error(f"No frames could be read from {path}")
+        return
+    print(f"{len(process_times_ms)} frames, {frames_with_tags} with tags, "
+          f"{np.mean(process_times_ms):.2f} ms/frame mean, {np.percentile(process_times_ms, 95):.2f} ms p95")
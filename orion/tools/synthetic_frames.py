@@ -0,0 +1,116 @@
+import glob
+import os.path
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+
+# Detections further than this from the label are counted as misses
+MATCH_DISTANCE_PX = 5.0
+
+
+@dataclass(frozen=True)
+class LabeledFrame:
+    image: cv2.Mat
+    ids: npt.NDArray[np.int32]
+    corners: npt.NDArray[np.float64]
+
+
+def match_detections(frame: LabeledFrame,
+                     ids: Optional[npt.NDArray[np.int32]],
+                     corners: Sequence[npt.NDArray[np.float32]]) -> Tuple[int, List[float], int]:
+    if ids is None or len(ids) == 0:
+        return 0, [], 0
+    ids = np.asarray(ids).flatten()
+    corners = np.array(corners).reshape(-1, 4, 2)
+    matched = np.zeros(len(ids), dtype=bool)
+    corner_errors = []
+    for label_id, label_corners in zip(frame.ids, frame.corners):
+        candidates = np.flatnonzero((ids == label_id) & ~matched)
+        if len(candidates) == 0:
+            continue
+        errors = np.linalg.norm(corners[candidates] - label_corners, axis=2).mean(axis=1)
+        best = np.argmin(errors)
+        if errors[best] < MATCH_DISTANCE_PX:
+            matched[candidates[best]] = True
+            corner_errors.append(float(errors[best]))
+    return len(corner_errors), corner_errors, int(np.count_nonzero(~matched))
+
+
+def _render_tag(frame: npt.NDArray[np.uint8],
+                marker_dict: cv2.aruco.Dictionary,
+                tag_id: int,
+                dst_corners: npt.NDArray[np.float32]):
+    cell_px = 10
+    marker_px = (marker_dict.markerSize + 2) * cell_px
+    # Leave a one-cell white quiet zone around the marker
+    patch = np.full((marker_px + 2 * cell_px, marker_px + 2 * cell_px), 255, dtype=np.uint8)
+    patch[cell_px:cell_px + marker_px, cell_px:cell_px + marker_px] = cv2.aruco.generateImageMarker(marker_dict,
+                                                                                                    tag_id,
+                                                                                                    marker_px)
+    lo = cell_px - 0.5
+    hi = cell_px + marker_px - 0.5
+    src_corners = np.array([[lo, lo], [hi, lo], [hi, hi], [lo, hi]], dtype=np.float32)
+    homography = cv2.getPerspectiveTransform(src_corners, dst_corners)
+    size = (frame.shape[1], frame.shape[0])
+    warped = cv2.warpPerspective(patch, homography, size, flags=cv2.INTER_LINEAR)
+    mask = cv2.warpPerspective(np.full_like(patch, 255), homography, size, flags=cv2.INTER_LINEAR)
+    alpha = mask.astype(np.float32) / 255.0
+    frame[:] = (frame * (1.0 - alpha) + warped * alpha).astype(np.uint8)
+
+
+def generate_synthetic_frames(tag_family: int,
+                              num_frames: int,
+                              width: int = 1280,
+                              height: int = 720,
+                              tags_per_frame: int = 6,
+                              tag_ids: Optional[Sequence[int]] = None,
+                              seed: int = 0) -> List[LabeledFrame]:
+    rng = np.random.default_rng(seed)
+    marker_dict = cv2.aruco.getPredefinedDictionary(tag_family)
+    if tag_ids is None:
+        tag_ids = range(min(len(marker_dict.bytesList), 30))
+    tag_ids = np.asarray(tag_ids, dtype=np.int32)
+
+    # Place tags in a grid of cells so that they never overlap
+    grid_cols = int(np.ceil(np.sqrt(tags_per_frame * width / height)))
+    grid_rows = int(np.ceil(tags_per_frame / grid_cols))
+    cell_w = width / grid_cols
+    cell_h = height / grid_rows
+
+    frames = []
+    for _ in range(num_frames):
+        gradient = np.linspace(60, 180, width, dtype=np.float32)[np.newaxis, :]
+        frame = np.clip(gradient + rng.normal(0, 8, (height, width)), 0, 255).astype(np.uint8)
+
+        cells = rng.choice(grid_cols * grid_rows, size=tags_per_frame, replace=False)
+        ids = rng.choice(tag_ids, size=tags_per_frame, replace=len(tag_ids) < tags_per_frame)
+        corners = np.zeros((tags_per_frame, 4, 2), dtype=np.float64)
+        for i, (cell, tag_id) in enumerate(zip(cells, ids)):
+            max_size = 0.7 * min(cell_w, cell_h)
+            size = rng.uniform(0.3, 1.0) * max_size
+            center = np.array([(cell % grid_cols + 0.5) * cell_w, (cell // grid_cols + 0.5) * cell_h])
+            center += rng.uniform(-0.5, 0.5, 2) * (np.array([cell_w, cell_h]) - max_size)
+            angle = rng.uniform(-np.pi, np.pi)
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            square = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]]) * size
+            # Perturb corners to approximate perspective distortion
+            square += rng.uniform(-0.1, 0.1, (4, 2)) * size
+            corners[i] = square @ rotation.T + center
+            _render_tag(frame, marker_dict, int(tag_id), corners[i].astype(np.float32))
+
+        frame = cv2.GaussianBlur(frame, (3, 3), 0)
+        frames.append(LabeledFrame(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR), ids.astype(np.int32), corners))
+    return frames
+
+
+def load_image_frames(image_dir: str) -> List[cv2.Mat]:
+    images = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        image = cv2.imread(path)
+        if image is not None:
+            images.append(image)
+    return images